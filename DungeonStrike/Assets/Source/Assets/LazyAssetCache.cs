@@ -0,0 +1,78 @@
+﻿using System.Collections.Generic;
+using UnityEngine;
+
+namespace DungeonStrike.Source.Assets
+{
+    /// <summary>
+    /// A least-recently-used cache of assets loaded on first use from a Resources folder.
+    /// </summary>
+    /// <remarks>
+    /// Used by the accessors in <see cref="AssetUtil"/> for asset directories with <c>"mode": "lazy"</c> in
+    /// assets.json. Such assets are not referenced by <see cref="AssetRefs"/>, so they are not loaded with the scene.
+    /// Evicting an asset only drops this cache's reference to it. Unity frees the asset the next time unused assets
+    /// are unloaded (for example, on scene load) if nothing in the scene still uses it.
+    /// </remarks>
+    public static class LazyAssetCache
+    {
+        private struct Entry
+        {
+            public Object Asset;
+            public LinkedListNode<string> Node;
+        }
+
+        private static readonly Dictionary<string, Entry> Entries = new Dictionary<string, Entry>();
+
+        // Resource paths, most recently used first.
+        private static readonly LinkedList<string> RecentlyUsed = new LinkedList<string>();
+
+        /// <summary>
+        /// The maximum number of assets to keep references to.
+        /// </summary>
+        public static int Capacity = 64;
+
+        /// <summary>
+        /// Returns the asset at a path relative to a Resources folder, loading it if it is not cached.
+        /// </summary>
+        /// <param name="path">Resource path of the asset, without a file extension.</param>
+        /// <typeparam name="T">Type of the asset.</typeparam>
+        /// <returns>The asset.</returns>
+        public static T Load<T>(string path) where T : Object
+        {
+            Entry entry;
+            if (Entries.TryGetValue(path, out entry))
+            {
+                RecentlyUsed.Remove(entry.Node);
+                // Assets which Unity has since unloaded or destroyed compare equal to null.
+                if (entry.Asset != null)
+                {
+                    RecentlyUsed.AddFirst(entry.Node);
+                    return (T) entry.Asset;
+                }
+                Entries.Remove(path);
+            }
+
+            var asset = Resources.Load<T>(path);
+            if (asset == null)
+            {
+                throw new System.InvalidOperationException("Asset not found in Resources: " + path);
+            }
+
+            Entries[path] = new Entry {Asset = asset, Node = RecentlyUsed.AddFirst(path)};
+            while (Entries.Count > Capacity)
+            {
+                Entries.Remove(RecentlyUsed.Last.Value);
+                RecentlyUsed.RemoveLast();
+            }
+            return asset;
+        }
+
+        /// <summary>
+        /// Drops every cached reference.
+        /// </summary>
+        public static void Clear()
+        {
+            Entries.Clear();
+            RecentlyUsed.Clear();
+        }
+    }
+}
@@ -39,9 +39,11 @@
                    (clojure.tools.namespace.repl/set-refresh-dirs "src"
                                                                   "test"))}
 
-  :profiles {:uberjar {:aot [dungeonstrike.main]}
+  :profiles {:uberjar {:aot [dungeonstrike.main]
+                       :target-path "target/uberjar"}
              :dev {:dependencies [[org.clojure/tools.namespace "0.2.11"]
                                   [cider/cider-nrepl "0.14.0"]
+                                  [cljfmt "0.5.7"]
                                   [debugger "0.2.0"]
                                   [com.gfredericks/debug-repl "0.0.8"]]
                    :source-paths ["dev"]}})
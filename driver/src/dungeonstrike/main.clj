@@ -62,7 +62,8 @@
    [nil "--port PORT" "Specifies the port for the websocket server."]
    [nil "--verbose" "Requests verbose test output."]
    [nil "--crash-on-exceptions" "Causes the driver to exit on exceptions."]
-   [nil "--test TEST" "Runs integration test TEST (or 'all')."]])
+   [nil "--test TEST"
+    "Runs integration test TEST (or a comma-separated list, or 'all')."]])
 
 (defn exit [status msg]
   (println msg)
@@ -4,6 +4,7 @@
             [clojure.edn :as edn]
             [clojure.java.io :as io]
             [clojure.spec.alpha :as s]
+            [clojure.string :as string]
             [dungeonstrike.logger :as logger]
             [dungeonstrike.paths :as paths]
             [dungeonstrike.test-message-values :as test-message-values]
@@ -134,6 +135,14 @@
   (flatten (map #(recording-sequence-for-test (str % ".edn"))
                 (all-tests))))
 
+(defn- recording-sequence-for-tests
+  "Returns the sequence of recording objects required to run each of the tests
+   in `test-names` in order on a single client. A prerequisite shared by
+   several tests is only included the first time it is needed, so later tests
+   run against the state left behind by earlier ones."
+  [test-names]
+  (distinct (mapcat recording-sequence-for-test test-names)))
+
 (s/fdef run-integration-test :args
         (s/cat :test-name (s/or :test-name string? :test-keyword keyword?)))
 (defn run-integration-test
@@ -194,7 +203,7 @@
 
       :otherwise
       (concat [startup-recording]
-              (recording-sequence-for-test test)
+              (recording-sequence-for-tests (string/split test #","))
               [shutdown-recording]))))
 
 (defn- fail-test
@@ -0,0 +1,158 @@
+"""Creates and extracts the third party asset archive. The archive for an
+   assets version is a directory in 'third_party_path' named after the version,
+   containing one zip file ("chunk") per vendor directory in Assets/ThirdParty,
+   mirroring the per-vendor .svf files in the checksums directory. Chunks are
+   compressed and extracted in parallel."""
+
+import multiprocessing
+import os
+import shutil
+import zipfile
+import hashing
+
+ROOT_CHUNK = "_root"
+PARTIAL_SUFFIX = ".partial"
+
+def archive_path(env, version):
+  """Returns the directory containing the chunks for an assets version."""
+  return os.path.join(env.third_party_path, version)
+
+def legacy_archive_path(env, version):
+  """Returns the path of a single-file archive created by older versions of
+  compress_third_party.py."""
+  return os.path.join(env.third_party_path, version + ".zip")
+
+def third_party_root(env):
+  return os.path.join(env.client_root, "Assets", "ThirdParty")
+
+def chunk_names(third_party):
+  """Returns the names of the chunks for the contents of 'third_party': one
+  per directory, plus ROOT_CHUNK for the files at the top level."""
+  names = sorted(name for name in os.listdir(third_party)
+                 if os.path.isdir(os.path.join(third_party, name)))
+  return names + [ROOT_CHUNK]
+
+def _chunk_members(third_party, chunk):
+  """Returns (path on disk, archive name) pairs for the files in a chunk."""
+  assets = os.path.dirname(third_party)
+  if chunk == ROOT_CHUNK:
+    paths = [os.path.join(third_party, name)
+             for name in sorted(os.listdir(third_party))
+             if os.path.isfile(os.path.join(third_party, name))]
+  else:
+    root = os.path.join(third_party, chunk)
+    paths = [os.path.join(root, name) for name in hashing.list_files(root)]
+  return [(path, os.path.relpath(path, assets)) for path in paths]
+
+def _compress_chunk(job):
+  (third_party, chunk, output) = job
+  if os.path.isfile(output):
+    return (chunk, False)
+  partial = output + PARTIAL_SUFFIX
+  with zipfile.ZipFile(partial, "w", zipfile.ZIP_DEFLATED,
+                       allowZip64 = True) as archive:
+    for (path, name) in _chunk_members(third_party, chunk):
+      archive.write(path, name)
+  os.rename(partial, output)
+  return (chunk, True)
+
+def compress(env, version, jobs = None):
+  """Writes one chunk per vendor directory for 'version'. Chunks which already
+  exist are kept, so an interrupted run can be resumed."""
+  third_party = third_party_root(env)
+  output_dir = archive_path(env, version)
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  chunks = chunk_names(third_party)
+  work = [(third_party, chunk, os.path.join(output_dir, chunk + ".zip"))
+          for chunk in chunks]
+  _run(_compress_chunk, work, jobs, "Compressed")
+
+def _extract_chunk(job):
+  (third_party, chunk, archive_file, checksum_file, index_file) = job
+  target = (third_party if chunk == ROOT_CHUNK
+            else os.path.join(third_party, chunk))
+  if chunk != ROOT_CHUNK and os.path.isdir(target) and checksum_file:
+    (errors, rehashed) = hashing.verify_directory(
+      target, checksum_file, index_file, jobs = 1)
+    if not errors:
+      return (chunk, False)
+
+  expected = {}
+  if checksum_file:
+    expected = dict(hashing.read_svf(checksum_file))
+  assets = os.path.dirname(third_party)
+  staging = target + PARTIAL_SUFFIX if chunk != ROOT_CHUNK else None
+  if staging and os.path.exists(staging):
+    shutil.rmtree(staging)
+  with zipfile.ZipFile(archive_file) as archive:
+    members = []
+    for info in archive.infolist():
+      if info.filename.endswith("/"): continue
+      relative = os.path.relpath(os.path.join(assets, info.filename), target)
+      members.append((info, relative))
+    if checksum_file:
+      names = set(relative.replace(os.sep, "/") for (_, relative) in members)
+      errors = ([name + " is missing" for name in sorted(set(expected) - names)]
+                + [name + " is not listed" for name in
+                   sorted(names - set(expected))])
+      if errors:
+        raise ValueError(archive_file + " does not match " + checksum_file +
+                         ": " + ", ".join(errors))
+    for (info, relative) in members:
+      crc = expected.get(relative.replace(os.sep, "/"))
+      if crc is not None and crc != "%08x" % (info.CRC & 0xffffffff):
+        raise ValueError(archive_file + ": " + info.filename +
+                         " does not match " + checksum_file)
+      destination = os.path.join(staging or target, relative)
+      parent = os.path.dirname(destination)
+      if not os.path.isdir(parent):
+        os.makedirs(parent)
+      # ZipFile verifies each member's CRC32 as it is read.
+      with archive.open(info) as source:
+        with open(destination, "wb") as output:
+          shutil.copyfileobj(source, output, hashing.BUFFER_SIZE)
+  if staging:
+    if os.path.exists(target):
+      shutil.rmtree(target)
+    os.rename(staging, target)
+  return (chunk, True)
+
+def extract(env, version, jobs = None):
+  """Extracts the chunks for 'version' into Assets/ThirdParty. Vendor
+  directories whose contents already match their .svf file are skipped, and
+  vendor directories with no chunk in the archive are removed."""
+  third_party = third_party_root(env)
+  if not os.path.isdir(third_party):
+    os.makedirs(third_party)
+  source_dir = archive_path(env, version)
+  chunks = sorted(os.path.splitext(name)[0] for name in os.listdir(source_dir)
+                  if name.endswith(".zip"))
+  for name in os.listdir(third_party):
+    path = os.path.join(third_party, name)
+    if os.path.isdir(path) and name not in chunks:
+      shutil.rmtree(path)
+  index_root = os.path.join(env.checksums_root, ".index")
+  if not os.path.isdir(index_root):
+    os.makedirs(index_root)
+  work = []
+  for chunk in chunks:
+    checksum_file = os.path.join(env.checksums_root, chunk + ".svf")
+    work.append((third_party, chunk, os.path.join(source_dir, chunk + ".zip"),
+                 checksum_file if os.path.isfile(checksum_file) else None,
+                 os.path.join(index_root, chunk + ".json")))
+  _run(_extract_chunk, work, jobs, "Extracted")
+
+def _run(function, work, jobs, verb):
+  """Runs 'function' over 'work' in a process pool, printing progress as each
+  chunk completes."""
+  pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+  try:
+    done = 0
+    for (chunk, changed) in pool.imap_unordered(function, work):
+      done += 1
+      print("[" + str(done) + "/" + str(len(work)) + "] " +
+            (verb if changed else "Skipped") + " " + chunk)
+  finally:
+    pool.close()
+    pool.join()
@@ -0,0 +1,136 @@
+"""A content-addressed cache of build outputs. Each artifact is stored under a
+   key computed from the contents of its inputs, including its build script,
+   using a lib.ResultCache digest memo of its own. An unchanged driver or
+   client is restored from the cache instead of being rebuilt. Entries are
+   evicted in least-recently-used order once the cache grows beyond its size
+   limit."""
+
+import hashlib
+import os
+import shutil
+import lib
+import staging
+
+PARTIAL_SUFFIX = ".partial"
+
+def _size(path):
+  """Returns the total size in bytes of the files under 'path'."""
+  if not os.path.isdir(path):
+    return os.lstat(path).st_size
+  total = 0
+  for (dirpath, dirnames, filenames) in os.walk(path):
+    for name in filenames:
+      total += os.lstat(os.path.join(dirpath, name)).st_size
+  return total
+
+class ArtifactCache(object):
+  def __init__(self, env, max_bytes = None):
+    self.root = os.path.join(env.cache_root, "artifacts")
+    self.max_bytes = max_bytes or env.artifact_cache_bytes
+    # Artifact keys only hash the build inputs, so saving into the presubmit's
+    # digest memo would prune the digests of every other file.
+    self.results = lib.ResultCache(os.path.join(env.cache_root,
+                                                "artifact_digests"))
+    lib.mkdirs(self.root)
+
+  def key(self, name, root, inputs, config = ()):
+    """Returns the key for the artifact 'name' built from the files and
+    directories in 'inputs'. Paths are hashed relative to 'root', so that
+    copies of the project (such as the staging area) share entries. 'config'
+    is a list of additional strings, such as tool versions, which affect the
+    build."""
+    digest = hashlib.sha1()
+    def update(value):
+      if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+      digest.update(value + b"\0")
+    update(name)
+    for value in config:
+      update(value)
+    (files, missing) = lib.list_input_files(inputs)
+    for path in missing:
+      update("missing:" + os.path.relpath(path, root))
+    for path in files:
+      update(os.path.relpath(path, root))
+      update(self.results.file_digest(path))
+    return digest.hexdigest()
+
+  def save(self):
+    """Writes the digests memoized by 'key' to disk. Call this once, after
+    computing the keys for a build."""
+    self.results.save()
+
+  def restore(self, key, destination):
+    """Replaces 'destination' with the cached artifact for 'key'. Returns False
+    on a cache miss. Directories are restored with copy-on-write clones where
+    the filesystem supports them, since builds may modify their outputs in
+    place."""
+    entry = os.path.join(self.root, key)
+    cached = os.path.join(entry, os.path.basename(destination))
+    if not os.path.exists(cached):
+      return False
+    os.utime(entry, None)
+    if os.path.isdir(cached):
+      if os.path.isfile(destination) or os.path.islink(destination):
+        os.remove(destination)
+      staging.sync(cached, destination, link_prefixes = ("",),
+                   link_mode = "reflink", exclude = ("Logs",))
+    else:
+      lib.mkdirs(os.path.dirname(destination))
+      tmp = destination + PARTIAL_SUFFIX
+      shutil.copy2(cached, tmp)
+      os.rename(tmp, destination)
+    return True
+
+  def store(self, key, source):
+    """Copies the artifact at 'source' into the cache under 'key'."""
+    entry = os.path.join(self.root, key)
+    if os.path.isdir(entry):
+      return
+    partial = entry + PARTIAL_SUFFIX
+    if os.path.exists(partial):
+      shutil.rmtree(partial)
+    os.makedirs(partial)
+    target = os.path.join(partial, os.path.basename(source))
+    if os.path.isdir(source):
+      shutil.copytree(source, target, symlinks = True,
+                      ignore = shutil.ignore_patterns(
+                        "Logs", staging.MANIFEST_NAME))
+    else:
+      shutil.copy2(source, target)
+    os.rename(partial, entry)
+    self.evict()
+
+  def evict(self):
+    """Removes the least recently used entries until the cache fits in
+    'max_bytes'. The most recent entry is always kept."""
+    entries = []
+    for name in os.listdir(self.root):
+      path = os.path.join(self.root, name)
+      if name.endswith(PARTIAL_SUFFIX) or not os.path.isdir(path): continue
+      entries.append((os.stat(path).st_mtime, _size(path), path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for (mtime, size, path) in entries[:-1]:
+      if total <= self.max_bytes: break
+      print("Evicting cached artifact " + os.path.basename(path))
+      shutil.rmtree(path)
+      total -= size
+
+def driver_inputs(env):
+  """Returns the inputs of the driver.jar build."""
+  return [env.script("build_driver_jar.py"),
+          os.path.join(env.driver_root, "src"),
+          os.path.join(env.driver_root, "project.clj"),
+          os.path.join(env.effects_root, "src"),
+          os.path.join(env.effects_root, "project.clj")]
+
+def client_inputs(env):
+  """Returns the inputs of the Unity client build. Third party assets are
+  represented by the assets version instead of being hashed."""
+  inputs = [os.path.join(env.assets_dir_path, name)
+            for name in sorted(os.listdir(env.assets_dir_path))
+            if not name.startswith("ThirdParty")]
+  return inputs + [env.script("build_unity_client.py"),
+                   os.path.join(env.client_root, "ProjectSettings"),
+                   os.path.join(env.client_root, "assets_version.md5")]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+"""Queries the binary manifests of assets versions. See manifests.py."""
+
+import argparse
+import sys
+import time
+import lib
+import manifests
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Shows and compares the files in assets versions.")
+  subparsers = parser.add_subparsers(dest = "command")
+  subparsers.add_parser(
+    "update", help = "Build the manifest for the checksums directory")
+  show = subparsers.add_parser(
+    "show", help = "List the vendor directories in a version")
+  show.add_argument("version", nargs = "?", default = "current")
+  lookup = subparsers.add_parser(
+    "lookup", help = "Print the CRC of a file, relative to " +
+                     "Assets/ThirdParty")
+  lookup.add_argument("path")
+  lookup.add_argument("--version", default = "current")
+  diff = subparsers.add_parser(
+    "diff", help = "List the vendors and files which differ between two " +
+                   "versions")
+  diff.add_argument("old")
+  diff.add_argument("new", nargs = "?", default = "current")
+  diff.add_argument("--vendors", action = "store_true",
+                    help = "Only list the vendor directories which differ")
+  args = parser.parse_args(argv)
+
+  if args.command == "update":
+    print(manifests.update(env))
+  elif args.command == "show":
+    manifest = manifests.load(env, args.version)
+    print("Assets version " + manifest.version + ", root " + manifest.root +
+          ", " + str(len(manifest)) + " files")
+    for vendor in manifest.vendors.values():
+      print(vendor.hash + "  " + str(vendor.end - vendor.start).rjust(6) +
+            "  " + vendor.name)
+  elif args.command == "lookup":
+    crc = manifests.load(env, args.version).lookup(args.path)
+    if crc is None:
+      print("Error: " + args.path + " is not in assets version " +
+            args.version)
+      sys.exit(1)
+    print(crc)
+  else:
+    old = manifests.load(env, args.old)
+    new = manifests.load(env, args.new)
+    start = time.time()
+    (vendors, files) = manifests.diff(old, new)
+    for (name, status) in vendors:
+      print(status[0].upper() + " " + name + "/")
+    if not args.vendors:
+      for change in files:
+        print("  " + change.status[0].upper() + " " + change.path + " " +
+              (change.old_crc or "--------") + " -> " +
+              (change.new_crc or "--------"))
+    print(str(len(vendors)) + " vendor(s) and " + str(len(files)) +
+          " file(s) changed (compared in " +
+          lib.format_duration(time.time() - start) + ")")
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python2.7
+"""Benchmarks the build and presubmit scripts against a synthetic project much
+larger than the real one. The project is generated in a temporary directory:
+vendor directories full of ThirdParty files with matching .svf files, C# and
+Clojure sources, and an assets.json listing thousands of assets. Each script
+is run in-process several times and the fastest run is reported. Results are
+written as JSON, and can be compared against a previous result to catch
+regressions."""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+import hashing
+import lib
+
+# Sizes of the project generated at scale 1.0.
+VENDORS = 20
+FILES_PER_VENDOR = 2000
+FILES_PER_FOLDER = 50
+MAX_FILE_BYTES = 4096
+CS_FILES = 3000
+CLJ_FILES = 1000
+SOURCE_LINES = 150
+ASSET_DIRS = 500
+ASSETS_PER_DIR = 20
+LAZY_EVERY = 5
+
+# The benchmarks to run, in order, as (name, script, arguments). The indexed
+# checksum run relies on the index written by the full run before it.
+BENCHMARKS = [
+  ("lint", "lint.py", []),
+  ("checksum_full", "checksum.py", ["--full"]),
+  ("checksum_indexed", "checksum.py", []),
+  ("metasum", "metasum.py", []),
+  ("asset_references_full", "generate_asset_references.py", ["--full"]),
+  ("asset_references_incremental", "generate_asset_references.py", []),
+]
+
+class BenchmarkEnv(lib.Env):
+  """An Env for a synthetic project. Commands which would start lein are
+  skipped, since they measure the JVM rather than the scripts."""
+  def lein(self, args, allow_failure = False, project_root = None):
+    return 0
+
+def _write(path, content):
+  lib.mkdirs(os.path.dirname(path))
+  with open(path, "wb") as output:
+    output.write(content)
+
+def _count(base, scale):
+  return max(1, int(base * scale))
+
+def generate_third_party(env, rng, scale):
+  """Writes the ThirdParty vendor directories and their .svf files. Returns
+  the number of files and bytes written."""
+  third_party = os.path.join(env.assets_dir_path, "ThirdParty")
+  lib.mkdirs(env.checksums_root)
+  total_bytes = 0
+  for vendor in range(_count(VENDORS, scale)):
+    name = "Vendor%02d" % vendor
+    entries = []
+    for index in range(FILES_PER_VENDOR):
+      relative = "Folder%03d/file%05d.asset" % (index // FILES_PER_FOLDER,
+                                                index)
+      content = os.urandom(rng.randint(0, MAX_FILE_BYTES))
+      _write(os.path.join(third_party, name, relative), content)
+      entries.append((relative, "%08x" % (zlib.crc32(content) & 0xffffffff)))
+      total_bytes += len(content)
+    hashing.write_svf(os.path.join(env.checksums_root, name + ".svf"),
+                      entries)
+  return (_count(VENDORS, scale) * FILES_PER_VENDOR, total_bytes)
+
+def _cs_source(index):
+  lines = ["namespace DungeonStrike.Source.Benchmark", "{",
+           "    public class Generated%05d" % index, "    {"]
+  for line in range(SOURCE_LINES):
+    if line % 50 == 0:
+      lines.append("        // AllowBannedRegex: Logging is intended here.")
+      lines.append("        // Debug.Log(\"value\");")
+    lines.append("        private int _value%03d = %d; // Some padding text." %
+                 (line, line * index))
+  lines += ["    }", "}", ""]
+  return "\n".join(lines)
+
+def _clj_source(index):
+  lines = ["(ns dungeonstrike.benchmark.generated%05d)" % index, ""]
+  for line in range(SOURCE_LINES // 2):
+    lines.append("(defn function-%03d" % line)
+    lines.append("  [value]\n  (+ value %d))\n" % (line * index))
+  return "\n".join(lines)
+
+def generate_sources(env, scale):
+  """Writes C# and Clojure sources for the linter. Returns the number of
+  files written."""
+  cs_root = os.path.join(env.assets_dir_path, "Source", "Benchmark")
+  for index in range(_count(CS_FILES, scale)):
+    _write(os.path.join(cs_root, "Generated%05d.cs" % index),
+           _cs_source(index))
+  clj_root = os.path.join(env.driver_root, "src", "dungeonstrike", "benchmark")
+  for index in range(_count(CLJ_FILES, scale)):
+    _write(os.path.join(clj_root, "generated%05d.clj" % index),
+           _clj_source(index))
+  lib.mkdirs(os.path.join(env.driver_root, "test"))
+  return _count(CS_FILES, scale) + _count(CLJ_FILES, scale)
+
+def generate_asset_config(env, scale):
+  """Writes assets.json and the asset files it refers to. Every LAZY_EVERY'th
+  directory is loaded lazily from a Resources folder. Returns the number of
+  assets configured."""
+  types = [("Material", "mat"), ("GameObject", "prefab"), ("Sprite", "png")]
+  dirs = []
+  for index in range(_count(ASSET_DIRS, scale)):
+    (type_name, extension) = types[index % len(types)]
+    lazy = index % LAZY_EVERY == 0
+    path = ("Benchmark/Resources/Dir%04d" if lazy
+            else "Benchmark/Dir%04d") % index
+    config = {"path": path, "extensions": [extension],
+              "prefix": "Bench%04d" % index}
+    if lazy:
+      config["mode"] = "lazy"
+    dirs.append(config)
+    for asset in range(ASSETS_PER_DIR):
+      _write(os.path.join(env.assets_dir_path, path,
+                          "asset_%03d.%s" % (asset, extension)), b"")
+  asset_config = {"types": [{"type": type_name, "extension": extension}
+                            for (type_name, extension) in types],
+                  "dirs": dirs}
+  _write(env.asset_config_path, json.dumps(asset_config, indent = 2))
+  lib.mkdirs(os.path.join(env.assets_dir_path, "Source", "Assets", "Editor"))
+  lib.mkdirs(os.path.join(env.driver_root, "src", "dungeonstrike",
+                          "generated"))
+  return len(dirs) * ASSETS_PER_DIR
+
+def generate_project(env, scale, seed = 0):
+  """Generates the synthetic project for 'env'. Returns a dictionary
+  describing its size."""
+  rng = random.Random(seed)
+  (files, total_bytes) = generate_third_party(env, rng, scale)
+  return {
+    "third_party_files": files,
+    "third_party_bytes": total_bytes,
+    "source_files": generate_sources(env, scale),
+    "assets": generate_asset_config(env, scale),
+  }
+
+def run_benchmark(env, script, args, repeat):
+  """Runs 'script' in-process 'repeat' times. Returns the list of wall times
+  in seconds."""
+  times = []
+  for run in range(repeat):
+    start = time.time()
+    (code, output) = lib.run_script(env, env.script(script), args,
+                                    capture = True)
+    times.append(time.time() - start)
+    if code != 0:
+      print(output)
+      raise Exception(script + " failed with code " + str(code))
+  return times
+
+def compare(results, baseline, threshold):
+  """Prints each result next to its baseline. Returns the names of the
+  benchmarks which got slower by more than 'threshold'."""
+  regressions = []
+  width = max([len(name) for name in results] + [9])
+  print("\n" + "Benchmark".ljust(width) + "  Fastest   Median    Baseline")
+  for (name, result) in sorted(results.items(),
+                               key = lambda item: item[1]["order"]):
+    line = (name.ljust(width) + "  " +
+            lib.format_duration(result["seconds"]).ljust(8) + "  " +
+            lib.format_duration(result["median"]).ljust(8))
+    previous = baseline.get(name) if baseline else None
+    if previous:
+      line += "  " + lib.format_duration(previous["seconds"])
+      # Differences under a tenth of a second are treated as noise.
+      if (result["seconds"] > previous["seconds"] * threshold and
+          result["seconds"] - previous["seconds"] > 0.1):
+        line += "  REGRESSION"
+        regressions.append(name)
+    print(line.rstrip())
+  return regressions
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Benchmarks the scripts against a synthetic project.")
+  parser.add_argument("--scale", type = float, default = 1.0,
+                      help = "Size of the synthetic project, relative to " +
+                             "the default of " +
+                             str(VENDORS * FILES_PER_VENDOR) +
+                             " ThirdParty files")
+  parser.add_argument("--repeat", type = int, default = 3,
+                      help = "Number of times to run each benchmark")
+  parser.add_argument("--output",
+                      help = "Path to write the results to as JSON")
+  parser.add_argument("--baseline",
+                      help = "Results from a previous run to compare against")
+  parser.add_argument("--threshold", type = float, default = 1.25,
+                      help = "Slowdown factor reported as a regression")
+  parser.add_argument("--keep", action = "store_true",
+                      help = "Keep the synthetic project afterwards")
+  args = parser.parse_args(argv)
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    if baseline["scale"] != args.scale:
+      print("Error: Baseline was recorded at scale " +
+            str(baseline["scale"]) + ", not " + str(args.scale))
+      sys.exit(1)
+
+  root = tempfile.mkdtemp(prefix = "dungeonstrike-benchmark-")
+  try:
+    project_root = os.path.join(root, "project")
+    bench_env = BenchmarkEnv({
+      "unity_path": "",
+      "staging_path": os.path.join(root, "staging"),
+      "third_party_path": os.path.join(root, "archives"),
+      "cache_path": os.path.join(root, "cache"),
+    }, env.scripts_root, project_root)
+
+    print("Generating synthetic project in " + root + "...")
+    start = time.time()
+    project = generate_project(bench_env, args.scale)
+    print("Generated " + str(project["third_party_files"]) +
+          " ThirdParty files, " + str(project["source_files"]) +
+          " sources and " + str(project["assets"]) + " assets in " +
+          lib.format_duration(time.time() - start))
+
+    results = {}
+    for (order, (name, script, script_args)) in enumerate(BENCHMARKS):
+      print("Running " + name + "...")
+      times = run_benchmark(bench_env, script, script_args, args.repeat)
+      results[name] = {"order": order, "seconds": min(times),
+                       "median": median(times), "runs": times}
+  finally:
+    if args.keep:
+      print("Kept synthetic project in " + root)
+    else:
+      shutil.rmtree(root, ignore_errors = True)
+
+  regressions = compare(results, baseline and baseline["results"],
+                        args.threshold)
+  report = {
+    "scale": args.scale,
+    "repeat": args.repeat,
+    "project": project,
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "results": results,
+  }
+  if args.output:
+    with open(args.output, "w") as output:
+      json.dump(report, output, indent = 2, sort_keys = True)
+    print("\nWrote results to " + args.output)
+
+  if regressions:
+    print("\n" + str(len(regressions)) + " benchmark(s) regressed by more " +
+          "than " + str(args.threshold) + "x: " + ", ".join(regressions))
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(lib.init())
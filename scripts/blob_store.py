@@ -0,0 +1,54 @@
+#!/usr/bin/env python2.7
+"""Manages the local store of ThirdParty assets versions used by
+extract_third_party.py. See blobs.py."""
+
+import argparse
+import os
+import blobs
+import lib
+
+def current_version(env):
+  with open(os.path.join(env.client_root, "assets_version.md5")) as version:
+    return version.read().strip()
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Manages the ThirdParty blob store.")
+  subparsers = parser.add_subparsers(dest = "command")
+  subparsers.add_parser("list", help = "List stored versions")
+  subparsers.add_parser(
+    "add", help = "Store the current contents of Assets/ThirdParty as the " +
+                  "current assets version")
+  checkout = subparsers.add_parser(
+    "checkout", help = "Make Assets/ThirdParty match a stored version")
+  checkout.add_argument("version", nargs = "?",
+                        help = "Version to check out (default: the current " +
+                               "assets version)")
+  checkout.add_argument("--link", choices = ["reflink", "hardlink", "copy"],
+                        default = "reflink",
+                        help = "How to place files from the store. " +
+                               "Hardlinked files are read-only.")
+  remove = subparsers.add_parser("remove", help = "Remove a stored version")
+  remove.add_argument("version")
+  prune = subparsers.add_parser(
+    "prune", help = "Remove all but the most recently used versions")
+  prune.add_argument("--keep", type = int, default = 5,
+                     help = "Number of versions to keep")
+  args = parser.parse_args(argv)
+
+  store = blobs.BlobStore(env)
+  current = current_version(env)
+  if args.command == "list":
+    for version in store.versions():
+      print(version + (" (current)" if version == current else ""))
+  elif args.command == "add":
+    store.add(current)
+  elif args.command == "checkout":
+    blobs.print_stats(store.checkout(args.version or current, args.link))
+  elif args.command == "remove":
+    store.remove(args.version)
+  else:
+    store.prune(args.keep, current)
+
+if __name__ == "__main__":
+  main(lib.init())
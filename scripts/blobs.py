@@ -0,0 +1,318 @@
+"""A local content-addressed store of ThirdParty files, shared between assets
+   versions. Every file is stored once, as an object named by the SHA-1 of its
+   contents. Each chunk of Assets/ThirdParty (see archives.py) is described by
+   a tree object listing its files, and each assets version by a small
+   manifest naming its trees, so versions which share vendor directories share
+   their trees and objects too. Objects are reference counted and deleted when
+   the last version using them is removed.
+
+   Checking out a version only places files whose contents differ from what
+   is already in Assets/ThirdParty, by hardlinking or reflinking objects into
+   place. A stat index of the files in the working tree, like the one used by
+   checksum.py, avoids rehashing unchanged files."""
+
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import stat
+import tempfile
+import zlib
+import archives
+import hashing
+import lib
+import staging
+
+CheckoutStats = collections.namedtuple(
+  "CheckoutStats", ["placed_files", "placed_bytes", "reused_files",
+                    "deleted_files"])
+
+def _read_json(path, default):
+  try:
+    with open(path) as json_file:
+      return json.load(json_file)
+  except (IOError, ValueError):
+    return default
+
+def _write_file(path, content):
+  """Replaces the file at 'path' with the bytes 'content'. Each writer uses
+  its own temporary file, since several processes may share the store."""
+  lib.mkdirs(os.path.dirname(path))
+  (handle, tmp) = tempfile.mkstemp(prefix = os.path.basename(path) + ".",
+                                   suffix = ".tmp",
+                                   dir = os.path.dirname(path))
+  with os.fdopen(handle, "wb") as output:
+    output.write(content)
+  os.rename(tmp, path)
+
+def _write_json(path, value):
+  _write_file(path, json.dumps(value, sort_keys = True).encode("utf-8"))
+
+def _relative_files(third_party, chunk):
+  """Returns the paths of the files in 'chunk', relative to 'third_party'."""
+  if chunk == archives.ROOT_CHUNK:
+    return sorted(name for name in os.listdir(third_party)
+                  if os.path.isfile(os.path.join(third_party, name)))
+  return [chunk + "/" + name
+          for name in hashing.list_files(os.path.join(third_party, chunk))]
+
+def _store_file(job):
+  """Hashes the file at 'path' and copies it into the store if no object with
+  the same contents exists. Returns (path, stat key, sha1, crc)."""
+  (path, objects_root) = job
+  key = hashing.stat_key(os.stat(path))
+  digest = hashlib.sha1()
+  crc = 0
+  with open(path, "rb") as input_file:
+    for block in iter(lambda: input_file.read(hashing.BUFFER_SIZE), b""):
+      digest.update(block)
+      crc = zlib.crc32(block, crc)
+  sha1 = digest.hexdigest()
+  destination = os.path.join(objects_root, sha1[:2], sha1[2:])
+  if not os.path.isfile(destination):
+    tmp = destination + "." + str(os.getpid()) + ".tmp"
+    staging.place(path, tmp, "reflink")
+    if hashing.stat_key(os.stat(path))[:2] != key[:2]:
+      os.remove(tmp)
+      raise ValueError(path + " changed while it was being stored")
+    os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.rename(tmp, destination)
+  return (path, key, sha1, "%08x" % (crc & 0xffffffff))
+
+class BlobStore(object):
+  def __init__(self, env):
+    self.env = env
+    self.root = env.blob_store_path
+    self.objects_root = os.path.join(self.root, "objects")
+    self.versions_root = os.path.join(self.root, "versions")
+    self.refcounts_path = os.path.join(self.root, "refcounts.json")
+    # Maps paths relative to Assets/ThirdParty to [size, mtime_ns, inode,
+    # sha1, crc] for the files last stored or checked out.
+    self.index_path = os.path.join(env.cache_root, "blob_index.json")
+    self.third_party = archives.third_party_root(env)
+
+  @contextlib.contextmanager
+  def _locked(self):
+    """Holds an exclusive lock on the store, so that processes adding and
+    removing versions at the same time don't lose reference count
+    updates."""
+    lib.mkdirs(self.root)
+    with open(os.path.join(self.root, "lock"), "a") as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      yield
+
+  def object_path(self, sha1):
+    return os.path.join(self.objects_root, sha1[:2], sha1[2:])
+
+  def manifest_path(self, version):
+    return os.path.join(self.versions_root, version + ".json")
+
+  def has_version(self, version):
+    return os.path.isfile(self.manifest_path(version))
+
+  def versions(self):
+    """Returns the stored versions, most recently used first."""
+    if not os.path.isdir(self.versions_root):
+      return []
+    names = [name for name in os.listdir(self.versions_root)
+             if name.endswith(".json")]
+    names.sort(key = lambda name: os.path.getmtime(
+      os.path.join(self.versions_root, name)), reverse = True)
+    return [os.path.splitext(name)[0] for name in names]
+
+  def read_tree(self, tree):
+    """Returns the [path, sha1, crc, size] entries of a tree object."""
+    with open(self.object_path(tree)) as tree_file:
+      return json.load(tree_file)
+
+  def _write_object(self, content):
+    sha1 = hashlib.sha1(content).hexdigest()
+    path = self.object_path(sha1)
+    if not os.path.isfile(path):
+      _write_file(path, content)
+    return sha1
+
+  def add(self, version, jobs = None):
+    """Stores the contents of Assets/ThirdParty as 'version'. Every file
+    listed in a .svf file in the checksums directory must match its CRC.
+    Files which have not changed since they were last stored or checked out
+    are not read again."""
+    if self.has_version(version):
+      print("Assets version " + version + " is already stored")
+      return
+    index = _read_json(self.index_path, {})
+    chunks = {}
+    stale = []
+    for chunk in archives.chunk_names(self.third_party):
+      chunks[chunk] = _relative_files(self.third_party, chunk)
+      for name in chunks[chunk]:
+        path = os.path.join(self.third_party, name)
+        entry = index.get(name)
+        if (entry and entry[:3] == hashing.stat_key(os.stat(path)) and
+            os.path.isfile(self.object_path(entry[3]))):
+          continue
+        stale.append(path)
+
+    for prefix in range(256):
+      lib.mkdirs(os.path.join(self.objects_root, "%02x" % prefix))
+    work = [(path, self.objects_root) for path in stale]
+    if work:
+      print("Storing " + str(len(work)) + " changed files...")
+      pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+      try:
+        for (path, key, sha1, crc) in pool.imap_unordered(
+            _store_file, work, chunksize = 16):
+          name = os.path.relpath(path, self.third_party).replace(os.sep, "/")
+          index[name] = key + [sha1, crc]
+      finally:
+        pool.close()
+        pool.join()
+    _write_json(self.index_path, index)
+
+    errors = []
+    tree_entries = {}
+    for (chunk, names) in sorted(chunks.items()):
+      checksum_file = os.path.join(self.env.checksums_root, chunk + ".svf")
+      if os.path.isfile(checksum_file):
+        expected = dict((chunk + "/" + name, crc) for (name, crc)
+                        in hashing.read_svf(checksum_file))
+        for name in sorted(set(expected) - set(names)):
+          errors.append(name + " is missing")
+        for name in names:
+          if name in expected and index[name][4] != expected[name]:
+            errors.append(name + " has crc " + index[name][4] +
+                          ", expected " + expected[name])
+      tree_entries[chunk] = [
+        [name, index[name][3], index[name][4], index[name][0]]
+        for name in names]
+    if errors:
+      for error in errors:
+        print("Error: " + error)
+      raise ValueError("Assets/ThirdParty does not match the checksums " +
+                       "directory")
+
+    trees = dict(
+      (chunk, self._write_object(json.dumps(entries).encode("utf-8")))
+      for (chunk, entries) in tree_entries.items())
+
+    with self._locked():
+      if self.has_version(version):
+        print("Assets version " + version + " is already stored")
+        return
+      refcounts = _read_json(self.refcounts_path, {})
+      for tree in trees.values():
+        refcounts[tree] = refcounts.get(tree, 0) + 1
+        if refcounts[tree] == 1:
+          for (name, sha1, crc, size) in self.read_tree(tree):
+            refcounts[sha1] = refcounts.get(sha1, 0) + 1
+      _write_json(self.refcounts_path, refcounts)
+      _write_json(self.manifest_path(version), {"trees": trees})
+    print("Stored assets version " + version)
+
+  def remove(self, version):
+    """Removes 'version', deleting every object no other version uses."""
+    with self._locked():
+      manifest = _read_json(self.manifest_path(version), None)
+      if manifest is None:
+        raise ValueError("Assets version " + version + " is not stored")
+      # The manifest goes first, so an interrupted removal leaves unreferenced
+      # objects behind rather than a version with missing objects.
+      os.remove(self.manifest_path(version))
+      refcounts = _read_json(self.refcounts_path, {})
+      deleted = 0
+      def release(sha1):
+        refcounts[sha1] = refcounts.get(sha1, 1) - 1
+        if refcounts[sha1] > 0:
+          return False
+        del refcounts[sha1]
+        lib.rm(self.object_path(sha1))
+        return True
+      for tree in manifest["trees"].values():
+        if refcounts.get(tree, 1) == 1:
+          for (name, sha1, crc, size) in self.read_tree(tree):
+            if release(sha1):
+              deleted += 1
+        release(tree)
+      _write_json(self.refcounts_path, refcounts)
+      print("Removed assets version " + version + " (" + str(deleted) +
+            " files deleted)")
+
+  def prune(self, keep, current = None):
+    """Removes all but the 'keep' most recently used versions, never removing
+    the version 'current'."""
+    versions = [version for version in self.versions() if version != current]
+    kept = keep - (1 if current and self.has_version(current) else 0)
+    for version in versions[max(0, kept):]:
+      self.remove(version)
+
+  def checkout(self, version, link_mode = "reflink"):
+    """Makes Assets/ThirdParty match 'version', placing objects with
+    'link_mode' ('reflink', 'hardlink' or 'copy') only for files whose
+    contents differ. Hardlinked files share the read-only object, so they
+    cannot be modified in place. Returns a CheckoutStats."""
+    manifest = _read_json(self.manifest_path(version), None)
+    if manifest is None:
+      raise ValueError("Assets version " + version + " is not stored")
+    index = _read_json(self.index_path, {})
+    counts = collections.Counter()
+    wanted = {}
+    for (chunk, tree) in sorted(manifest["trees"].items()):
+      entries = self.read_tree(tree)
+      for (name, sha1, crc, size) in entries:
+        wanted[name] = sha1
+        path = os.path.join(self.third_party, name)
+        entry = index.get(name)
+        try:
+          key = hashing.stat_key(os.lstat(path))
+        except OSError:
+          key = None
+        if entry and entry[:3] == key and entry[3] == sha1:
+          counts["reused_files"] += 1
+          continue
+        staging.place(self.object_path(sha1), path, link_mode)
+        if link_mode != "hardlink":
+          os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
+                   stat.S_IROTH)
+        index[name] = hashing.stat_key(os.lstat(path)) + [sha1, crc]
+        counts["placed_files"] += 1
+        counts["placed_bytes"] += size
+      if chunk != archives.ROOT_CHUNK:
+        self._write_checksum_index(chunk, entries, index)
+
+    for (dirpath, dirnames, filenames) in os.walk(self.third_party,
+                                                  topdown = False):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        name = os.path.relpath(path, self.third_party).replace(os.sep, "/")
+        if name not in wanted:
+          os.remove(path)
+          index.pop(name, None)
+          counts["deleted_files"] += 1
+      if dirpath != self.third_party and not os.listdir(dirpath):
+        os.rmdir(dirpath)
+    for name in list(index):
+      if name not in wanted:
+        del index[name]
+    _write_json(self.index_path, index)
+    os.utime(self.manifest_path(version), None)
+    return CheckoutStats(*[counts[field] for field in CheckoutStats._fields])
+
+  def _write_checksum_index(self, chunk, entries, index):
+    """Writes the stat index used by checksum.py for a vendor directory, so
+    that files placed by checkout are not rehashed when they are verified."""
+    prefix = chunk + "/"
+    checksum_index = dict(
+      (name[len(prefix):], index[name][:3] + [crc])
+      for (name, sha1, crc, size) in entries)
+    _write_json(os.path.join(self.env.checksums_root, ".index",
+                             chunk + ".json"), checksum_index)
+
+def print_stats(stats):
+  """Prints a summary of the work done by 'checkout'."""
+  print("Placed " + str(stats.placed_files) + " files (" +
+        str(round(stats.placed_bytes / (1024.0 * 1024.0), 1)) +
+        " MB), kept " + str(stats.reused_files) + " unchanged files, " +
+        "deleted " + str(stats.deleted_files) + " files.")
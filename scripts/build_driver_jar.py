@@ -1,19 +1,35 @@
 #!/usr/bin/env python2.7
+import argparse
 import os
 import lib
-env = lib.init()
+import artifacts
 
-print("\nBuilding Driver...\n")
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(description = "Builds driver.jar.")
+  parser.add_argument("--no-cache", action = "store_true",
+                      help = "Rebuild even if a cached jar matches the sources")
+  args = parser.parse_args(argv)
 
-env.lein(["uberjar"])
-out = os.path.join(env.driver_root, "out")
-lib.mkdirs(out)
+  jar = os.path.join(env.driver_jar_path, "driver.jar")
+  cache = artifacts.ArtifactCache(env)
+  key = cache.key("driver.jar", env.project_root, artifacts.driver_inputs(env),
+                  [cache.results.tool_version("lein")])
+  cache.save()
 
-os.rename(os.path.join(env.driver_root,
-                       "target/dungeonstrike-0.1.0-SNAPSHOT-standalone.jar"),
-          os.path.join(env.driver_jar_path, "driver.jar"))
+  if not args.no_cache and cache.restore(key, jar):
+    print("\nDriver sources unchanged, using cached driver.jar\n")
+    return
 
-# Uberjar artifacts break tools.namespace reloading, must clean after every
-# build:
+  print("\nBuilding Driver...\n")
 
-env.lein(["clean"])
+  env.lein(["uberjar"])
+  lib.mkdirs(env.driver_jar_path)
+
+  # The uberjar profile compiles into its own target path, so its AOT classes
+  # don't break tools.namespace reloading and don't need to be cleaned.
+  os.rename(os.path.join(env.driver_root, "target", "uberjar",
+                         "dungeonstrike-0.1.0-SNAPSHOT-standalone.jar"), jar)
+  cache.store(key, jar)
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -1,12 +1,33 @@
 #!/usr/bin/env python2.7
+import argparse
 import lib
-env = lib.init()
+import artifacts
 
-print("\nBuilding Unity client...\n")
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(description = "Builds the Unity client.")
+  parser.add_argument("--no-cache", action = "store_true",
+                      help = "Rebuild even if a cached client matches the " +
+                             "sources")
+  args = parser.parse_args(argv)
 
-env.unity([
-  "-quit",
-  "-batchmode",
-  "-projectPath", env.client_root,
-  "-buildOSXUniversalPlayer", env.client_binary_path
-])
+  cache = artifacts.ArtifactCache(env)
+  key = cache.key("DungeonStrike.app", env.project_root,
+                  artifacts.client_inputs(env), [env.unity_path])
+  cache.save()
+
+  if not args.no_cache and cache.restore(key, env.client_binary_path):
+    print("\nClient sources unchanged, using cached client\n")
+    return
+
+  print("\nBuilding Unity client...\n")
+
+  env.unity([
+    "-quit",
+    "-batchmode",
+    "-projectPath", env.client_root,
+    "-buildOSXUniversalPlayer", env.client_binary_path
+  ])
+  cache.store(key, env.client_binary_path)
+
+if __name__ == "__main__":
+  main(lib.init())
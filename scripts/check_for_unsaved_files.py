@@ -1,10 +1,18 @@
 #!/usr/bin/env python2.7
 import os
+import sys
+import fileindex
 import lib
-env = lib.init()
 
-unsaved = lib.output(["find", env.project_root, "-name", ".#*"])
-if len(unsaved.strip()) > 0:
-  print("Error: Unsaved files")
-  print unsaved
-  exit(1)
+def main(env, argv = None):
+  # Editor lock files for unsaved buffers are never tracked by git, so only
+  # untracked files need to be checked.
+  unsaved = [path for path in fileindex.load(env).untracked()
+             if os.path.basename(path).startswith(".#")]
+  if unsaved:
+    print("Error: Unsaved files")
+    print("\n".join(unsaved))
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -1,17 +1,62 @@
 #!/usr/bin/env python
+"""Validates the contents of Assets/ThirdParty against the checksums in the
+checksums directory. A stat index of previously verified files is kept in
+checksums/.index so that only files which changed since the last run are
+rehashed."""
+
+import argparse
 import os
+import sys
+import hashing
 import lib
-env = lib.init()
 
-print("\nValidating checksums...\n")
-third_party = os.path.join(env.client_root, 'Assets/ThirdParty')
+def third_party_root(env):
+  return os.path.join(env.client_root, 'Assets/ThirdParty')
+
+def vendors(env):
+  """Returns the names of the vendor directories in Assets/ThirdParty."""
+  third_party = third_party_root(env)
+  return [directory for directory in sorted(os.listdir(third_party))
+          if os.path.isdir(os.path.join(third_party, directory)) and
+          directory != "Plugins"]
 
-for directory in os.listdir(third_party):
-  path = os.path.join(third_party, directory)
-  if not os.path.isdir(path): continue
-  if directory == "Plugins": continue
+def verify(env, directory, full = False):
+  """Verifies the vendor directory 'directory' against its .svf file. Returns
+  a tuple of (list of error messages, number of files rehashed)."""
   checksum_file = os.path.join(env.checksums_root, directory + ".svf")
-  lib.call(["cfv", "-rr", "-VV", "-p", path, '-f', checksum_file])
-  print(directory + " OK")
+  if not os.path.isfile(checksum_file):
+    return (["No checksum file found for " + directory], 0)
+  index_root = os.path.join(env.checksums_root, ".index")
+  lib.mkdirs(index_root)
+  with lib.span(directory, "vendor"):
+    (errors, rehashed) = hashing.verify_directory(
+      os.path.join(third_party_root(env), directory), checksum_file,
+      os.path.join(index_root, directory + ".json"), full = full)
+  return ([directory + "/" + error for error in errors], rehashed)
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Validates ThirdParty asset checksums.")
+  parser.add_argument("--full", action = "store_true",
+                      help = "Rehash every file, ignoring the stat index")
+  args = parser.parse_args(argv)
+
+  print("\nValidating checksums...\n")
+
+  failed = False
+  for directory in vendors(env):
+    (errors, rehashed) = verify(env, directory, full = args.full)
+    for error in errors:
+      print("Error: " + error)
+    if errors:
+      failed = True
+    else:
+      print(directory + " OK (" + str(rehashed) + " files rehashed)")
+
+  if failed:
+    sys.exit(1)
+
+  print("ALL OK")
 
-print("ALL OK")
+if __name__ == "__main__":
+  main(lib.init())
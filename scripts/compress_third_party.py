@@ -1,7 +1,12 @@
 #!/usr/bin/env python2.7
 import os
 import shutil
+import archives
+import blobs
+import hashing
 import lib
+import manifests
+import metasum
 env = lib.init()
 
 print("Updating checksums...")
@@ -14,18 +19,15 @@ for directory in os.listdir(third_party):
   if not os.path.isdir(path): continue
   if directory == "Plugins": continue
   print path
-  lib.call(["cfv", "-C", "-rr", "-p", path])
-  sfv = os.path.join(path, directory + ".sfv")
-  newPath = os.path.join(env.checksums_root,  directory + ".svf")
-  os.rename(sfv, newPath)
-  lib.call(["perl", "-p", "-i", "-e", "s/Generated.*//g", newPath])
+  hashing.write_svf(os.path.join(env.checksums_root, directory + ".svf"),
+                    hashing.checksum_directory(path))
 
 print("\nChecksums updated. Updating asset_version.md5...")
 
-metasum = lib.output([env.script("metasum.py")]).rstrip()
 version_path = os.path.join(env.client_root, "assets_version.md5")
 with open(version_path, "w") as assets_version:
-  assets_version.write(metasum)
+  assets_version.write(metasum.compute(env))
+manifests.update(env)
 
 print("asset_version.md5 updated")
 
@@ -38,15 +40,20 @@ if not keep_going:
 
 print("Creating third party archive...")
 
-third_party = os.path.join(env.client_root, "Assets", "ThirdParty")
-checksum = lib.output([env.script("metasum.py")]).rstrip()
-
-size = lib.output(["du", "-sk", third_party]).split("\t")[0]
-
-if os.path.exists(env.third_party_path):
-  shutil.rmtree(env.third_party_path)
+checksum = metasum.compute(env)
 
+# Remove archives for other assets versions. Chunks already written for this
+# version are kept so that an interrupted run resumes where it left off.
 lib.mkdirs(env.third_party_path)
-output_file = os.path.join(env.third_party_path, checksum + ".zip")
-
-lib.call(["7z", "a", "-r",  output_file, third_party])
+for name in os.listdir(env.third_party_path):
+  path = os.path.join(env.third_party_path, name)
+  if name == checksum: continue
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  else:
+    os.remove(path)
+
+archives.compress(env, checksum)
+
+print("Adding assets version " + checksum + " to the blob store...")
+blobs.BlobStore(env).add(checksum)
@@ -1,12 +1,59 @@
 #!/usr/bin/env python2.7
+import argparse
 import os
+from multiprocessing.pool import ThreadPool
 import lib
-env = lib.init()
+import staging
 
-print("\nCopying all project files to staging directory...\n")
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Copies the project to the staging workspaces.")
+  parser.add_argument("--link-mode", choices = ["hardlink", "reflink", "copy"],
+                      default = "hardlink",
+                      help = "How to place third party assets in the staging " +
+                             "directory (default: hardlink)")
+  parser.add_argument("--workspace", action = "append",
+                      help = "Staging workspace to copy to, which the caller " +
+                             "has locked. May be repeated. By default, every " +
+                             "workspace is locked and copied to.")
+  args = parser.parse_args(argv)
 
-lib.call([
-  "rsync", "--archive", "--delete", "--quiet",
-  env.project_root + os.sep, # Need trailing / to make rsync not create a subdir
-  env.staging_path
-])
+  lease = None
+  workspaces = args.workspace
+  if not workspaces:
+    lease = staging.acquire_workspaces(env, env.staging_workspaces)
+    workspaces = lease.paths
+
+  print("\nCopying changed project files to " + str(len(workspaces)) +
+        " staging workspace(s)...\n")
+
+  # Third party assets are never modified, so they can share storage with the
+  # project instead of being copied.
+  third_party = os.path.relpath(
+    os.path.join(env.client_root, "Assets", "ThirdParty"), env.project_root)
+  exclude = staging.workspace_excludes(env)
+  source_scan = staging.scan(env.project_root, exclude)
+
+  def copy(workspace):
+    # The Library is rewritten by Unity, so it is never hardlinked.
+    seeded = staging.seed_library(env, workspace)
+    stats = staging.sync(env.project_root, workspace,
+                         link_prefixes = [third_party + os.sep],
+                         link_mode = args.link_mode, exclude = exclude,
+                         source_scan = source_scan)
+    return (workspace, seeded, stats)
+
+  pool = ThreadPool(len(workspaces))
+  try:
+    results = pool.map(copy, workspaces)
+  finally:
+    pool.close()
+    if lease:
+      lease.release()
+  for (workspace, seeded, stats) in results:
+    print(workspace + ":" + (" (Unity Library copied from the project)"
+                             if seeded else ""))
+    staging.print_stats(stats)
+
+if __name__ == "__main__":
+  main(lib.init())
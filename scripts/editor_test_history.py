@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+"""Shows the editor test history recorded by run_editor_tests.py: the tests
+which usually take longest, and those which got slower in the latest run."""
+
+import argparse
+import time
+import editor_tests
+import lib
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Shows editor test timing history.")
+  parser.add_argument("--count", type = int, default = 20,
+                      help = "Number of slowest tests to show")
+  parser.add_argument("--threshold", type = float, default = 1.5,
+                      help = "Slowdown factor reported as a regression")
+  args = parser.parse_args(argv)
+
+  connection = lib.history_db(env)
+  runs = connection.execute(
+    "SELECT id, started, seconds, shards, success FROM editor_test_runs " +
+    "ORDER BY id DESC LIMIT 5").fetchall()
+  if not runs:
+    print("No editor test runs recorded yet.")
+    return
+  latest = [editor_tests.TestResult(*row) for row in connection.execute(
+    "SELECT name, fixture, status, seconds FROM editor_test_results " +
+    "WHERE run_id = ?", (runs[0][0],))]
+  connection.close()
+
+  print("Recent runs:")
+  for (run_id, started, seconds, shards, success) in runs:
+    print("  " + time.strftime("%Y-%m-%d %H:%M", time.localtime(started)) +
+          "  " + ("passed" if success else "FAILED") + "  " +
+          lib.format_duration(seconds) + "  " + str(shards) + " shard(s)")
+
+  history = editor_tests.history(env)
+  typical = sorted(((editor_tests.median(durations), name)
+                    for (name, (fixture, durations)) in history.items()),
+                   reverse = True)[:args.count]
+  print("\nSlowest tests (median of the last " +
+        str(editor_tests.HISTORY_RUNS) + " runs):")
+  for (seconds, name) in typical:
+    print("  " + lib.format_duration(seconds).ljust(8) + " " + name)
+
+  estimates = editor_tests.fixture_estimates(env)
+  print("\nSlowest fixtures:")
+  for fixture in sorted(estimates, key = lambda f: -estimates[f])[:10]:
+    print("  " + lib.format_duration(estimates[fixture]).ljust(8) + " " +
+          fixture)
+
+  slow = editor_tests.slowdowns(env, latest, runs[0][0], args.threshold)
+  print("\nTests slower than usual in the latest run:" +
+        ("" if slow else " none"))
+  for (name, seconds, usual) in slow:
+    print("  " + lib.format_duration(seconds).ljust(8) + " (usually " +
+          lib.format_duration(usual) + ") " + name)
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,256 @@
+"""Results and timing history for the Unity editor tests. Unity writes the
+   results of '-runEditorTests' to an NUnit XML file, which is parsed into a
+   TestResult per test case and recorded in the history database (see
+   'lib.history_db').
+
+   The history is used to split the suite into shards which take about the
+   same time, so that the tests can run across several Unity instances, each
+   in its own staging workspace. Shards are made of whole fixtures, since
+   fixtures often share expensive setup, and each shard runs the fixtures
+   named in its '-editorTestsFilter'. Fixtures which have never run are found
+   by looking for test classes in the test sources. A test class which can't
+   be named in a filter, such as a generic one, would be left out of every
+   shard, so its presence disables sharding."""
+
+import collections
+import heapq
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+import lib
+
+TestResult = collections.namedtuple("TestResult", ["name", "fixture",
+                                                   "status", "seconds"])
+
+# Number of recent runs whose durations are used to estimate a test's time.
+HISTORY_RUNS = 10
+
+# NUnit 2 and NUnit 3 spell outcomes differently.
+_STATUSES = {
+  "passed": "passed", "success": "passed",
+  "failed": "failed", "failure": "failed", "error": "failed",
+}
+
+# Comments, strings and character literals, which are blanked out before
+# looking for declarations.
+_NOISE_PATTERN = re.compile(
+  r'//[^\n]*|/\*.*?\*/|@"(?:[^"]|"")*"|"(?:\\.|[^"\\\n])*"|' +
+  r"'(?:\\.|[^'\\\n])+'", re.DOTALL)
+# The parts of a C# file which matter for finding test classes: namespace and
+# class declarations, braces, and NUnit attributes.
+_TOKEN_PATTERN = re.compile(
+  r"\bnamespace\s+(?P<namespace>[\w.]+)|" +
+  r"(?P<modifiers>(?:\b\w+\s+)*)\bclass\s+(?P<class>\w+)" +
+  r"(?P<generic>\s*<)?(?:\s*:\s*(?P<base>[\w.]+))?|" +
+  r"(?P<open>\{)|(?P<close>\})|" +
+  r"\[\s*(?:NUnit\.Framework\.)?(?P<attribute>TestFixture|Test|UnityTest|" +
+  r"TestCase|TestCaseSource)\b")
+
+def fixture_of(name):
+  """Returns the fixture of the test with the full name 'name'."""
+  return name.split("(")[0].rsplit(".", 1)[0]
+
+def parse_results(path):
+  """Returns a list of TestResults from the NUnit 2 or NUnit 3 XML file at
+  'path'."""
+  results = []
+  for case in ElementTree.parse(path).iter("test-case"):
+    name = case.get("fullname") or case.get("name")
+    outcome = (case.get("result") or "").lower()
+    if case.get("executed") == "False":
+      outcome = "skipped"
+    seconds = case.get("duration") or case.get("time") or "0"
+    fixture = case.get("classname") or fixture_of(name)
+    results.append(TestResult(name, fixture, _STATUSES.get(outcome, "skipped"),
+                              float(seconds)))
+  return results
+
+def _test_classes(source):
+  """Returns a list of (full name, base class, is abstract, is generic, has
+  tests) for every class in the C# 'source'. Nested classes are named
+  'Outer+Inner', as NUnit names them. A class has tests if it is marked
+  [TestFixture] or has test methods."""
+  source = _NOISE_PATTERN.sub(lambda match: " " * len(match.group(0)), source)
+  classes = []
+  # One entry per open brace: None, or [kind, name, ...] for the namespace or
+  # class it opens.
+  scopes = []
+  pending = None
+  fixture = False
+  for match in _TOKEN_PATTERN.finditer(source):
+    if match.group("namespace"):
+      pending = ["namespace", match.group("namespace")]
+    elif match.group("class"):
+      pending = ["class", match.group("class"), match.group("base"),
+                 "abstract" in match.group("modifiers").split(),
+                 bool(match.group("generic")), fixture]
+      fixture = False
+    elif match.group("attribute") == "TestFixture":
+      fixture = True
+    elif match.group("attribute"):
+      owners = [scope for scope in scopes if scope and scope[0] == "class"]
+      if owners:
+        owners[-1][5] = True
+    elif match.group("open"):
+      scopes.append(pending)
+      pending = None
+    elif match.group("close") and scopes:
+      scope = scopes.pop()
+      if scope and scope[0] == "class":
+        name = ""
+        for outer in scopes:
+          if outer:
+            name += outer[1] + ("." if outer[0] == "namespace" else "+")
+        classes.append((name + scope[1],) + tuple(scope[2:]))
+  return classes
+
+def discover_fixtures(index, root):
+  """Finds the test fixtures in the C# sources under 'root', listed from the
+  FileIndex 'index', to schedule fixtures which have no history yet. A
+  fixture is a class which is not abstract and is marked [TestFixture], has
+  test methods, or derives from such a class. Returns a tuple of (set of
+  fixture names, list of fixtures which can't be named in a filter)."""
+  classes = []
+  for path in index.files(root, [".cs"]):
+    with open(path) as source_file:
+      source = source_file.read()
+    classes.extend((path,) + test_class for test_class in _test_classes(source))
+  # Derived classes inherit their base class's tests.
+  tests = set(name.split("+")[-1].split(".")[-1]
+              for (path, name, base, abstract, generic, has_tests) in classes
+              if has_tests)
+  changed = True
+  while changed:
+    changed = False
+    for (path, name, base, abstract, generic, has_tests) in classes:
+      short_name = name.split("+")[-1].split(".")[-1]
+      if base and base.split(".")[-1] in tests and short_name not in tests:
+        tests.add(short_name)
+        changed = True
+  fixtures = set()
+  unnamed = []
+  for (path, name, base, abstract, generic, has_tests) in classes:
+    if abstract or name.split("+")[-1].split(".")[-1] not in tests:
+      continue
+    if generic:
+      unnamed.append(name + " (" + os.path.relpath(path, index.root) + ")")
+    else:
+      fixtures.add(name)
+  return (fixtures, sorted(unnamed))
+
+def missing_fixtures(fixtures, results):
+  """Returns the fixtures in 'fixtures' which have no TestResults in
+  'results'."""
+  seen = set(result.fixture for result in results)
+  return sorted(fixture for fixture in fixtures if fixture not in seen)
+
+def record(env, results, started, shards):
+  """Records a run's TestResults in the history database. Returns the run's
+  id."""
+  connection = lib.history_db(env)
+  with connection:
+    cursor = connection.execute(
+      "INSERT INTO editor_test_runs (started, seconds, shards, success) " +
+      "VALUES (?, ?, ?, ?)",
+      (started, time.time() - started, shards,
+       all(result.status != "failed" for result in results)))
+    run_id = cursor.lastrowid
+    connection.executemany(
+      "INSERT INTO editor_test_results (run_id, name, fixture, status, " +
+      "seconds) VALUES (?, ?, ?, ?, ?)",
+      [(run_id, result.name, result.fixture, result.status, result.seconds)
+       for result in results])
+  connection.close()
+  return run_id
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def history(env, before = None, runs = HISTORY_RUNS):
+  """Returns a dictionary from test name to (fixture, list of durations of
+  its passing runs) over the last 'runs' runs, optionally only those before
+  the run with id 'before'."""
+  connection = lib.history_db(env)
+  if before is None:
+    query = ("SELECT id FROM editor_test_runs ORDER BY id DESC LIMIT ?",
+             (runs,))
+  else:
+    query = ("SELECT id FROM editor_test_runs WHERE id < ? " +
+             "ORDER BY id DESC LIMIT ?", (before, runs))
+  run_ids = [row[0] for row in connection.execute(*query)]
+  result = {}
+  if run_ids:
+    for (name, fixture, seconds) in connection.execute(
+        "SELECT name, fixture, seconds FROM editor_test_results " +
+        "WHERE status = 'passed' AND run_id IN (" +
+        ",".join("?" * len(run_ids)) + ")", run_ids):
+      result.setdefault(name, (fixture, []))[1].append(seconds)
+  connection.close()
+  return result
+
+def fixture_estimates(env, discovered = ()):
+  """Returns a dictionary from fixture name to its expected duration in
+  seconds: the sum of the median durations of its tests. Fixtures in
+  'discovered' without any history are expected to take as long as a typical
+  fixture."""
+  estimates = collections.defaultdict(float)
+  for (name, (fixture, durations)) in history(env).items():
+    estimates[fixture] += median(durations)
+  typical = median(list(estimates.values())) if estimates else 1.0
+  for fixture in discovered:
+    if fixture not in estimates:
+      estimates[fixture] = typical
+  return dict(estimates)
+
+def make_shards(estimates, count):
+  """Splits the fixtures in 'estimates' into at most 'count' shards with
+  similar total durations, by assigning the longest fixtures first, each to
+  the shard with the least work so far. Returns a list of (expected seconds,
+  list of fixtures), longest first."""
+  shards = [(0.0, index, []) for index in range(count)]
+  heapq.heapify(shards)
+  for fixture in sorted(estimates, key = lambda f: (-estimates[f], f)):
+    (total, index, fixtures) = heapq.heappop(shards)
+    fixtures.append(fixture)
+    heapq.heappush(shards, (total + estimates[fixture], index, fixtures))
+  return sorted([(total, sorted(fixtures))
+                 for (total, index, fixtures) in shards if fixtures],
+                reverse = True)
+
+def slowdowns(env, results, run_id, threshold = 1.5, minimum = 0.1):
+  """Returns (test name, seconds, typical seconds) for each passing test in
+  'results' which took more than 'threshold' times its median duration in
+  the runs before 'run_id', ignoring differences under 'minimum' seconds."""
+  previous = history(env, before = run_id)
+  result = []
+  for test in results:
+    if test.status != "passed" or test.name not in previous: continue
+    typical = median(previous[test.name][1])
+    if test.seconds > typical * threshold and test.seconds - typical > minimum:
+      result.append((test.name, test.seconds, typical))
+  return sorted(result, key = lambda s: s[2] - s[1])
+
+def print_report(results, slow, count = 10):
+  """Prints the slowest tests in 'results' and the slowdowns in 'slow'."""
+  passed = [r for r in results if r.status == "passed"]
+  failed = [r for r in results if r.status == "failed"]
+  print(str(len(passed)) + " passed, " + str(len(failed)) + " failed, " +
+        str(len(results) - len(passed) - len(failed)) + " skipped")
+  for result in failed:
+    print("FAILED " + result.name)
+  slowest = sorted(results, key = lambda r: -r.seconds)[:count]
+  if slowest:
+    print("\nSlowest tests:")
+    for result in slowest:
+      print("  " + lib.format_duration(result.seconds).ljust(8) + " " +
+            result.name)
+  if slow:
+    print("\nTests slower than usual:")
+    for (name, seconds, typical) in slow:
+      print("  " + lib.format_duration(seconds).ljust(8) + " (usually " +
+            lib.format_duration(typical) + ") " + name)
@@ -1,21 +1,38 @@
 #!/usr/bin/env python2.7
 import os
 import shutil
+import archives
+import blobs
 import lib
 env = lib.init()
 
-print("Extracing third party archive...")
-
 with open(os.path.join(env.client_root, "assets_version.md5")) as version:
   hash = version.read().rstrip()
 
-third_party = os.path.join(env.client_root, "Assets", "ThirdParty")
-if os.path.exists(third_party):
-  shutil.rmtree(third_party)
-lib.mkdirs(third_party)
+# Versions in the local blob store are checked out by replacing only the files
+# which differ from the current contents of Assets/ThirdParty.
+store = blobs.BlobStore(env)
+if store.has_version(hash):
+  print("Checking out third party assets from the blob store...")
+  blobs.print_stats(store.checkout(hash))
+  exit(0)
+
+print("Extracing third party archive...")
+
+if os.path.isdir(archives.archive_path(env, hash)):
+  archives.extract(env, hash)
+else:
+  # Archives created before per-vendor chunks are a single 7z-created zip file.
+  third_party = os.path.join(env.client_root, "Assets", "ThirdParty")
+  if os.path.exists(third_party):
+    shutil.rmtree(third_party)
+  lib.mkdirs(third_party)
+
+  lib.call([
+    "7z", "x",
+    archives.legacy_archive_path(env, hash),
+    "-o" + os.path.join(env.client_root, 'Assets')
+  ])
 
-lib.call([
-  "7z", "x",
-  os.path.join(env.third_party_path, hash + ".zip"),
-  "-o" + os.path.join(env.client_root, 'Assets')
-])
+print("Adding assets version " + hash + " to the blob store...")
+store.add(hash)
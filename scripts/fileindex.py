@@ -0,0 +1,223 @@
+"""A persistent index of the files in the project, shared by the scripts which
+   need "every file of type X under Y". The file list comes from git: tracked
+   files from 'git ls-files' and untracked ones from 'git ls-files --others
+   --exclude-standard', so ignored trees such as Unity's Library and the lein
+   target directories are never walked. The user's global excludes file is
+   not applied, since it commonly ignores the editor lock files which
+   check_for_unsaved_files.py looks for. The vendor and build trees in
+   'ignored_roots' are excluded even if git doesn't ignore them.
+
+   The index is saved in '<cache>/file_index.json' along with the mtimes of
+   git's index file and of every indexed directory. Creating, deleting or
+   renaming a file changes the mtime of its directory, so an up to date index
+   is reused after a single stat() per directory, and git is only asked again
+   when something changed. Projects which aren't git checkouts are walked
+   instead.
+
+   Queries use sorted lists of paths, per extension, so listing the files
+   under a directory costs a binary search plus the number of matches."""
+
+import bisect
+import collections
+import fnmatch
+import json
+import os
+import subprocess
+import threading
+import hashing
+import lib
+
+FORMAT_VERSION = 2
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def ignored_roots(env):
+  """Returns the directories whose contents are never indexed."""
+  return [
+    os.path.join(env.client_root, "Assets", "ThirdParty"),
+    os.path.join(env.client_root, "Library"),
+    os.path.join(env.client_root, "Temp"),
+    os.path.join(env.client_root, "Logs"),
+    os.path.join(env.driver_root, "target"),
+    os.path.join(env.driver_root, "out"),
+    os.path.join(env.effects_root, "target"),
+    os.path.join(env.effects_root, "out"),
+  ]
+
+def _mtime(path):
+  try:
+    return hashing.stat_key(os.stat(path))[1]
+  except OSError:
+    return None
+
+def _git(root, args):
+  """Runs git in 'root', returning its output split on NUL bytes, or None if
+  'root' is not a git checkout."""
+  process = subprocess.Popen(["git", "-C", root] + args,
+                             stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE)
+  output = process.communicate()[0]
+  if process.returncode != 0:
+    return None
+  return [path.decode("utf-8") for path in output.split(b"\0") if path]
+
+class FileIndex(object):
+  """The files in a project, as paths relative to the project root using '/'
+  as the separator. Call 'refresh' to bring the index up to date."""
+  def __init__(self, env):
+    self.root = env.project_root
+    self.path = os.path.join(env.cache_root, "file_index.json")
+    self.ignored = [os.path.relpath(path, self.root).replace(os.sep, "/") +
+                    "/" for path in ignored_roots(env)]
+    self.lock = threading.Lock()
+    self.state = self._load()
+    self._build_queries()
+
+  def _load(self):
+    try:
+      with open(self.path) as index_file:
+        state = json.load(index_file)
+      if state.get("format") == FORMAT_VERSION and state["root"] == self.root:
+        return state
+    except (IOError, ValueError, KeyError):
+      pass
+    return {"format": FORMAT_VERSION, "root": self.root, "git_dir": None,
+            "git_index": None, "dirs": {}, "tracked": [], "untracked": []}
+
+  def _save(self):
+    lib.mkdirs(os.path.dirname(self.path))
+    tmp = self.path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as index_file:
+      json.dump(self.state, index_file)
+    os.rename(tmp, self.path)
+
+  def _is_ignored(self, path):
+    return path.startswith(tuple(self.ignored))
+
+  def _changed(self):
+    """Returns True if git's index or any indexed directory changed since the
+    index was built."""
+    state = self.state
+    if not state["dirs"]:
+      return True
+    git_dir = state["git_dir"]
+    if git_dir and _mtime(os.path.join(git_dir, "index")) != state["git_index"]:
+      return True
+    for (directory, mtime) in state["dirs"].items():
+      if _mtime(os.path.join(self.root, directory)) != mtime:
+        return True
+    return False
+
+  def _list_git(self):
+    """Returns (tracked, untracked) from git, or None if the project is not a
+    git checkout."""
+    git_dir = _git(self.root, ["rev-parse", "-z", "--absolute-git-dir"])
+    if git_dir is None:
+      return None
+    self.state["git_dir"] = git_dir[0].strip()
+    self.state["git_index"] = _mtime(os.path.join(git_dir[0].strip(),
+                                                  "index"))
+    cached = _git(self.root, ["ls-files", "-z", "--cached"])
+    deleted = set(_git(self.root, ["ls-files", "-z", "--deleted"]))
+    untracked = _git(self.root, ["-c", "core.excludesFile=", "ls-files", "-z",
+                                 "--others", "--exclude-standard"])
+    return ([path for path in cached if path not in deleted], untracked)
+
+  def _list_walk(self):
+    """Returns (files, []) by walking the project."""
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(self.root):
+      relative = os.path.relpath(dirpath, self.root).replace(os.sep, "/")
+      prefix = "" if relative == "." else relative + "/"
+      dirnames[:] = [name for name in dirnames if name != ".git" and
+                     not self._is_ignored(prefix + name + "/")]
+      files.extend(prefix + name for name in filenames)
+    return (files, [])
+
+  def refresh(self):
+    """Brings the index up to date. Returns True if it changed."""
+    with self.lock:
+      if not self._changed():
+        return False
+      listing = self._list_git() or self._list_walk()
+      (tracked, untracked) = [sorted(path for path in paths
+                                     if not self._is_ignored(path))
+                              for paths in listing]
+      directories = set([""])
+      for path in tracked + untracked:
+        directory = os.path.dirname(path)
+        while directory not in directories:
+          directories.add(directory)
+          directory = os.path.dirname(directory)
+      self.state["tracked"] = tracked
+      self.state["untracked"] = untracked
+      self.state["dirs"] = dict(
+        (directory, _mtime(os.path.join(self.root, directory)))
+        for directory in directories)
+      self._save()
+      self._build_queries()
+      return True
+
+  def _build_queries(self):
+    # Editor lock files (such as Emacs's '.#Foo.cs') are only reported by
+    # 'untracked', so that they are never linted or formatted.
+    self.paths = sorted(path for path in
+                        self.state["tracked"] + self.state["untracked"]
+                        if not os.path.basename(path).startswith(".#"))
+    self.by_extension = collections.defaultdict(list)
+    for path in self.paths:
+      self.by_extension[os.path.splitext(path)[1]].append(path)
+
+  def _relative(self, directory):
+    relative = os.path.relpath(directory, self.root).replace(os.sep, "/")
+    return "" if relative == "." else relative + "/"
+
+  def _range(self, paths, prefix):
+    """Returns the paths in the sorted list 'paths' starting with 'prefix'."""
+    start = bisect.bisect_left(paths, prefix)
+    end = (bisect.bisect_left(paths, prefix[:-1] + "0") if prefix
+           else len(paths))
+    return paths[start:end]
+
+  def files(self, under = None, extensions = None):
+    """Returns the absolute paths of the files under the directory 'under'
+    (the whole project by default) with one of 'extensions' (such as '.cs'),
+    or with any extension if it is None, sorted by path."""
+    prefix = self._relative(under) if under else ""
+    if extensions is None:
+      matches = self._range(self.paths, prefix)
+    else:
+      matches = sorted(path for extension in set(extensions)
+                       for path in self._range(
+                         self.by_extension.get(extension, []), prefix))
+    return [os.path.join(self.root, path) for path in matches]
+
+  def glob(self, pattern, under = None):
+    """Returns the absolute paths of the files under 'under' whose path
+    relative to it matches the fnmatch 'pattern'. As in fnmatch, '*' also
+    matches '/'. A pattern ending in a literal extension only considers files
+    with that extension."""
+    prefix = self._relative(under) if under else ""
+    extension = os.path.splitext(pattern)[1]
+    if extension and not any(char in extension for char in "*?["):
+      candidates = self._range(self.by_extension.get(extension, []), prefix)
+    else:
+      candidates = self._range(self.paths, prefix)
+    return [os.path.join(self.root, path) for path in candidates
+            if fnmatch.fnmatchcase(path[len(prefix):], pattern)]
+
+  def untracked(self):
+    """Returns the absolute paths of the files git does not track and the
+    project does not ignore, including editor lock files."""
+    return [os.path.join(self.root, path) for path in self.state["untracked"]]
+
+def load(env):
+  """Returns the up to date FileIndex for the project. The index is shared
+  by every script running in this process."""
+  with _indexes_lock:
+    index = _indexes.get(env.project_root)
+    if index is None:
+      index = _indexes[env.project_root] = FileIndex(env)
+  index.refresh()
+  return index
@@ -1,19 +1,19 @@
 #!/usr/bin/env python2.7
 from __future__ import print_function
 
+import argparse
+import hashlib
 import os
 import lib
 import json
 import re
+import sys
 import collections
-env = lib.init()
-
-if not os.path.isfile(env.asset_config_path):
-  print("Error: assets.json not found!")
-  exit(1)
-
-asset_config = json.load(open(env.asset_config_path, "r"))
-
+import staging
+try:
+  from StringIO import StringIO
+except ImportError:
+  from io import StringIO
 class Printer:
   def __init__(self, file):
     self.file = file
@@ -40,6 +40,19 @@ class Printer:
 Asset = collections.namedtuple("Asset", ["name", "path", "type"])
 all_asset_names = set()
 
+# Maps the names of assets in directories with "mode": "lazy" to their path
+# relative to a Resources folder. These assets are loaded on first use through
+# LazyAssetCache instead of being referenced by AssetRefs.
+resource_paths = {}
+
+# Maps paths in the lazy Resources mirror to the lazy assets outside a
+# Resources folder which are copied there. See 'update_lazy_mirror'.
+mirrored_assets = {}
+
+# The directory, relative to Assets, of the lazy Resources mirror. It is
+# generated, so it is not checked in.
+LAZY_MIRROR = os.path.join("LazyResources", "Resources")
+
 def enum_name_from_file_name(filename, config):
   for replace, replace_with in config.get("replace", {}).items():
     filename = filename.replace(replace, replace_with)
@@ -55,36 +68,157 @@ def type_for_extension(extension, types):
     if type["extension"] == extension:
       return type
   print("Error: Extension not found in type map " + extension)
-  exit(1)
+  sys.exit(1)
 
-def add_assets_for_directory(asset_map, config, types):
-  path = os.path.join(env.assets_dir_path, config["path"])
+def unchanged(directories):
+  """Returns True if none of the directories in the provided map from path to
+  mtime have been modified."""
+  for (path, mtime) in directories.items():
+    try:
+      if os.path.getmtime(path) != mtime:
+        return False
+    except OSError:
+      return False
+  return True
+
+def list_directory(cache, path):
+  """Returns the paths of every file under 'path'. Adding, removing or
+  renaming a file changes the mtime of its parent directory, so the previous
+  listing is reused if no directory mtime changed."""
+  scan = cache["scans"].get(path)
+  if scan and unchanged(scan["directories"]):
+    return scan["files"]
+  directories = {}
+  result = []
   for root, dirs, files in os.walk(path):
-    for file_path in files:
-      (name, extension) = os.path.splitext(file_path)
-      extension = extension[1:] # strip leading dot
-      if matched_extension(extension, config):
-        type = type_for_extension(extension, types)
-        relative_path = os.path.relpath(os.path.join(root, file_path),
-                                        env.client_root)
-        asset_name = enum_name_from_file_name(name, config)
-        if asset_name in all_asset_names:
-          print("Error: Duplicate asset name! " + asset_name)
-          exit(1)
-        else:
-          all_asset_names.add(asset_name)
-        asset_map[type["type"]].add(
-          Asset(asset_name, relative_path, type["type"]))
-
-asset_map = collections.defaultdict(set)
-for config in asset_config["dirs"]:
-  add_assets_for_directory(asset_map, config, asset_config["types"])
+    directories[root] = os.path.getmtime(root)
+    result.extend(os.path.join(root, file_path) for file_path in files)
+  cache["scans"][path] = {"directories": directories, "files": result}
+  return result
+
+def resource_path(relative_path):
+  """Returns the path used to load an asset with Resources.Load, or None if the
+  asset is not inside a Resources folder."""
+  parts = os.path.splitext(relative_path)[0].split(os.sep)
+  if "Resources" not in parts:
+    return None
+  index = len(parts) - 1 - parts[::-1].index("Resources")
+  return "/".join(parts[index + 1:])
+
+def add_assets_for_directory(env, cache, asset_map, config, types):
+  path = os.path.join(env.assets_dir_path, config["path"])
+  mode = config.get("mode", "eager")
+  if mode not in ("eager", "lazy"):
+    print("Error: Unknown mode '" + mode + "' for " + config["path"])
+    sys.exit(1)
+  for full_path in list_directory(cache, path):
+    file_path = os.path.basename(full_path)
+    (name, extension) = os.path.splitext(file_path)
+    extension = extension[1:] # strip leading dot
+    if matched_extension(extension, config):
+      type = type_for_extension(extension, types)
+      relative_path = os.path.relpath(full_path, env.client_root)
+      asset_name = enum_name_from_file_name(name, config)
+      if asset_name in all_asset_names:
+        print("Error: Duplicate asset name! " + asset_name)
+        sys.exit(1)
+      else:
+        all_asset_names.add(asset_name)
+      if mode == "lazy":
+        resource = resource_path(relative_path)
+        if not resource:
+          # Resources.Load can only find assets in a Resources folder, so the
+          # asset is copied into the mirror under its path in Assets.
+          mirror_relative = os.path.join(config["path"],
+                                         os.path.relpath(full_path, path))
+          mirrored_assets[os.path.join(env.assets_dir_path, LAZY_MIRROR,
+                                       mirror_relative)] = full_path
+          resource = os.path.splitext(mirror_relative)[0].replace(os.sep, "/")
+        resource_paths[asset_name] = resource
+      asset_map[type["type"]].add(
+        Asset(asset_name, relative_path, type["type"]))
+
+def _mirror_meta(contents, mirror_path):
+  """Returns the .meta file for a mirrored asset: the source asset's, which
+  holds its import settings, with a GUID of its own derived from
+  'mirror_path'."""
+  guid = hashlib.md5(mirror_path.encode("utf-8")).hexdigest()
+  return re.sub(r"(?m)^guid: *[0-9a-fA-F]+", "guid: " + guid, contents)
+
+def update_lazy_mirror(env, mirrored):
+  """Makes the lazy Resources mirror hold exactly the assets in 'mirrored', a
+  dictionary from mirror path to source path. This lets lazy directories
+  outside a Resources folder, such as the checksum-locked card art in
+  ThirdParty, be loaded with Resources.Load. Assets are cloned where the
+  filesystem supports it and only copied again when their size or mtime
+  changes. Returns the number of files written or deleted."""
+  root = os.path.join(env.assets_dir_path, LAZY_MIRROR)
+  changes = 0
+  for (mirror, source) in sorted(mirrored.items()):
+    stat = os.stat(source)
+    try:
+      current = os.stat(mirror)
+    except OSError:
+      current = None
+    # Copies keep the mtime only to the microsecond, so whole seconds are
+    # compared.
+    if (not current or current.st_size != stat.st_size or
+        int(current.st_mtime) != int(stat.st_mtime)):
+      staging.place(source, mirror, "reflink")
+      changes += 1
+    if os.path.isfile(source + ".meta"):
+      with open(source + ".meta") as meta_file:
+        meta = _mirror_meta(meta_file.read(),
+                            os.path.relpath(mirror, env.assets_dir_path))
+      previous = None
+      if os.path.isfile(mirror + ".meta"):
+        with open(mirror + ".meta") as meta_file:
+          previous = meta_file.read()
+      if meta != previous:
+        with open(mirror + ".meta", "w") as meta_file:
+          meta_file.write(meta)
+        changes += 1
+
+  # Removes assets which are no longer mirrored, then empty directories and
+  # the .meta files Unity created for them.
+  for (dirpath, dirnames, filenames) in os.walk(root, topdown = False):
+    for name in filenames:
+      path = os.path.join(dirpath, name)
+      asset = path[:-len(".meta")] if name.endswith(".meta") else path
+      if asset not in mirrored and not os.path.isdir(asset):
+        os.remove(path)
+        changes += 1
+    if dirpath != root and not os.listdir(dirpath):
+      os.rmdir(dirpath)
+      lib.rm(dirpath + ".meta")
+  return changes
 
 header = ("// WARNING: Do not modify this file! This file is automatically\n" +
           "// generated by running 'scripts/generate_asset_references.py'.\n")
 
+def enum_type(asset_type):
+  return "PrefabName" if asset_type == "GameObject" else asset_type + "Name"
+
+def generate_resource_paths(asset_type, lazy, p):
+  """Prints a table from asset name to resource path for lazy assets."""
+  table_type = "Dictionary<" + enum_type(asset_type) + ", string>"
+  p.print("private static readonly " + table_type + " " + asset_type +
+          "Paths =")
+  p.indent()
+  p.print("new " + table_type)
+  p.brace()
+  for value in lazy:
+    p.print("{" + enum_type(asset_type) + "." + value.name + ", \"" +
+            resource_paths[value.name] + "\"},")
+  p.dedent()
+  p.print("};")
+  p.dedent()
+  p.print("")
+
 def generate_asset_loader(asset_map, p):
   p.print(header)
+  if resource_paths:
+    p.print("using System.Collections.Generic;")
   p.print("using UnityEngine;")
   p.print("using DungeonStrike.Source.Messaging;\n")
   p.print("namespace DungeonStrike.Source.Assets")
@@ -92,6 +226,9 @@ def generate_asset_loader(asset_map, p):
   p.print("public class AssetUtil")
   p.brace()
   for asset_type, asset_list in asset_map.items():
+    lazy = [value for value in asset_list if value.name in resource_paths]
+    if lazy:
+      generate_resource_paths(asset_type, lazy, p)
     if asset_type == "GameObject":
       p.print("public static GameObject InstantiatePrefab(" +
               "AssetRefs refs, PrefabName name)")
@@ -102,7 +239,9 @@ def generate_asset_loader(asset_map, p):
     p.print("switch (name)")
     p.brace()
     for value in asset_list:
-     if asset_type == "GameObject":
+     if value.name in resource_paths:
+       continue
+     elif asset_type == "GameObject":
        p.print("case PrefabName." + value.name + ":")
        p.indent()
        p.print("return Object.Instantiate(refs." + value.name + ");")
@@ -113,6 +252,16 @@ def generate_asset_loader(asset_map, p):
        p.print("return refs." + value.name + ";")
        p.dedent()
     p.unbrace()
+    if lazy:
+      p.print("string path;")
+      p.print("if (" + asset_type + "Paths.TryGetValue(name, out path))")
+      p.brace()
+      if asset_type == "GameObject":
+        p.print("return Object.Instantiate(" +
+                "LazyAssetCache.Load<GameObject>(path));")
+      else:
+        p.print("return LazyAssetCache.Load<" + asset_type + ">(path);")
+      p.unbrace()
     p.print("throw new System.InvalidOperationException" \
             "(\"Unknown asset name: \" + name);")
     p.unbrace()
@@ -129,6 +278,7 @@ def generate_refs(asset_map, p):
   p.brace()
   for name, values in asset_map.items():
     for value in values:
+      if value.name in resource_paths: continue
       p.print("public " + value.type + " " + value.name + ";")
   p.unbrace()
   p.unbrace()
@@ -146,6 +296,7 @@ def generate_linker(asset_map, p):
   p.brace()
   for name, values in asset_map.items():
     for value in values:
+      if value.name in resource_paths: continue
       p.print("refs." + value.name + " = AssetDatabase.LoadAssetAtPath<" + value.type + ">(\"" \
               + value.path + "\");")
       #p.print("refs." + value.name + " = AssetDatabase.LoadAssetAtPath(\"" \
@@ -173,14 +324,91 @@ def generate_assets_clj(asset_map, p):
     p.dedent()
     p.print("})\n")
 
-output_path = os.path.join(env.assets_dir_path, "Source", "Assets")
-generate_asset_loader(asset_map, Printer(
-  open(os.path.join(output_path, "AssetUtil.cs"), "w")))
-generate_refs(asset_map, Printer(
-  open(os.path.join(output_path, "AssetRefs.cs"), "w")))
-generate_linker(asset_map, Printer(
-  open(os.path.join(output_path, "Editor", "AssetLinker.cs"), "w")))
-generate_assets_clj(asset_map, Printer(
-  open(os.path.join(env.driver_root, "src", "dungeonstrike", "generated",
-                    "assets.clj"), "w")))
-env.lein(["cljfmt", "fix"])
+def write_if_changed(cache, asset_map, generator, path):
+  """Generates an output file in memory and writes it to 'path' only if it
+  differs from the output previously written there. Unity reimports any file
+  whose mtime changes, so unchanged outputs must not be touched. Returns True
+  if the file was written."""
+  buffer = StringIO()
+  generator(asset_map, Printer(buffer))
+  content = buffer.getvalue()
+  if not isinstance(content, bytes):
+    content = content.encode("utf-8")
+  digest = hashlib.sha1(content).hexdigest()
+  previous = cache["outputs"].get(path)
+  if (previous and previous[0] == digest and os.path.isfile(path) and
+      os.path.getmtime(path) == previous[1]):
+    return False
+  if not previous and os.path.isfile(path):
+    with open(path, "rb") as existing:
+      if existing.read() == content:
+        cache["outputs"][path] = [digest, os.path.getmtime(path)]
+        return False
+  with open(path, "wb") as output:
+    output.write(content)
+  cache["outputs"][path] = [digest, None]
+  return True
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Generates asset reference code from assets.json.")
+  parser.add_argument("--full", action = "store_true",
+                      help = "Rescan every directory and rewrite every output")
+  args = parser.parse_args(argv)
+
+  if not os.path.isfile(env.asset_config_path):
+    print("Error: assets.json not found!")
+    sys.exit(1)
+
+  with open(env.asset_config_path, "r") as config_file:
+    asset_config = json.load(config_file)
+
+  # Caches the file listing of each configured directory, keyed on the mtimes
+  # of the directories scanned, and a digest of each output file as generated.
+  cache_path = os.path.join(env.cache_root, "asset_references.json")
+  cache = {"scans": {}, "outputs": {}}
+  if os.path.isfile(cache_path) and not args.full:
+    with open(cache_path) as cache_file:
+      cache = json.load(cache_file)
+
+  all_asset_names.clear()
+  resource_paths.clear()
+  mirrored_assets.clear()
+  asset_map = collections.defaultdict(set)
+  for config in asset_config["dirs"]:
+    add_assets_for_directory(env, cache, asset_map, config,
+                             asset_config["types"])
+
+  output_path = os.path.join(env.assets_dir_path, "Source", "Assets")
+  clj_path = os.path.join(env.driver_root, "src", "dungeonstrike", "generated",
+                          "assets.clj")
+  outputs = [
+    (generate_asset_loader, os.path.join(output_path, "AssetUtil.cs")),
+    (generate_refs, os.path.join(output_path, "AssetRefs.cs")),
+    (generate_linker, os.path.join(output_path, "Editor", "AssetLinker.cs")),
+    (generate_assets_clj, clj_path),
+  ]
+  written = [path for (generator, path) in outputs
+             if write_if_changed(cache, asset_map, generator, path)]
+  mirror_changes = update_lazy_mirror(env, mirrored_assets)
+  if mirror_changes:
+    print("Updated " + str(mirror_changes) + " file(s) in " +
+          os.path.join("Assets", LAZY_MIRROR))
+
+  # The Clojure output is reformatted after it is written, so the mtime recorded
+  # for it must be taken afterwards.
+  if clj_path in written:
+    env.lein(["cljfmt", "fix"])
+
+  for path in written:
+    cache["outputs"][path][1] = os.path.getmtime(path)
+    print("Updated " + os.path.relpath(path, env.project_root))
+  if not written:
+    print("Asset references are up to date.")
+
+  lib.mkdirs(env.cache_root)
+  with open(cache_path, "w") as cache_file:
+    json.dump(cache, cache_file)
+
+if __name__ == "__main__":
+  main(lib.init())
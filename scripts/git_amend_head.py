@@ -2,27 +2,37 @@
 import sys
 import re
 import lib
-env = lib.init()
-env.check_assets_version()
 
-branch = lib.output(["git", "branch"]).rstrip()
-all_args = sys.argv[1:]
+def main(env, argv = None):
+  env.check_assets_version()
+  branch = lib.output(["git", "branch"]).rstrip()
+  all_args = list(argv or [])
 
-if branch != "* master":
-  print("Not on master, aborting.")
-  lib.call(["git", "commit", "-a", "--amend"] + all_args)
-  exit()
+  if branch != "* master":
+    print("Not on master, aborting.")
+    lib.call(["git", "commit", "-a", "--amend"] + all_args)
+    return 0
 
-lib.call([env.script("presubmit.py")])
+  # The changes already in the commit being amended need testing too, so
+  # integration tests are selected against its parent.
+  parents = lib.output(["git", "log", "-1", "--pretty=%P"]).split()
+  presubmit_args = (["--base", "HEAD~1"] if parents
+                    else ["--all-integration-tests"])
+  if lib.run_script(env, env.script("presubmit.py"), presubmit_args) != 0:
+    return 1
 
-time = lib.output(["date", "+%Y-%m-%d %H:%M"])
-key = lib.output(["md5", "-q", "-s", time]).rstrip()
-previous_message = lib.output(["git", "log", "-1", "--pretty=%B"]).rstrip()
-without_key = re.sub(r"KEY:.*", "", previous_message).rstrip()
+  time = lib.output(["date", "+%Y-%m-%d %H:%M"])
+  key = lib.output(["md5", "-q", "-s", time]).rstrip()
+  previous_message = lib.output(["git", "log", "-1", "--pretty=%B"]).rstrip()
+  without_key = re.sub(r"KEY:.*", "", previous_message).rstrip()
 
-print("Creating commit...")
-lib.call(
-  ["git", "commit"] +
-  all_args +
-  ["-a", "--amend", "-m", without_key, "-m", "KEY: " + key]
-)
+  print("Creating commit...")
+  lib.call(
+    ["git", "commit"] +
+    all_args +
+    ["-a", "--amend", "-m", without_key, "-m", "KEY: " + key]
+  )
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(lib.init(), sys.argv[1:]))
@@ -1,21 +1,26 @@
 #!/usr/bin/env python2.7
 import sys
 import lib
-env = lib.init()
-env.check_assets_version()
 
-branch = lib.output(["git", "branch"]).rstrip()
-all_args = sys.argv[1:]
+def main(env, argv = None):
+  env.check_assets_version()
+  branch = lib.output(["git", "branch"]).rstrip()
+  all_args = list(argv or [])
 
-if branch != "* master":
-  print("Not on master, aborting.")
-  lib.call(["git", "commit"] + all_args)
-  exit()
+  if branch != "* master":
+    print("Not on master, aborting.")
+    lib.call(["git", "commit"] + all_args)
+    return 0
 
-lib.call([env.script("presubmit.py")])
+  if lib.run_script(env, env.script("presubmit.py")) != 0:
+    return 1
 
-time = lib.output(["date", "+%Y-%m-%d %H:%M"])
-key = lib.output(["md5", "-q", "-s", time])
+  time = lib.output(["date", "+%Y-%m-%d %H:%M"])
+  key = lib.output(["md5", "-q", "-s", time])
 
-print("Creating commit...")
-lib.call(["git", "commit"] + all_args + ["-m", "KEY: " + key])
+  print("Creating commit...")
+  lib.call(["git", "commit"] + all_args + ["-m", "KEY: " + key])
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(lib.init(), sys.argv[1:]))
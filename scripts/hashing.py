@@ -0,0 +1,184 @@
+"""In-process, multi-core file hashing. Reads and writes the .svf checksum
+   files in the checksums directory in the same format as 'cfv -C -rr'."""
+
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import time
+import zlib
+
+BUFFER_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 16 * 1024 * 1024
+SVF_HEADER = "; \n;\n"
+
+def _blocks(input_file, size):
+  """Yields the contents of 'input_file' in large blocks, memory-mapping the
+  file if it is large."""
+  if size >= MMAP_THRESHOLD:
+    mapped = mmap.mmap(input_file.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+      for offset in range(0, size, BUFFER_SIZE * 8):
+        yield mapped[offset:offset + BUFFER_SIZE * 8]
+    finally:
+      mapped.close()
+  else:
+    for block in iter(lambda: input_file.read(BUFFER_SIZE), b""):
+      yield block
+
+def hash_file(path, algorithm = "crc32"):
+  """Returns the hex digest of the file at 'path'. 'algorithm' is either
+  'crc32' or the name of a hashlib algorithm such as 'md5'."""
+  with open(path, "rb") as input_file:
+    size = os.fstat(input_file.fileno()).st_size
+    if algorithm == "crc32":
+      crc = 0
+      for block in _blocks(input_file, size):
+        crc = zlib.crc32(block, crc)
+      return "%08x" % (crc & 0xffffffff)
+    digest = hashlib.new(algorithm)
+    for block in _blocks(input_file, size):
+      digest.update(block)
+    return digest.hexdigest()
+
+def _hash_worker(job):
+  (path, algorithm) = job
+  return (path, hash_file(path, algorithm), os.path.getsize(path))
+
+def hash_files(paths, algorithm = "crc32", jobs = None, verbose = True):
+  """Hashes every file in 'paths' across a pool of 'jobs' processes (defaults
+  to the number of CPUs). Returns a dictionary from path to hex digest. If
+  'verbose' is set, prints the throughput achieved."""
+  paths = list(paths)
+  start = time.time()
+  total_bytes = 0
+  results = {}
+  work = [(path, algorithm) for path in paths]
+  if len(work) < 2 or jobs == 1:
+    hashed = map(_hash_worker, work)
+    pool = None
+  else:
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    hashed = pool.imap_unordered(_hash_worker, work, chunksize = 16)
+  try:
+    for (path, digest, size) in hashed:
+      results[path] = digest
+      total_bytes += size
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  if verbose and paths:
+    print_throughput(len(paths), total_bytes, time.time() - start)
+  return results
+
+def print_throughput(count, total_bytes, seconds):
+  """Prints the number of files and megabytes per second hashed."""
+  megabytes = total_bytes / (1024.0 * 1024.0)
+  rate = megabytes / seconds if seconds > 0 else 0
+  print("Hashed " + str(count) + " files (" + str(round(megabytes, 1)) +
+        " MB) in " + str(round(seconds, 2)) + "s, " + str(round(rate, 1)) +
+        " MB/s")
+
+def svf_sort_key(name):
+  """Sort key matching cfv's recursive ordering, where the contents of a
+  directory are listed at the position of the directory's name."""
+  return name.split("/")
+
+def list_files(root):
+  """Returns the paths of all files under 'root', relative to 'root', in .svf
+  order."""
+  names = []
+  for (dirpath, dirnames, filenames) in os.walk(root):
+    relative = os.path.relpath(dirpath, root)
+    for name in filenames:
+      names.append(name if relative == "." else
+                   os.path.join(relative, name).replace(os.sep, "/"))
+  return sorted(names, key = svf_sort_key)
+
+def parse_svf(lines):
+  """Returns a list of (relative path, crc) tuples from the lines of an .svf
+  file."""
+  entries = []
+  for line in lines:
+    line = line.rstrip("\r\n")
+    if not line or line.startswith(";"): continue
+    (name, crc) = line.rsplit(" ", 1)
+    entries.append((name, crc.lower()))
+  return entries
+
+def read_svf(path):
+  """Returns a list of (relative path, crc) tuples from an .svf file."""
+  with open(path) as svf:
+    return parse_svf(svf)
+
+def write_svf(path, entries):
+  """Writes a list of (relative path, crc) tuples to an .svf file."""
+  lines = [name + " " + crc + "\n"
+           for (name, crc) in sorted(entries,
+                                     key = lambda e: svf_sort_key(e[0]))]
+  with open(path, "w") as svf:
+    svf.write(SVF_HEADER + "".join(lines))
+
+def checksum_directory(root, jobs = None):
+  """Computes (relative path, crc) entries for every file under 'root'."""
+  names = list_files(root)
+  crcs = hash_files([os.path.join(root, name) for name in names], jobs = jobs)
+  return [(name, crcs[os.path.join(root, name)]) for name in names]
+
+def stat_key(stat):
+  """Returns the (size, mtime_ns, inode) tuple used to detect changed files."""
+  mtime_ns = getattr(stat, "st_mtime_ns", None)
+  if mtime_ns is None:
+    mtime_ns = int(stat.st_mtime * 1e9)
+  return [stat.st_size, mtime_ns, stat.st_ino]
+
+def load_index(path, full = False):
+  """Loads a stat index written by 'verify_directory'. Returns an empty index
+  if 'full' is set."""
+  if full or not os.path.isfile(path):
+    return {}
+  try:
+    with open(path) as index_file:
+      return json.load(index_file)
+  except ValueError:
+    return {}
+
+def verify_directory(path, checksum_file, index_file, full = False,
+                     jobs = None):
+  """Verifies every file listed in 'checksum_file' relative to 'path', keeping
+  a stat index of verified files in 'index_file'. Only files whose (size,
+  mtime_ns, inode) changed since they were last verified are rehashed, in
+  parallel, unless 'full' is set. Returns a tuple of (list of error messages,
+  number of files rehashed)."""
+  index = load_index(index_file, full)
+  entries = []
+  errors = []
+  for (name, expected) in read_svf(checksum_file):
+    try:
+      key = stat_key(os.stat(os.path.join(path, name)))
+    except OSError:
+      errors.append(name + " is missing")
+      continue
+    cached = index.get(name)
+    actual = cached[3] if cached and cached[:3] == key else None
+    entries.append((name, expected, key, actual))
+
+  stale = [os.path.join(path, name)
+           for (name, expected, key, actual) in entries if actual is None]
+  crcs = hash_files(stale, jobs = jobs, verbose = len(stale) > 100)
+
+  updated = {}
+  for (name, expected, key, actual) in entries:
+    if actual is None:
+      actual = crcs[os.path.join(path, name)]
+    if actual == expected:
+      updated[name] = key + [actual]
+    else:
+      errors.append(name + " has crc " + actual + ", expected " + expected)
+  tmp = index_file + ".tmp"
+  with open(tmp, "w") as output:
+    json.dump(updated, output)
+  os.rename(tmp, index_file)
+  return (errors, len(stale))
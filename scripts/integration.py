@@ -0,0 +1,449 @@
+"""Runs recording-based integration tests across a pool of Unity clients. Each
+   client runs from its own copy of the client application, so that it gets
+   its own Logs directory, and talks to its own driver on a port allocated at
+   runtime. Tests which share a :prerequisite chain run in sequence on the
+   same client, so that the shared recordings (usually a scene load) are only
+   played once.
+
+   Recordings are also indexed by the code they exercise, so that only the
+   tests affected by a change need to be run."""
+
+import atexit
+import collections
+import itertools
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import lib
+import nrepl
+import staging
+
+CLIENT_EXIT_TIMEOUT = 10
+
+# A driver which writes no output for this many seconds is assumed to be hung.
+# Verbose drivers report every recording they play, and no recording takes
+# this long.
+DRIVER_IDLE_TIMEOUT = 300
+
+# The file holding the values named by the :message->client keys of
+# recordings, relative to the project root.
+TEST_VALUES_PATH = "driver/src/dungeonstrike/test_message_values.clj"
+
+# Paths, relative to the project root, of code and data used while running
+# integration tests. A change under one of these prefixes which can't be traced
+# to specific recordings selects every test.
+RUNTIME_PREFIXES = (
+  "driver/src/", "driver/project.clj", "effects/src/", "effects/project.clj",
+  "DungeonStrike/Assets/", "DungeonStrike/ProjectSettings/"
+)
+
+# Paths under RUNTIME_PREFIXES which are not used by the client or driver.
+IGNORED_PREFIXES = ("DungeonStrike/Assets/Tests/",)
+
+Recording = collections.namedtuple(
+  "Recording", ["file", "name", "prerequisite", "message", "sources"])
+
+_NAME_PATTERN = re.compile(r'^\{:name "([^"]*)"', re.MULTILINE)
+_PREREQUISITE_PATTERN = re.compile(r'^ :prerequisite (?:nil|"([^"]*)")',
+                                   re.MULTILINE)
+_MESSAGE_PATTERN = re.compile(r'^ :message->client :test-values/([\w-]+)',
+                              re.MULTILINE)
+_SOURCE_PATTERN = re.compile(r':source "([^"]*)"')
+_DEF_PATTERN = re.compile(r'^\(def ([\w-]+)')
+_SUCCESS_PATTERN = re.compile(r"^SUCCESS: '(.*)' \[(\d+)s\]$", re.MULTILINE)
+_HUNK_PATTERN = re.compile(r'^@@ -\S+ \+(\d+)(?:,(\d+))? @@')
+
+_processes = set()
+_processes_lock = threading.Lock()
+_print_lock = threading.Lock()
+
+def load_recordings(tests_root):
+  """Returns a dictionary from file name (e.g. 'create-deck.edn') to Recording
+  for every recording in the tests directory."""
+  recordings_root = os.path.join(tests_root, "recordings")
+  result = {}
+  for name in sorted(os.listdir(recordings_root)):
+    if not name.endswith(".edn"): continue
+    with open(os.path.join(recordings_root, name)) as recording_file:
+      contents = recording_file.read()
+    name_match = _NAME_PATTERN.search(contents)
+    prerequisite_match = _PREREQUISITE_PATTERN.search(contents)
+    message_match = _MESSAGE_PATTERN.search(contents)
+    result[name] = Recording(
+      name,
+      name_match.group(1) if name_match else os.path.splitext(name)[0],
+      prerequisite_match.group(1) if prerequisite_match else None,
+      message_match.group(1) if message_match else None,
+      frozenset(_SOURCE_PATTERN.findall(contents)))
+  return result
+
+def top_level_tests(recordings):
+  """Returns the files of the recordings which are not a prerequisite of any
+  other recording, matching the driver's definition of 'all'."""
+  prerequisites = set(r.prerequisite for r in recordings.values())
+  return sorted(name for name in recordings if name not in prerequisites)
+
+def prerequisite_chain(recordings, test):
+  """Returns the files of the recordings which run for 'test': its recursive
+  prerequisites, followed by 'test' itself."""
+  chain = []
+  while test:
+    if test not in recordings:
+      raise ValueError("Recording not found: " + test)
+    if test in chain:
+      raise ValueError("Prerequisite cycle in " + test)
+    chain.insert(0, test)
+    test = recordings[test].prerequisite
+  return chain
+
+def source_path(source):
+  """Returns the path, relative to the project root, of the file defining the
+  driver namespace or client class named in a log entry's :source."""
+  if source.startswith("DungeonStrike.Source."):
+    return ("DungeonStrike/Assets/Source/" +
+            "/".join(source.split(".")[2:]) + ".cs")
+  return "driver/src/" + source.replace("-", "_").replace(".", "/") + ".clj"
+
+def source_index(recordings):
+  """Returns a dictionary from the path of a source file to the set of
+  recordings which expect log entries from it."""
+  index = collections.defaultdict(set)
+  for recording in recordings.values():
+    for source in recording.sources:
+      index[source_path(source)].add(recording.file)
+  return index
+
+def changed_files(env, base = "HEAD"):
+  """Returns the paths, relative to the project root, of files which differ
+  from the commit 'base', including untracked files."""
+  git = ["git", "-C", env.project_root]
+  output = (lib.output(git + ["diff", "--name-only", base]) +
+            lib.output(git + ["ls-files", "--others", "--exclude-standard"]))
+  return sorted(set(line for line in output.splitlines() if line))
+
+def changed_test_values(env, base = "HEAD"):
+  """Returns the names of the top-level definitions in TEST_VALUES_PATH which
+  differ from the commit 'base'."""
+  path = os.path.join(env.project_root, TEST_VALUES_PATH)
+  if not os.path.isfile(path):
+    return set()
+  definitions = []
+  with open(path) as values_file:
+    for (number, line) in enumerate(values_file, 1):
+      match = _DEF_PATTERN.match(line)
+      if match:
+        definitions.append((number, match.group(1)))
+  diff = lib.output(["git", "-C", env.project_root, "diff", "-U0", base, "--",
+                     TEST_VALUES_PATH])
+  result = set()
+  for line in diff.splitlines():
+    match = _HUNK_PATTERN.match(line)
+    if not match: continue
+    first = int(match.group(1))
+    count = int(match.group(2) or 1)
+    for number in range(first, first + max(count, 1)):
+      names = [name for (start, name) in definitions if start <= number]
+      result.add(names[-1] if names else None)
+  return result
+
+def affected_by(recordings, index, path, test_values):
+  """Returns the set of recordings directly affected by a change to 'path', or
+  None if the change could affect any recording. 'test_values' is the set of
+  changed definitions in TEST_VALUES_PATH."""
+  if path.endswith(".meta"):
+    path = path[:-len(".meta")]
+  if path.startswith("tests/recordings/"):
+    name = os.path.basename(path)
+    return set([name]) if name in recordings else set()
+  if path == TEST_VALUES_PATH:
+    messages = dict((r.message, r.file) for r in recordings.values()
+                    if r.message)
+    if any(name not in messages for name in test_values):
+      return None
+    return set(messages[name] for name in test_values)
+  if path in index:
+    return set(index[path])
+  if (path.startswith(RUNTIME_PREFIXES) and
+      not path.startswith(IGNORED_PREFIXES)):
+    return None
+  return set()
+
+def changed_tests(env, recordings, base = "HEAD"):
+  """Returns the recordings which need to run to test the changes since the
+  commit 'base': every recording which exercises changed code or data, or has
+  such a recording in its prerequisite chain. Recordings which are replayed as
+  the prerequisite of another selected recording are omitted."""
+  index = source_index(recordings)
+  paths = changed_files(env, base)
+  test_values = (changed_test_values(env, base)
+                 if TEST_VALUES_PATH in paths else set())
+  affected = set()
+  for path in paths:
+    tests = affected_by(recordings, index, path, test_values)
+    if tests is None:
+      print("Change to " + path + " may affect any test.")
+      return top_level_tests(recordings)
+    if tests:
+      print("Change to " + path + " affects " + ", ".join(sorted(tests)))
+    affected |= tests
+  selected = set(test for test in recordings
+                 if affected & set(prerequisite_chain(recordings, test)))
+  prerequisites = set(recordings[test].prerequisite for test in selected)
+  return sorted(selected - prerequisites)
+
+def _start(args, **kwargs):
+  """Starts 'args' under a lib.Process in its own process group and records it
+  so that it is killed if this script exits."""
+  process = lib.Process(args, **kwargs)
+  with _processes_lock:
+    _processes.add(process)
+  return process
+
+def _kill(process, timeout = 0):
+  """Waits up to 'timeout' seconds for 'process' to exit, then kills its
+  process group."""
+  process.stop(timeout)
+  with _processes_lock:
+    _processes.discard(process)
+
+def kill_all():
+  """Kills every client and driver which is still running."""
+  with _processes_lock:
+    processes = list(_processes)
+  for process in processes:
+    _kill(process)
+
+atexit.register(kill_all)
+
+class Slot(object):
+  """A private copy of the client application and driver log directory,
+  used by one client at a time."""
+
+  def __init__(self, env, root, index):
+    self.env = env
+    self.root = os.path.join(root, str(index))
+    self.client_path = os.path.join(self.root,
+                                    os.path.basename(env.client_binary_path))
+    self.driver_path = os.path.join(self.root, "driver")
+
+  def prepare(self):
+    """Brings the copy of the client up to date with the latest build. The
+    application bundle is hardlinked, since clients never modify it."""
+    staging.sync(self.env.client_binary_path, self.client_path,
+                 link_prefixes = ("Contents",), exclude = ("Logs",))
+
+  def client_log_path(self):
+    return os.path.join(self.client_path, "Logs", "client_logs.txt")
+
+  def driver_log_path(self):
+    return os.path.join(self.driver_path, "logs", "driver_logs.txt")
+
+  def reset_logs(self):
+    for path in [self.client_log_path(), self.driver_log_path()]:
+      lib.rm(path)
+      lib.mkdirs(os.path.dirname(path))
+
+  def run(self, tests, log_dir):
+    """Runs 'tests' in order in a new client and driver on a free port, with
+    each shared prerequisite played once, and copies the logs to 'log_dir'.
+    Returns a dictionary from the name of each recording which passed to its
+    duration in seconds."""
+    self.reset_logs()
+    if os.path.exists(log_dir):
+      shutil.rmtree(log_dir)
+    lib.mkdirs(log_dir)
+    port = str(nrepl.free_port())
+    driver_output = os.path.join(log_dir, "driver_output.txt")
+    with lib.span(",".join(tests), "integration", port = port):
+      with open(os.path.join(log_dir, "client_output.txt"), "w") as output:
+        client = _start([os.path.join(self.client_path, "Contents", "MacOS",
+                                      "dungeonstrike"),
+                         "-batchmode", "--port", port],
+                        stdout = output, stderr = subprocess.STDOUT)
+      driver = None
+      try:
+        with open(driver_output, "w") as output:
+          # Verbose output reports each recording which passed.
+          driver = _start([
+            "java",
+            "-jar", os.path.join(self.env.driver_jar_path, "driver.jar"),
+            "--crash-on-exceptions",
+            "--port", port,
+            "--client-path", self.client_path,
+            "--driver-path", self.driver_path,
+            "--tests-path", self.env.tests_root,
+            "--test", ",".join(tests),
+            "--verbose"
+          ], stdout = output, stderr = subprocess.STDOUT,
+                          idle_timeout = DRIVER_IDLE_TIMEOUT,
+                          activity_paths = [self.driver_log_path()])
+          driver.wait()
+      finally:
+        if driver:
+          _kill(driver)
+        # The driver's shutdown recording asks the client to quit.
+        _kill(client, CLIENT_EXIT_TIMEOUT)
+    for path in [self.client_log_path(), self.driver_log_path()]:
+      if os.path.isfile(path):
+        shutil.copy(path, log_dir)
+    with open(driver_output) as output:
+      return dict((name, int(seconds)) for (name, seconds)
+                  in _SUCCESS_PATTERN.findall(output.read()))
+
+def batch_sequence(recordings, tests):
+  """Returns the recordings played when 'tests' run on a single client, in
+  order. Matches the order used by the driver for a comma-separated --test."""
+  sequence = []
+  for test in tests:
+    for name in prerequisite_chain(recordings, test):
+      if name not in sequence:
+        sequence.append(name)
+  return sequence
+
+def make_batches(recordings, tests, jobs):
+  """Groups 'tests' into batches which share the first recording in their
+  prerequisite chains (typically a scene load), so that it is played once per
+  batch. The largest batches are split until there is a batch for each of
+  'jobs' clients. Returns the batches with the longest first."""
+  groups = collections.OrderedDict()
+  for test in sorted(tests, key = lambda t: prerequisite_chain(recordings, t)):
+    root = prerequisite_chain(recordings, test)[0]
+    groups.setdefault(root, []).append(test)
+  batches = list(groups.values())
+  while len(batches) < jobs:
+    largest = max(batches, key = len)
+    if len(largest) < 2: break
+    batches.remove(largest)
+    middle = len(largest) // 2
+    batches += [largest[:middle], largest[middle:]]
+  return sorted(batches, key = lambda b: -len(batch_sequence(recordings, b)))
+
+def run_tests(env, tests, jobs, verbose = False, isolated = False):
+  """Runs the recordings named in 'tests' across 'jobs' clients. Tests which
+  share prerequisites run in sequence on the same client unless 'isolated' is
+  set. When a test fails after other tests ran on its client, it is rerun on
+  its own; if it then passes, it is reported as 'leaked', since an earlier
+  test left behind state which broke it. Returns a list of TaskResults in the
+  same order as 'tests', whose output is the directory containing the logs
+  of the failing run."""
+  recordings = load_recordings(env.tests_root)
+  chains = dict((test, prerequisite_chain(recordings, test))
+                for test in tests)
+  if isolated:
+    batches = sorted([[test] for test in tests],
+                     key = lambda b: -len(chains[b[0]]))
+  else:
+    batches = make_batches(recordings, tests, jobs)
+  # Each entry is a tuple of (tests, earlier), where 'earlier' is None, or for
+  # a test being rerun on its own, a tuple of (recordings which ran before it
+  # failed, log directory of the failing run).
+  queue = [(batch, None) for batch in batches]
+  results = {}
+  root = os.path.join(env.driver_jar_path, "integration")
+  results_root = os.path.join(root, "results")
+  if os.path.exists(results_root):
+    shutil.rmtree(results_root)
+  slots = [Slot(env, os.path.join(root, "slots"), i)
+           for i in range(max(1, min(jobs, len(batches))))]
+  lock = threading.Lock()
+  condition = threading.Condition(lock)
+  active = [0]
+  runs = itertools.count()
+
+  def record(test, status, seconds, log_dir):
+    results[test] = lib.TaskResult(test, status, seconds, log_dir)
+    with _print_lock:
+      print(status.upper() + " '" + test + "' " +
+            lib.format_duration(seconds))
+
+  def finish(batch, earlier, passed, log_dir, seconds):
+    sequence = batch_sequence(recordings, batch)
+    passed_files = set(name for name in sequence
+                       if recordings[name].name in passed)
+    failure = next((name for name in sequence if name not in passed_files),
+                   None)
+    failed = [test for test in batch if failure in chains[test]]
+    remaining = [test for test in batch
+                 if test not in failed and test not in passed_files]
+    for test in batch:
+      if test in passed_files:
+        if earlier:
+          record(test, "leaked", passed[recordings[test].name], earlier[1])
+          with _print_lock:
+            print("'" + test + "' passed on its own but failed after " +
+                  ", ".join(earlier[0]) + " ran on the same client. See " +
+                  earlier[1])
+        else:
+          record(test, "ok", passed[recordings[test].name], log_dir)
+    if failed and verbose:
+      with _print_lock:
+        with open(os.path.join(log_dir, "driver_output.txt")) as output:
+          print(output.read())
+    if remaining:
+      queue.append((remaining, None))
+    if not failed:
+      return
+    # Recordings played before the failure which the failing test doesn't
+    # need, and which could have left state behind.
+    before = [name for name in sequence[:sequence.index(failure)]
+              if name not in chains[failed[0]]]
+    if earlier or not before:
+      for test in failed:
+        record(test, "failed", seconds, log_dir)
+    else:
+      with _print_lock:
+        print("'" + failed[0] + "' failed after " + ", ".join(before) +
+              ", rerunning it on its own.")
+      queue.append(([failed[0]], (before, log_dir)))
+      if failed[1:]:
+        queue.append((failed[1:], None))
+
+  # Clients and drivers are attributed to the caller's step, if any.
+  step = lib.current_step()
+
+  def worker(slot):
+    with lib.in_step(step):
+      run_slot(slot)
+
+  def run_slot(slot):
+    slot.prepare()
+    while True:
+      with condition:
+        while not queue and active[0]:
+          condition.wait()
+        if not queue: return
+        (batch, earlier) = queue.pop(0)
+        active[0] += 1
+        log_dir = os.path.join(results_root, "%02d-%s" % (
+          next(runs), os.path.splitext(batch[0])[0]))
+      with _print_lock:
+        print("Running " +
+              " -> ".join(batch_sequence(recordings, batch)))
+      start = time.time()
+      try:
+        passed = slot.run(batch, log_dir)
+      except Exception as e:
+        with _print_lock:
+          print("Error running " + ", ".join(batch) + ": " + str(e))
+        passed = {}
+      with condition:
+        finish(batch, earlier, passed, log_dir, time.time() - start)
+        active[0] -= 1
+        condition.notify_all()
+
+  threads = [threading.Thread(target = worker, args = (slot,))
+             for slot in slots]
+  try:
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(1)
+  finally:
+    kill_all()
+  return [results.get(test, lib.TaskResult(test, "skipped", 0, None))
+          for test in tests]
@@ -2,17 +2,34 @@
    directory. You must ensure that 'env = lib.init()' is the first line of every
    script."""
 
+import atexit
 import collections
+import contextlib
+import errno
+import hashlib
 import json
+import multiprocessing
+import nrepl
 import os
 import os.path
 import shutil
+import signal
+import sqlite3
 import subprocess
-import re
+import sys
+import tempfile
+import threading
+import time
+import types
+
+# Seconds after which a batchmode Unity run which has stopped writing to its
+# log is assumed to be hung. Importing a fresh project can take several
+# minutes between log lines.
+UNITY_IDLE_TIMEOUT = 900
 
 EXPECTED_PROGRAMS = [
-  "rsync", "pv", "find", "wc", "lein", "cfv", "git", "md5deep",
-  "java", "touch", "python", "7z", "md5"
+  "rsync", "pv", "find", "wc", "lein", "git", "java", "touch", "python", "7z",
+  "md5"
 ]
 
 class Env(object):
@@ -30,7 +47,15 @@ class Env(object):
       self.checksums_root = os.path.join(project_root, "checksums")
       self.unity_path = config["unity_path"]
       self.staging_path = config["staging_path"]
+      self.staging_workspaces = max(1, config.get("staging_workspaces", 2))
       self.third_party_path = config["third_party_path"]
+      self.cache_root = os.path.expanduser(
+        config.get("cache_path", "~/.cache/dungeonstrike"))
+      self.warm_lein = config.get("warm_lein", False)
+      self.artifact_cache_bytes = (
+        config.get("artifact_cache_mb", 4096) * 1024 * 1024)
+      self.blob_store_path = os.path.expanduser(
+        config.get("blob_store_path", os.path.join(self.cache_root, "blobs")))
       self.assets_dir_path = os.path.join(self.client_root, "Assets")
       self.asset_config_path = os.path.join(self.assets_dir_path, "assets.json")
 
@@ -39,74 +64,402 @@ class Env(object):
     one in ThirdParty."""
     with open(os.path.join(self.client_root, "assets_version.md5")) as assets:
       self.assets_version = assets.readline().strip()
-    if not os.path.isfile(os.path.join(self.third_party_path,
-                                       self.assets_version + ".zip")):
+    archive = os.path.join(self.third_party_path, self.assets_version)
+    if not (os.path.isdir(archive) or os.path.isfile(archive + ".zip")):
       print("Error: ThirdParty directory does not match current assets " +
             "version '" + self.assets_version + "'")
       print("ThirdParty assets may need to be updated.")
-      exit(1)
-
-  def lein(self, args, allow_failure = False):
-    """Runs a lein command by changing to the correct directory and invoking
-    lein with the provided 'args'."""
-    cwd = os.getcwd()
-    os.chdir(self.driver_root)
-    if allow_failure:
-      result = subprocess.call(["lein"] + args)
-      os.chdir(cwd)
-      return result
-    else:
-      call(["lein"] + args)
-      os.chdir(cwd)
+      sys.exit(1)
+
+  def lein(self, args, allow_failure = False, project_root = None):
+    """Runs a lein command in 'project_root' (the driver by default) with the
+    provided 'args'. If a warm REPL server is running for the project (see
+    'repl_server.py'), supported commands are evaluated there instead of
+    starting a new JVM. Setting 'warm_lein' in environment.json starts a
+    server on demand."""
+    project_root = project_root or self.driver_root
+    result = nrepl.run_lein(self, project_root, args)
+    if result is None:
+      result = call_unchecked(["lein"] + args, cwd = project_root)
+    if result != 0 and not allow_failure:
+      sys.exit(result)
+    return result
 
   def script(self, name):
     return os.path.join(self.scripts_root, name)
 
-  def unity(self, args):
-    """Invokes Unity with the provided arguments."""
-    result = subprocess.call([self.unity_path] + args)
-    if result != 0:
+  def unity_log_path(self, args):
+    """Returns the path of the Editor.log written by Unity when invoked with
+    'args'."""
+    if "-logFile" in args[:-1]:
+      return os.path.abspath(args[args.index("-logFile") + 1])
+    if sys.platform == "darwin":
+      return os.path.expanduser("~/Library/Logs/Unity/Editor.log")
+    return os.path.expanduser("~/.config/unity3d/Editor.log")
+
+  def unity(self, args, timeout = None, idle_timeout = None,
+            allow_failure = False):
+    """Invokes Unity with the provided arguments. Unity is idle while it
+    neither writes output nor appends to its log, and a batchmode run which is
+    idle for UNITY_IDLE_TIMEOUT seconds is killed. Batchmode runs log to the
+    project's Logs directory, so that runs in different staging workspaces
+    don't share an Editor.log."""
+    if "-batchmode" in args:
+      if idle_timeout is None:
+        idle_timeout = UNITY_IDLE_TIMEOUT
+      if "-logFile" not in args:
+        log_path = os.path.join(self.client_root, "Logs", "Editor.log")
+        mkdirs(os.path.dirname(log_path))
+        args = args + ["-logFile", log_path]
+    result = call_unchecked([self.unity_path] + args, timeout = timeout,
+                            idle_timeout = idle_timeout,
+                            activity_paths = [self.unity_log_path(args)])
+    if result != 0 and not allow_failure:
       print("Error invoking Unity. Code: " + str(result))
       print("""Things to try:
 1) Close Unity. Only one instance of Unity can have a project open (code 1).
-2) Check for compile errors in Editor.log (code 1)
+2) Check for compile errors in """ + self.unity_log_path(args) + """ (code 1)
 3) Check for unit test failures (code 2)""")
-      exit(result)
+      sys.exit(result)
     else:
       return result
 
 def call(args, failure_message = None):
   """Wrapper around subprocess.check_call"""
-  result = subprocess.call(args)
+  result = call_unchecked(args)
   if result != 0:
     if failure_message:
       print(failure_message)
-    exit(result)
+    sys.exit(result)
 
 def output(args):
   """Wrapper around subprocess.check_output"""
-  return subprocess.check_output(args)
+  with span(os.path.basename(args[0]), "subprocess", args = args):
+    return subprocess.check_output(args)
+
+def call_unchecked(args, timeout = None, idle_timeout = None,
+                   activity_paths = (), **kwargs):
+  """Runs 'args' under a supervised Process and returns its exit code. If the
+  calling thread's output is being captured by 'run_script', the subprocess's
+  output is captured too. Otherwise, unless an idle timeout applies, the
+  subprocess shares the terminal, so that interactive commands work."""
+  buffer = getattr(_capture, "buffer", None)
+  context = current_step()
+  idle = idle_timeout or (context and context.idle_timeout)
+  pipe = (buffer is not None or bool(idle)) and "stdout" not in kwargs
+  with span(os.path.basename(args[0]), "subprocess", args = args):
+    process = Process(args, timeout = timeout, idle_timeout = idle_timeout,
+                      activity_paths = activity_paths, output = buffer,
+                      pipe_output = pipe, new_group = pipe, **kwargs)
+    return process.wait()
+
+# The maximum resident set size reported by getrusage is in bytes on macOS and
+# in kilobytes on Linux. Block I/O is counted in 512 byte blocks.
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+BLOCK_SIZE = 512
+
+# The grace period between asking a process group to exit and killing it.
+KILL_GRACE_SECONDS = 5
+
+# The exit code recorded for a process whose exit status could not be read,
+# because something else reaped it.
+UNKNOWN_RETURNCODE = -1
+
+ProcessStats = collections.namedtuple(
+  "ProcessStats", ["step", "command", "returncode", "killed", "seconds",
+                   "cpu_seconds", "max_rss_bytes", "read_bytes",
+                   "write_bytes", "error"])
+
+# A step of a larger run, such as a presubmit step. See 'step'.
+Step = collections.namedtuple("Step", ["name", "deadline", "idle_timeout",
+                                       "killed"])
 
-def call_unchecked(args, **kwargs):
-  """Wrapper around subprocess.call"""
-  return subprocess.call(args, **kwargs)
+_step = threading.local()
+_processes = set()
+_process_stats = []
+_processes_lock = threading.Lock()
+
+def current_step():
+  """Returns the Step the calling thread is running, or None."""
+  return getattr(_step, "current", None)
+
+@contextlib.contextmanager
+def in_step(context):
+  """Attributes processes started by the calling thread to the Step 'context',
+  which may have been started by another thread."""
+  previous = current_step()
+  _step.current = context
+  try:
+    yield context
+  finally:
+    _step.current = previous
+
+@contextlib.contextmanager
+def step(name, timeout = None, idle_timeout = None):
+  """Runs a 'with' block as the step 'name'. Processes started during the
+  step are attributed to it in 'process_stats', are killed if the step takes
+  longer than 'timeout' seconds or one of them is idle for 'idle_timeout'
+  seconds, and are killed if they are still running when the step ends. The
+  reasons processes were killed are added to the Step's 'killed' list."""
+  context = Step(name, time.time() + timeout if timeout else None,
+                 idle_timeout, [])
+  with in_step(context):
+    try:
+      yield context
+    finally:
+      kill_processes(context)
+
+class Process(object):
+  """A supervised subprocess. If 'new_group' is set, the process runs in its
+  own process group, and the whole group is killed when the process exits or
+  times out, so that no descendants are left running. The process is killed
+  if it runs for more than 'timeout' seconds, if it is idle for more than
+  'idle_timeout' seconds, or if the current step's limits are exceeded. A
+  process is idle if it writes no output and none of the files in
+  'activity_paths' (or the file its output is redirected to) change.
+
+  If 'pipe_output' is set, output is appended to the list 'output' or, if
+  that is None, written to sys.stdout. Resource use is recorded when the
+  process is reaped; see 'process_stats'."""
+  def __init__(self, args, timeout = None, idle_timeout = None,
+               activity_paths = (), output = None, pipe_output = False,
+               new_group = True, **kwargs):
+    self.args = args
+    self.step = current_step()
+    self.started = time.time()
+    deadlines = [self.started + timeout if timeout else None,
+                 self.step and self.step.deadline]
+    deadlines = [deadline for deadline in deadlines if deadline]
+    self.deadline = min(deadlines) if deadlines else None
+    self.idle_timeout = idle_timeout or (self.step and self.step.idle_timeout)
+    self.activity_paths = list(activity_paths)
+    stdout = kwargs.get("stdout")
+    if hasattr(stdout, "name") and os.path.isfile(stdout.name):
+      self.activity_paths.append(stdout.name)
+    self.activity = dict((path, self._stamp(path))
+                         for path in self.activity_paths)
+    self.last_activity = self.started
+    self.new_group = new_group
+    self.returncode = None
+    self.killed = None
+    if pipe_output:
+      kwargs["stdout"] = subprocess.PIPE
+      kwargs["stderr"] = subprocess.STDOUT
+    if new_group:
+      kwargs["preexec_fn"] = os.setsid
+    self.popen = subprocess.Popen(args, **kwargs)
+    self.pid = self.popen.pid
+    with _processes_lock:
+      _processes.add(self)
+    self.reader = None
+    if pipe_output:
+      self.reader = threading.Thread(target = self._read,
+                                     args = (self.popen.stdout, output))
+      self.reader.daemon = True
+      self.reader.start()
+
+  def _stamp(self, path):
+    try:
+      stat = os.stat(path)
+      return (stat.st_size, stat.st_mtime)
+    except OSError:
+      return None
+
+  def _read(self, stream, output):
+    for line in iter(stream.readline, b""):
+      self.last_activity = time.time()
+      text = line.decode("utf-8", "replace")
+      if output is not None:
+        output.append(text)
+      else:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    stream.close()
+
+  def _check_activity(self):
+    for path in self.activity_paths:
+      stamp = self._stamp(path)
+      if stamp != self.activity[path]:
+        self.activity[path] = stamp
+        self.last_activity = time.time()
+
+  def poll(self):
+    """Reaps the process if it has exited. Returns its exit code, or None if
+    it is still running."""
+    if self.returncode is None:
+      self._wait(os.WNOHANG)
+    return self.returncode
+
+  def _wait(self, options):
+    """Reaps the process with os.wait4. Returns False if it is still
+    running."""
+    try:
+      (pid, status, usage) = os.wait4(self.pid, options)
+    except OSError as e:
+      if e.errno != errno.ECHILD:
+        raise
+      # The process was reaped elsewhere, so whether it succeeded is unknown.
+      self._reaped(None, None, "exit status lost (reaped elsewhere)")
+      return True
+    if pid == 0:
+      return False
+    self._reaped(status, usage)
+    return True
+
+  def _reaped(self, status, usage, error = None):
+    if status is None:
+      self.returncode = UNKNOWN_RETURNCODE
+    elif os.WIFSIGNALED(status):
+      self.returncode = -os.WTERMSIG(status)
+    else:
+      self.returncode = os.WEXITSTATUS(status)
+    self.popen.returncode = self.returncode
+    if self.new_group:
+      # Descendants which outlived the process are killed with it.
+      try:
+        os.killpg(self.pid, signal.SIGKILL)
+      except OSError:
+        pass
+    if self.reader:
+      self.reader.join(KILL_GRACE_SECONDS)
+    with _processes_lock:
+      _processes.discard(self)
+      _process_stats.append(ProcessStats(
+        self.step and self.step.name, " ".join(self.args), self.returncode,
+        self.killed, time.time() - self.started,
+        usage and usage.ru_utime + usage.ru_stime,
+        usage and usage.ru_maxrss * RSS_UNIT,
+        usage and usage.ru_inblock * BLOCK_SIZE,
+        usage and usage.ru_oublock * BLOCK_SIZE, error))
+
+  def wait(self):
+    """Waits for the process to exit, killing it if it exceeds its limits.
+    Returns its exit code."""
+    while self.poll() is None:
+      now = time.time()
+      self._check_activity()
+      if self.deadline and now > self.deadline:
+        self.kill("timed out after " + format_duration(now - self.started))
+      elif (self.idle_timeout and
+            now - self.last_activity > self.idle_timeout):
+        self.kill("idle for " + format_duration(now - self.last_activity))
+      else:
+        time.sleep(0.1)
+    return self.returncode
+
+  def kill(self, reason = None, grace = KILL_GRACE_SECONDS):
+    """Asks the process (and its group) to exit, then kills it if it is
+    still running after 'grace' seconds. Returns its exit code."""
+    if self.poll() is not None:
+      return self.returncode
+    if reason:
+      self.killed = reason
+      name = os.path.basename(self.args[0])
+      if self.step:
+        self.step.killed.append(name + " " + reason)
+      else:
+        print("Killing " + name + ": " + reason)
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+      try:
+        if self.new_group:
+          os.killpg(self.pid, sig)
+        else:
+          os.kill(self.pid, sig)
+      except OSError:
+        pass
+      deadline = time.time() + grace
+      while self.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+      if self.returncode is not None:
+        break
+    if self.returncode is None:
+      self._wait(0)
+    return self.returncode
+
+  def stop(self, timeout = 0):
+    """Waits up to 'timeout' seconds for the process to exit on its own, then
+    kills it. Returns its exit code."""
+    deadline = time.time() + timeout
+    while self.poll() is None and time.time() < deadline:
+      time.sleep(0.1)
+    return self.kill()
+
+def kill_processes(context = None):
+  """Kills every supervised process still running, or only those started
+  during the Step 'context'."""
+  with _processes_lock:
+    processes = [process for process in _processes
+                 if context is None or process.step is context]
+  for process in processes:
+    process.kill(grace = 1)
+
+atexit.register(kill_processes)
+
+def process_stats(name = None):
+  """Returns the ProcessStats of every supervised process which has exited,
+  or only of those started during the step 'name'."""
+  with _processes_lock:
+    return [stats for stats in _process_stats
+            if name is None or stats.step == name]
+
+def format_bytes(count):
+  """Formats a number of bytes for display."""
+  if count is None:
+    return "?"
+  for unit in ["B", "KB", "MB"]:
+    if count < 1024:
+      return str(int(count)) + unit
+    count /= 1024.0
+  return str(round(count, 1)) + "GB"
+
+def print_process_table(stats):
+  """Prints the resource use of the processes in the list of ProcessStats
+  'stats', grouped by step."""
+  if not stats:
+    return
+  rows = [(stats.step or "-", os.path.basename(stats.command.split(" ")[0]),
+           format_duration(stats.seconds),
+           "?" if stats.cpu_seconds is None
+           else format_duration(stats.cpu_seconds),
+           format_bytes(stats.max_rss_bytes), format_bytes(stats.read_bytes),
+           format_bytes(stats.write_bytes),
+           stats.error or stats.killed or str(stats.returncode))
+          for stats in sorted(stats, key = lambda s: (s.step or "", s.seconds))]
+  headers = ("Step", "Process", "Time", "CPU", "Peak RSS", "Read", "Written",
+             "Exit")
+  widths = [max(len(row[i]) for row in rows + [headers])
+            for i in range(len(headers))]
+  print("")
+  for row in [headers] + rows:
+    print("  ".join(value.ljust(width)
+                    for (value, width) in zip(row, widths)).rstrip())
+
+def _is_exe(fpath):
+  return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+# Locations of programs found by 'which', keyed by (PATH, program).
+_which_memo = {}
 
 def which(program):
   """Returns the location of a program on the PATH if it can be found, or None
   if it does not exist."""
-  def is_exe(fpath):
-    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
   fpath, fname = os.path.split(program)
   if fpath:
-    if is_exe(program):
+    if _is_exe(program):
       return program
-  else:
-    for path in os.environ["PATH"].split(os.pathsep):
-      path = path.strip('"')
-      exe_file = os.path.join(path, program)
-      if is_exe(exe_file):
-        return exe_file
-  return None
+    return None
+  key = (os.environ["PATH"], program)
+  if key in _which_memo:
+    return _which_memo[key]
+  result = None
+  for path in os.environ["PATH"].split(os.pathsep):
+    path = path.strip('"')
+    exe_file = os.path.join(path, program)
+    if _is_exe(exe_file):
+      result = exe_file
+      break
+  _which_memo[key] = result
+  return result
 
 def mkdirs(path):
   """Creates the directory 'path' if needed."""
@@ -118,30 +471,34 @@ def rm(path):
   if os.path.exists(path):
     os.remove(path)
 
-def ban_regex(path, extension, regex):
-  """Bans a regex from appearing in files on the given path with the given file
-  extension."""
-  for (dirpath, dirname, filenames) in os.walk(path):
-    for name in filenames:
-      if name.endswith(extension) and not "Generated" in name:
-        path = os.path.join(dirpath, name)
-        with open(path, 'r') as source_file:
-          line_number = 0
-          prev_line = None
-          for line in source_file.readlines():
-            line_number += 1
-            if re.search(regex, line) and not "AllowBannedRegex:" in prev_line:
-              print("Error: " + name + ":" + str(line_number) +
-                    " matches forbidden regex " + regex)
-              exit(1)
-            prev_line = line
-
-def verify_on_path(programs):
-  """Verifies that the provided programs can be found on the system path."""
+def verify_on_path(programs, memo_path = None):
+  """Verifies that the provided programs can be found on the system path. If
+  'memo_path' is provided, the locations found are recorded there for the
+  current PATH, and later calls only check that each recorded location is
+  still executable instead of searching the PATH again."""
+  memo = {}
+  if memo_path and os.path.isfile(memo_path):
+    try:
+      with open(memo_path) as memo_file:
+        memo = json.load(memo_file)
+    except ValueError:
+      memo = {}
+  found = memo.get(os.environ["PATH"], {})
+  if all(found.get(program) and _is_exe(found[program])
+         for program in programs):
+    return
+  found = {}
   for program in programs:
-    if not which(program):
+    found[program] = which(program)
+    if not found[program]:
       print("Program " + program + " not found on path. Please install.")
-      exit(1)
+      sys.exit(1)
+  if memo_path:
+    mkdirs(os.path.dirname(memo_path))
+    tmp = memo_path + ".tmp"
+    with open(tmp, "w") as memo_file:
+      json.dump({os.environ["PATH"]: found}, memo_file)
+    os.rename(tmp, memo_path)
 
 def yesno(prompt):
   """Prompts the user to enter y or n in response to a question. Returns True
@@ -184,7 +541,7 @@ def prompt_to_create_environment_file(env_path):
   script path information in it."""
   response = yesno("No environment.json file found. Create one now? (y/n)")
   if not response:
-    exit(0)
+    sys.exit(0)
   with open(env_path, "w") as env_file:
     unity_path = input_prompt(
       "What is the path to your Unity binary?",
@@ -222,17 +579,236 @@ def init():
   project_root = os.path.abspath(os.path.join(scripts_root, os.pardir))
   env_path = os.path.join(project_root, "environment.json")
 
-  verify_on_path(EXPECTED_PROGRAMS)
-
   commit_hook = os.path.join(project_root, ".git", "hooks", "commit-msg")
   if not os.path.isfile(commit_hook):
     shutil.copy(os.path.join(scripts_root, "commit-msg.git"), commit_hook)
 
   if not os.path.isfile(env_path):
     prompt_to_create_environment_file(env_path)
+  trace_script()
   with open(env_path) as env_file:
     config = json.load(env_file)
-    return Env(config, scripts_root, project_root)
+  env = Env(config, scripts_root, project_root)
+  # Subprocesses are killed on exit, including when the script is terminated.
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+  verify_on_path(EXPECTED_PROGRAMS,
+                 os.path.join(env.cache_root, "programs.json"))
+  return env
+
+_capture = threading.local()
+# Number of running 'run_script' calls capturing output, which keep
+# sys.stdout and sys.stderr replaced by _CapturedOutput until the last ends.
+_captures = [0]
+_captures_lock = threading.Lock()
+
+class _CapturedOutput(object):
+  """Stands in for sys.stdout and sys.stderr while scripts run in-process.
+  Writes from a thread whose output is being captured go to that thread's
+  buffer, and all other writes go to the original stream."""
+  def __init__(self, stream):
+    self.stream = stream
+
+  def write(self, text):
+    buffer = getattr(_capture, "buffer", None)
+    if buffer is None:
+      self.stream.write(text)
+    else:
+      if isinstance(text, bytes):
+        text = text.decode("utf-8", "replace")
+      buffer.append(text)
+
+  def flush(self):
+    if getattr(_capture, "buffer", None) is None:
+      self.stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+def _start_capture():
+  with _captures_lock:
+    if _captures[0] == 0:
+      sys.stdout = _CapturedOutput(sys.stdout)
+      sys.stderr = _CapturedOutput(sys.stderr)
+    _captures[0] += 1
+  _capture.buffer = []
+
+def _finish_capture():
+  _capture.buffer = None
+  with _captures_lock:
+    _captures[0] -= 1
+    if _captures[0] == 0 and isinstance(sys.stdout, _CapturedOutput):
+      sys.stdout = sys.stdout.stream
+      sys.stderr = sys.stderr.stream
+
+def _load_script(path):
+  """Executes the script at 'path' as a new module, so that every run starts
+  from fresh module globals. The module replaces any earlier one of the same
+  name in sys.modules, which lets functions defined in it be pickled."""
+  name = os.path.splitext(os.path.basename(path))[0]
+  with open(path) as script_file:
+    code = compile(script_file.read(), path, "exec")
+  module = types.ModuleType(name)
+  module.__file__ = path
+  sys.modules[name] = module
+  exec(code, module.__dict__)
+  return module
+
+def run_script(env, path, args = (), capture = False):
+  """Runs the script at 'path' in this process by calling its 'main' function
+  with the shared 'env' and the command line arguments 'args', instead of
+  starting a new interpreter. Scripts finish by returning or by calling
+  sys.exit, never the builtin exit(), which closes sys.stdin. If 'capture' is
+  set, returns a tuple of (exit code, output written by the script and its
+  subprocesses); otherwise returns the exit code."""
+  path = os.path.abspath(path)
+  scripts_root = os.path.dirname(path)
+  if scripts_root not in sys.path:
+    sys.path.insert(0, scripts_root)
+  name = os.path.splitext(os.path.basename(path))[0]
+  if capture:
+    _start_capture()
+  try:
+    with span(name, "script", args = list(args)):
+      try:
+        code = _load_script(path).main(env, list(args))
+      except SystemExit as e:
+        code = e.code
+    if code is not None and not isinstance(code, int):
+      print(code)
+      code = 1
+    code = code or 0
+    if capture:
+      return (code, "".join(_capture.buffer))
+    return code
+  finally:
+    if capture:
+      _finish_capture()
+
+TRACE_VARIABLE = "DUNGEONSTRIKE_TRACE"
+_trace_lock = threading.Lock()
+
+def _trace_event(event):
+  """Appends a Chrome trace event to the current trace file, if tracing was
+  enabled by 'start_trace' in this process or a parent process."""
+  path = os.environ.get(TRACE_VARIABLE)
+  if not path:
+    return
+  event["pid"] = os.getpid()
+  event.setdefault("tid", threading.current_thread().ident)
+  line = json.dumps(event) + "\n"
+  with _trace_lock:
+    with open(path, "a") as trace_file:
+      trace_file.write(line)
+
+@contextlib.contextmanager
+def span(name, category = "span", **args):
+  """Records the time spent in a 'with' block as a trace span. Spans may be
+  nested."""
+  start = time.time()
+  try:
+    yield
+  finally:
+    _trace_event({"name": name, "cat": category, "ph": "X",
+                  "ts": int(start * 1e6),
+                  "dur": int((time.time() - start) * 1e6),
+                  "args": args})
+
+def trace_script():
+  """Records a span covering the rest of the current script's execution."""
+  if not os.environ.get(TRACE_VARIABLE):
+    return
+  name = os.path.basename(sys.argv[0])
+  start = time.time()
+  _trace_event({"name": "process_name", "ph": "M", "args": {"name": name}})
+  def finish():
+    _trace_event({"name": name, "cat": "script", "ph": "X",
+                  "ts": int(start * 1e6),
+                  "dur": int((time.time() - start) * 1e6),
+                  "tid": threading.current_thread().ident})
+  atexit.register(finish)
+
+def start_trace(env, name, keep = 50):
+  """Starts recording trace events for this process and every script it runs.
+  Only the most recent 'keep' traces are retained. Returns the path of the
+  trace events file."""
+  traces = os.path.join(env.cache_root, "traces")
+  mkdirs(traces)
+  for old in sorted(os.listdir(traces))[:-keep]:
+    rm(os.path.join(traces, old))
+  path = os.path.join(traces, name + "-" + time.strftime("%Y%m%d-%H%M%S") +
+                      ".events")
+  os.environ[TRACE_VARIABLE] = path
+  return path
+
+def finish_trace(path):
+  """Stops tracing and converts the events file at 'path' into a Chrome trace
+  (viewable in chrome://tracing). Returns the path of the trace."""
+  del os.environ[TRACE_VARIABLE]
+  events = []
+  if os.path.isfile(path):
+    with open(path) as events_file:
+      events = [json.loads(line) for line in events_file if line.strip()]
+    os.remove(path)
+  output_path = os.path.splitext(path)[0] + ".json"
+  with open(output_path, "w") as output_file:
+    json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, output_file)
+  return output_path
+
+def history_db(env):
+  """Returns a connection to the local SQLite database of historical timing
+  data, creating its tables if needed."""
+  mkdirs(env.cache_root)
+  connection = sqlite3.connect(os.path.join(env.cache_root, "history.db"))
+  connection.executescript("""
+    CREATE TABLE IF NOT EXISTS presubmit_runs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      started REAL NOT NULL,
+      seconds REAL NOT NULL,
+      success INTEGER NOT NULL,
+      revision TEXT,
+      trace_path TEXT
+    );
+    CREATE TABLE IF NOT EXISTS presubmit_steps (
+      run_id INTEGER NOT NULL REFERENCES presubmit_runs(id),
+      name TEXT NOT NULL,
+      status TEXT NOT NULL,
+      seconds REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS editor_test_runs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      started REAL NOT NULL,
+      seconds REAL NOT NULL,
+      shards INTEGER NOT NULL,
+      success INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS editor_test_results (
+      run_id INTEGER NOT NULL REFERENCES editor_test_runs(id),
+      name TEXT NOT NULL,
+      fixture TEXT NOT NULL,
+      status TEXT NOT NULL,
+      seconds REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS editor_test_results_run
+      ON editor_test_results(run_id);
+    CREATE TABLE IF NOT EXISTS presubmit_processes (
+      run_id INTEGER NOT NULL REFERENCES presubmit_runs(id),
+      step TEXT,
+      command TEXT NOT NULL,
+      returncode INTEGER,
+      killed TEXT,
+      seconds REAL NOT NULL,
+      cpu_seconds REAL,
+      max_rss_bytes INTEGER,
+      read_bytes INTEGER,
+      write_bytes INTEGER,
+      error TEXT
+    );
+  """)
+  columns = [row[1] for row in
+             connection.execute("PRAGMA table_info(presubmit_processes)")]
+  if "error" not in columns:
+    connection.execute("ALTER TABLE presubmit_processes ADD COLUMN error TEXT")
+  return connection
 
 def is_generated(name):
   return name in {
@@ -241,3 +817,377 @@ def is_generated(name):
     "AssetLinker.cs",
     "Generated.cs"
    }
+
+class Task(object):
+  """A single step in a task graph run by 'run_tasks'. The step either runs the
+  command line 'args' as a subprocess or calls the function 'fn' in a worker
+  thread. If 'env' is provided, 'args' is a script and its arguments, which are
+  run in-process with 'run_script' using that shared Env. 'inputs' lists the
+  files and directories the step reads and 'deps' lists the names of the tasks
+  which must succeed before it can start. An 'interactive' task is run on its
+  own, with the terminal attached, once every other running task has finished.
+
+  If 'cache' is True, a successful run is recorded in the ResultCache and the
+  task is skipped while its inputs and 'config' (a list of strings such as tool
+  versions and settings) are unchanged. The task runs as a 'step', so its
+  subprocesses are killed if it runs for more than 'timeout' seconds, if one
+  of them is idle for 'idle_timeout' seconds, or when the task finishes."""
+  def __init__(self, name, args = None, fn = None, inputs = (), deps = (),
+               interactive = False, cache = False, config = (), env = None,
+               timeout = None, idle_timeout = None):
+    if (args is None) == (fn is None):
+      raise ValueError("Task " + name + " needs exactly one of 'args' or 'fn'")
+    self.name = name
+    self.args = args
+    self.fn = fn
+    self.env = env
+    self.inputs = list(inputs)
+    self.deps = list(deps)
+    self.interactive = interactive
+    self.cache = cache
+    self.config = list(config)
+    self.timeout = timeout
+    self.idle_timeout = idle_timeout
+
+TaskResult = collections.namedtuple("TaskResult",
+                                    ["name", "status", "seconds", "output"])
+
+SUCCESS_STATUSES = ("ok", "cached")
+
+_print_lock = threading.Lock()
+
+def _execute_task(task):
+  """Runs a single task, returning a (status, output) tuple. Output from
+  non-interactive subprocesses and scripts is captured so that concurrently
+  running steps do not interleave their logs."""
+  if task.fn:
+    try:
+      result = task.fn()
+    except SystemExit as e:
+      result = e.code
+    return ("ok" if not result else "failed", None)
+  if task.env:
+    if task.interactive:
+      result = run_script(task.env, task.args[0], task.args[1:])
+      return ("ok" if result == 0 else "failed", None)
+    (result, output) = run_script(task.env, task.args[0], task.args[1:],
+                                  capture = True)
+    return ("ok" if result == 0 else "failed", output)
+  if task.interactive:
+    result = Process(task.args, new_group = False).wait()
+    return ("ok" if result == 0 else "failed", None)
+  output = []
+  result = Process(task.args, output = output, pipe_output = True).wait()
+  return ("ok" if result == 0 else "failed", "".join(output))
+
+def _check_task_graph(tasks):
+  """Verifies that every dependency names a known task and that the graph has
+  no cycles."""
+  by_name = {}
+  for task in tasks:
+    if task.name in by_name:
+      print("Error: Duplicate task name " + task.name)
+      sys.exit(1)
+    by_name[task.name] = task
+  visiting = set()
+  visited = set()
+  def visit(task):
+    if task.name in visited: return
+    if task.name in visiting:
+      print("Error: Dependency cycle involving task " + task.name)
+      sys.exit(1)
+    visiting.add(task.name)
+    for dep in task.deps:
+      if dep not in by_name:
+        print("Error: Task " + task.name + " depends on unknown task " + dep)
+        sys.exit(1)
+      visit(by_name[dep])
+    visiting.remove(task.name)
+    visited.add(task.name)
+  for task in tasks:
+    visit(task)
+
+def list_input_files(paths):
+  """Expands a list of input files and directories into a sorted list of
+  files. Returns a tuple of (files, paths which do not exist)."""
+  files = []
+  missing = []
+  for path in sorted(paths):
+    if os.path.isdir(path):
+      for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames.sort()
+        files.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+    elif os.path.isfile(path):
+      files.append(path)
+    else:
+      missing.append(path)
+  return (files, missing)
+
+class ResultCache(object):
+  """A persistent, content-addressed cache of successful task results. Each
+  entry is keyed by a hash of the task's command, configuration and the
+  contents of its input files. File digests are memoized by (size, mtime) so
+  that computing a key for an unchanged tree only requires a stat() per file.
+  Entries are evicted in least-recently-used order once the cache, including
+  the digest memo, grows beyond 'max_bytes'."""
+  def __init__(self, root, max_bytes = 64 * 1024 * 1024):
+    self.results_root = os.path.join(root, "results")
+    self.digests_path = os.path.join(root, "file_digests.json")
+    self.versions_path = os.path.join(root, "tool_versions.json")
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    mkdirs(self.results_root)
+    self.digests = self._load(self.digests_path)
+    self.versions = self._load(self.versions_path)
+    # Paths whose digests were computed or checked by this cache.
+    self.used = set()
+
+  def _load(self, path):
+    try:
+      with open(path) as json_file:
+        return json.load(json_file)
+    except (IOError, ValueError):
+      return {}
+
+  def _write(self, path, value):
+    # Other processes may be writing the same file, so each writer needs its
+    # own temporary file.
+    (handle, tmp) = tempfile.mkstemp(prefix = os.path.basename(path) + ".",
+                                     suffix = ".tmp",
+                                     dir = os.path.dirname(path))
+    with os.fdopen(handle, "w") as json_file:
+      json.dump(value, json_file)
+    os.rename(tmp, path)
+
+  def _prune_digests(self):
+    """Drops the memoized digests of files which no longer exist or have
+    changed since they were hashed."""
+    for (path, memo) in list(self.digests.items()):
+      if path in self.used: continue
+      try:
+        stat = os.stat(path)
+      except OSError:
+        del self.digests[path]
+        continue
+      if memo[0] != stat.st_size or memo[1] != stat.st_mtime:
+        del self.digests[path]
+
+  def save(self):
+    """Writes the file digest and tool version memos to disk."""
+    with self.lock:
+      self._prune_digests()
+      self._write(self.digests_path, self.digests)
+      self._write(self.versions_path, self.versions)
+    self.evict()
+
+  def file_digest(self, path):
+    """Returns the SHA-1 of the contents of the file at 'path', reusing the
+    previous digest if the file's size and mtime have not changed."""
+    stat = os.stat(path)
+    with self.lock:
+      memo = self.digests.get(path)
+      self.used.add(path)
+    if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime:
+      return memo[2]
+    digest = hashlib.sha1()
+    with open(path, "rb") as input_file:
+      for block in iter(lambda: input_file.read(1024 * 1024), b""):
+        digest.update(block)
+    result = digest.hexdigest()
+    with self.lock:
+      self.digests[path] = [stat.st_size, stat.st_mtime, result]
+    return result
+
+  def tool_version(self, program, args = ["--version"]):
+    """Returns the version string printed by 'program'. The program is only
+    invoked again when its binary changes."""
+    path = which(program)
+    if not path:
+      return program + " (not found)"
+    stat = os.stat(os.path.realpath(path))
+    stamp = [path, stat.st_size, stat.st_mtime]
+    with self.lock:
+      memo = self.versions.get(program)
+    if memo and memo[0] == stamp:
+      return memo[1]
+    process = subprocess.Popen([path] + args, stdout = subprocess.PIPE,
+                               stderr = subprocess.STDOUT)
+    version = process.communicate()[0].decode("utf-8", "replace").strip()
+    with self.lock:
+      self.versions[program] = [stamp, version]
+    return version
+
+  def key(self, task):
+    """Computes the cache key for 'task'."""
+    digest = hashlib.sha1()
+    def update(value):
+      if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+      digest.update(value + b"\0")
+    update(task.name)
+    update(repr(task.args))
+    for value in task.config:
+      update(value)
+    files = [os.path.splitext(os.path.realpath(__file__))[0] + ".py"]
+    if task.args and os.path.isfile(task.args[0]):
+      files.append(task.args[0])
+    (input_files, missing) = list_input_files(task.inputs)
+    for path in missing:
+      update("missing:" + path)
+    for path in files + input_files:
+      update(path)
+      update(self.file_digest(path))
+    return digest.hexdigest()
+
+  def lookup(self, key):
+    """Returns the cached result for 'key', or None on a cache miss."""
+    path = os.path.join(self.results_root, key + ".json")
+    result = self._load(path)
+    if not result:
+      return None
+    os.utime(path, None)
+    return result
+
+  def store(self, key, result):
+    """Records a successful TaskResult under 'key'."""
+    self._write(os.path.join(self.results_root, key + ".json"),
+                {"name": result.name, "seconds": result.seconds})
+    self.evict()
+
+  def evict(self):
+    """Removes the least recently used entries until the cache, including the
+    memos, fits in 'max_bytes'. If the memos alone are too large, only the
+    digests of files used by this cache are kept."""
+    with self.lock:
+      entries = []
+      for name in os.listdir(self.results_root):
+        path = os.path.join(self.results_root, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+      total = sum(entry[1] for entry in entries)
+      for path in [self.digests_path, self.versions_path]:
+        if os.path.isfile(path):
+          total += os.path.getsize(path)
+      for (mtime, size, path) in sorted(entries):
+        if total <= self.max_bytes: break
+        rm(path)
+        total -= size
+      if total > self.max_bytes:
+        self.digests = dict((path, self.digests[path]) for path in self.used
+                            if path in self.digests)
+        self._write(self.digests_path, self.digests)
+
+def print_task_summary(results, elapsed):
+  """Prints a table of the status and wall time of every task in 'results'."""
+  width = max([len(r.name) for r in results] + [4])
+  print("")
+  print("Step".ljust(width) + "  Status   Time")
+  for result in results:
+    print(result.name.ljust(width) + "  " + result.status.ljust(7) + "  " +
+          format_duration(result.seconds))
+  total = sum(r.seconds for r in results)
+  print("Wall time: " + format_duration(elapsed) + " (" +
+        format_duration(total) + " of step time)")
+
+def format_duration(seconds):
+  """Formats a number of seconds for display."""
+  if seconds > 60:
+    return str(round(seconds / 60, 2)) + "m"
+  return str(round(seconds, 2)) + "s"
+
+def run_tasks(tasks, jobs = None, cache = None):
+  """Runs a graph of Task objects, starting each task as soon as all of its
+  dependencies have succeeded and running at most 'jobs' tasks at once
+  (defaults to the number of CPUs). Tasks whose dependencies failed are
+  skipped. If a ResultCache is provided, cacheable tasks whose inputs have not
+  changed since their last successful run are reported as cached instead of
+  being run. Prints a summary table at the end and returns the list of
+  TaskResults, in the same order as 'tasks'."""
+  _check_task_graph(tasks)
+  jobs = jobs or multiprocessing.cpu_count()
+  start = time.time()
+  results = collections.OrderedDict()
+  pending = list(tasks)
+  running = set()
+  condition = threading.Condition()
+
+  def finish(task, status, seconds, output):
+    with _print_lock:
+      if output:
+        print("\n---- " + task.name + " ----")
+        print(output.rstrip())
+      if status not in SUCCESS_STATUSES:
+        print("Step " + task.name + " " + status + ".")
+    with condition:
+      results[task.name] = TaskResult(task.name, status, seconds, output)
+      running.discard(task.name)
+      condition.notify()
+
+  def worker(task):
+    task_start = time.time()
+    key = None
+    with span(task.name, "step"), step(task.name, task.timeout,
+                                       task.idle_timeout) as context:
+      try:
+        if cache and task.cache:
+          key = cache.key(task)
+        if key and cache.lookup(key):
+          (status, output) = ("cached", None)
+        else:
+          (status, output) = _execute_task(task)
+      except Exception as e:
+        (status, output) = ("failed", str(e))
+      if context.killed and status != "ok":
+        status = "timeout"
+        output = ((output or "").rstrip() + "\nKilled " +
+                  ", ".join(context.killed)).lstrip()
+    seconds = time.time() - task_start
+    if key and status == "ok":
+      cache.store(key, TaskResult(task.name, status, seconds, None))
+    finish(task, status, seconds, output)
+
+  with condition:
+    while pending or running:
+      started = False
+      for task in list(pending):
+        statuses = [results[dep].status for dep in task.deps if dep in results]
+        if any(status not in SUCCESS_STATUSES for status in statuses):
+          pending.remove(task)
+          results[task.name] = TaskResult(task.name, "skipped", 0, None)
+          started = True
+          continue
+        if len(statuses) < len(task.deps): continue
+        if task.interactive:
+          # Interactive tasks run alone, once every running task has
+          # finished. Other ready tasks are started in the meantime.
+          if running: continue
+          pending.remove(task)
+          condition.release()
+          try:
+            worker(task)
+          finally:
+            condition.acquire()
+          started = True
+          break
+        if len(running) >= jobs: break
+        pending.remove(task)
+        running.add(task.name)
+        thread = threading.Thread(target = worker, args = (task,))
+        thread.daemon = True
+        thread.start()
+        started = True
+      if not started:
+        condition.wait()
+
+  if cache:
+    cache.save()
+  ordered = [results[task.name] for task in tasks]
+  print_task_summary(ordered, time.time() - start)
+  return ordered
+
+def tasks_succeeded(results):
+  """Returns True if every TaskResult in 'results' passed."""
+  return all(result.status in SUCCESS_STATUSES for result in results)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python2.7
+"""A script to enforce maximum line lengths and ban certain regexes from
+appearing in source files. Reports every violation found."""
+
+import os
+import sys
+import fileindex
+import lib
+import linter
+
+RULES = [
+  linter.Rule(".cs", max_length = 120, banned = [r"Debug\.Log"]),
+  linter.Rule(".clj", max_length = 80, banned = [r"\(p "]),
+]
+
+def trees(env):
+  return [
+    os.path.join(env.client_root, "Assets", "Source"),
+    os.path.join(env.driver_root, "src"),
+    os.path.join(env.driver_root, "test"),
+  ]
+
+def main(env, argv = None):
+  print("Linting source files...")
+
+  violations = linter.Linter(RULES).lint_trees(fileindex.load(env),
+                                               trees(env))
+  for violation in violations:
+    print("Error: " + os.path.relpath(violation.path, env.project_root) + ":" +
+          str(violation.line) + " " + violation.message)
+
+  if violations:
+    print(str(len(violations)) + " lint errors found.")
+    sys.exit(1)
+
+  print("All source files OK!")
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,64 @@
+"""A single-pass source linter. The files in each source tree are listed from
+   the project's file index (see fileindex.py) and each file is read once,
+   applying every rule registered for the file's extension."""
+
+import collections
+import os
+import re
+import lib
+
+# Lint rules for files with 'extension'. Lines may be at most 'max_length'
+# characters long, and must not match any of the regexes in 'banned' unless the
+# previous line contains 'AllowBannedRegex:'.
+Rule = collections.namedtuple("Rule", ["extension", "max_length", "banned"])
+
+Violation = collections.namedtuple("Violation", ["path", "line", "message"])
+
+ALLOW_BANNED = "AllowBannedRegex:"
+
+class Linter(object):
+  """Applies a set of Rules, precompiling every banned regex up front."""
+  def __init__(self, rules):
+    self.rules = {}
+    for rule in rules:
+      compiled = [(regex, re.compile(regex)) for regex in rule.banned]
+      self.rules[rule.extension] = (rule.max_length, compiled)
+
+  def lint_file(self, path, max_length, banned):
+    """Returns a list of Violations for the file at 'path'."""
+    with open(path, "r") as source_file:
+      content = source_file.read()
+    lines = content.splitlines()
+    violations = []
+    for (regex, compiled) in banned:
+      if not compiled.search(content): continue
+      for (index, line) in enumerate(lines):
+        if not compiled.search(line): continue
+        if index > 0 and ALLOW_BANNED in lines[index - 1]: continue
+        violations.append(Violation(path, index + 1,
+                                    "matches forbidden regex " + regex))
+    if max_length:
+      for (index, line) in enumerate(lines):
+        if len(line) > max_length and len(line.rstrip()) > max_length:
+          violations.append(Violation(
+            path, index + 1,
+            "is greater than " + str(max_length) + " characters."))
+    return violations
+
+  def lint_tree(self, index, root):
+    """Returns a list of Violations for every non-generated file under 'root'
+    with a registered extension, listed from the FileIndex 'index'."""
+    violations = []
+    for path in index.files(root, self.rules.keys()):
+      if lib.is_generated(os.path.basename(path)): continue
+      rules = self.rules[os.path.splitext(path)[1]]
+      violations.extend(self.lint_file(path, *rules))
+    return violations
+
+  def lint_trees(self, index, roots):
+    """Lints every tree in 'roots', returning all Violations found."""
+    violations = []
+    for root in roots:
+      with lib.span(root, "lint"):
+        violations.extend(self.lint_tree(index, root))
+    return sorted(violations)
@@ -0,0 +1,321 @@
+"""Compact binary manifests of the ThirdParty files in an assets version. A
+   manifest is built from the .svf files in the checksums directory and lists
+   every file, as a path relative to Assets/ThirdParty, with its CRC. Paths are
+   stored sorted in a single array-backed table, so a path is found by binary
+   search without parsing the rest of the manifest.
+
+   Each vendor directory (one .svf file) has its own hash, the MD5 of its .svf
+   file, and the manifest's root hash is computed from the vendor names and
+   hashes. Two versions therefore differ in exactly the vendors whose hashes
+   differ, and only those vendors' files need to be compared. MD5 can't be
+   composed from the hashes of its parts, so the manifest also records the
+   assets version itself (see metasum.py), computed from the same bytes.
+
+   Manifests are cached in '<cache>/manifests' by assets version. Versions
+   other than the current one are built from the checksums directory of the
+   commit which introduced them."""
+
+import array
+import bisect
+import binascii
+import collections
+import hashlib
+import os
+import struct
+import subprocess
+import sys
+import hashing
+import lib
+import metasum
+
+MAGIC = b"DSAM"
+FORMAT_VERSION = 1
+# Magic, format version, vendor count, file count, assets version, root hash.
+HEADER = struct.Struct("<4sIII16s16s")
+VERSION_PATH = "DungeonStrike/assets_version.md5"
+
+Vendor = collections.namedtuple("Vendor", ["name", "hash", "start", "end"])
+
+FileDiff = collections.namedtuple("FileDiff", ["path", "status", "old_crc",
+                                               "new_crc"])
+
+def _uint32_array(data = b""):
+  """Returns an array of little-endian unsigned 32-bit integers read from
+  'data'."""
+  values = array.array("I")
+  if hasattr(values, "frombytes"):
+    values.frombytes(data)
+  else:
+    values.fromstring(data)
+  if sys.byteorder == "big":
+    values.byteswap()
+  return values
+
+def _array_bytes(values):
+  values = array.array(values.typecode, values)
+  if sys.byteorder == "big":
+    values.byteswap()
+  return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+def _encode(text):
+  return text if isinstance(text, bytes) else text.encode("utf-8")
+
+def _decode(data):
+  return data.decode("utf-8")
+
+class _Paths(object):
+  """A read-only sequence of the encoded paths in a manifest, for bisect."""
+  def __init__(self, manifest):
+    self.manifest = manifest
+
+  def __len__(self):
+    return len(self.manifest.crcs)
+
+  def __getitem__(self, index):
+    return self.manifest._path_bytes(index)
+
+class Manifest(object):
+  """A parsed manifest. Paths and CRCs are only decoded when accessed."""
+  def __init__(self, data):
+    (magic, format_version, vendor_count, file_count, version,
+     root) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+      raise ValueError("Not a version " + str(FORMAT_VERSION) +
+                       " asset manifest")
+    self.version = _decode(binascii.hexlify(version))
+    self.root = _decode(binascii.hexlify(root))
+    offset = HEADER.size
+    def table(count):
+      start = offset
+      return (_uint32_array(data[start:start + 4 * count]),
+              start + 4 * count)
+    (name_offsets, offset) = table(vendor_count + 1)
+    (vendor_starts, offset) = table(vendor_count + 1)
+    vendor_hashes = data[offset:offset + 16 * vendor_count]
+    offset += 16 * vendor_count
+    (self.path_offsets, offset) = table(file_count + 1)
+    (self.crcs, offset) = table(file_count)
+    names = data[offset:offset + name_offsets[-1]]
+    offset += name_offsets[-1]
+    self.paths = data[offset:offset + self.path_offsets[-1]]
+    self.vendors = collections.OrderedDict()
+    for index in range(vendor_count):
+      name = _decode(names[name_offsets[index]:name_offsets[index + 1]])
+      self.vendors[name] = Vendor(
+        name,
+        _decode(binascii.hexlify(vendor_hashes[16 * index:16 * index + 16])),
+        vendor_starts[index], vendor_starts[index + 1])
+
+  def __len__(self):
+    return len(self.crcs)
+
+  def _path_bytes(self, index):
+    return self.paths[self.path_offsets[index]:self.path_offsets[index + 1]]
+
+  def path(self, index):
+    return _decode(self._path_bytes(index))
+
+  def crc(self, index):
+    return "%08x" % self.crcs[index]
+
+  def find(self, path):
+    """Returns the index of 'path', relative to Assets/ThirdParty, or
+    None."""
+    key = _encode(path)
+    index = bisect.bisect_left(_Paths(self), key)
+    if index < len(self) and self._path_bytes(index) == key:
+      return index
+    return None
+
+  def lookup(self, path):
+    """Returns the CRC of 'path', relative to Assets/ThirdParty, or None if it
+    is not in this version."""
+    index = self.find(path)
+    return None if index is None else self.crc(index)
+
+  def entries(self, vendor = None):
+    """Yields (path, crc) for every file, or for the files of 'vendor'."""
+    if vendor is None:
+      (start, end) = (0, len(self))
+    else:
+      (start, end) = self.vendors[vendor][2:]
+    for index in range(start, end):
+      yield (self.path(index), self.crc(index))
+
+def build(files):
+  """Builds a manifest from 'files', a list of (name, contents) for every
+  file in a checksums directory, sorted by name. Returns the encoded
+  manifest."""
+  version = metasum.version_of([contents for (name, contents) in files])
+  vendors = []
+  for (name, contents) in files:
+    if not name.endswith(".svf"): continue
+    vendor = _encode(name[:-len(".svf")])
+    entries = hashing.parse_svf(_decode(contents).splitlines())
+    # Paths sort as bytes, so every vendor's files form one contiguous range
+    # and vendors sort by their path prefix.
+    vendors.append((vendor + b"/", vendor, hashlib.md5(contents).digest(),
+                    sorted((vendor + b"/" + _encode(path), int(crc, 16))
+                           for (path, crc) in entries)))
+  vendors.sort()
+
+  root = hashlib.md5()
+  name_offsets = _uint32_array()
+  vendor_starts = _uint32_array()
+  path_offsets = _uint32_array()
+  crcs = _uint32_array()
+  names = []
+  paths = []
+  name_offset = path_offset = 0
+  for (prefix, vendor, digest, entries) in vendors:
+    root.update(vendor + b"\0" + digest)
+    name_offsets.append(name_offset)
+    name_offset += len(vendor)
+    names.append(vendor)
+    vendor_starts.append(len(crcs))
+    for (path, crc) in entries:
+      path_offsets.append(path_offset)
+      path_offset += len(path)
+      paths.append(path)
+      crcs.append(crc)
+  name_offsets.append(name_offset)
+  vendor_starts.append(len(crcs))
+  path_offsets.append(path_offset)
+
+  return b"".join([
+    HEADER.pack(MAGIC, FORMAT_VERSION, len(vendors), len(crcs),
+                binascii.unhexlify(version), root.digest()),
+    _array_bytes(name_offsets), _array_bytes(vendor_starts),
+    b"".join(digest for (prefix, vendor, digest, entries) in vendors),
+    _array_bytes(path_offsets), _array_bytes(crcs),
+    b"".join(names), b"".join(paths)])
+
+def read_checksums(root):
+  """Returns (name, contents) for every file in the checksums directory
+  'root', sorted by name."""
+  files = []
+  for name in sorted(os.listdir(root)):
+    path = os.path.join(root, name)
+    if os.path.isfile(path):
+      with open(path, "rb") as checksum_file:
+        files.append((name, checksum_file.read()))
+  return files
+
+def manifest_root(env):
+  return os.path.join(env.cache_root, "manifests")
+
+def manifest_path(env, version):
+  return os.path.join(manifest_root(env), version + ".dsam")
+
+def _save(env, data):
+  version = Manifest(data).version
+  lib.mkdirs(manifest_root(env))
+  tmp = manifest_path(env, version) + ".tmp"
+  with open(tmp, "wb") as output:
+    output.write(data)
+  os.rename(tmp, manifest_path(env, version))
+  return version
+
+def update(env):
+  """Builds and caches the manifest for the checksums directory of the
+  working tree. Returns its assets version."""
+  return _save(env, build(read_checksums(env.checksums_root)))
+
+def _git(env, args):
+  return lib.output(["git", "-C", env.project_root] + args)
+
+def find_revision(env, version):
+  """Returns the most recent commit which set the assets version to
+  'version', or None."""
+  log = _git(env, ["log", "--format=commit %H", "-p", "--", VERSION_PATH])
+  revision = None
+  for line in log.splitlines():
+    if line.startswith("commit "):
+      revision = line.split(" ")[1]
+    elif line.startswith("+") and line[1:].strip() == version:
+      return revision
+  return None
+
+def build_from_git(env, revision):
+  """Builds the manifest for the checksums directory at 'revision'."""
+  prefix = os.path.relpath(env.checksums_root, env.project_root)
+  listing = _git(env, ["ls-tree", "-z", revision, prefix + "/"])
+  blobs = []
+  for entry in listing.split("\0"):
+    if not entry: continue
+    (info, path) = entry.split("\t", 1)
+    (mode, kind, sha) = info.split(" ")
+    if kind == "blob":
+      blobs.append((os.path.basename(path), sha))
+  blobs.sort()
+  process = subprocess.Popen(
+    ["git", "-C", env.project_root, "cat-file", "--batch"],
+    stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+  output = process.communicate(
+    b"".join(_encode(sha) + b"\n" for (name, sha) in blobs))[0]
+  if process.returncode != 0:
+    raise ValueError("Unable to read the checksums at " + revision)
+  files = []
+  offset = 0
+  for (name, sha) in blobs:
+    end = output.index(b"\n", offset)
+    size = int(output[offset:end].split(b" ")[2])
+    files.append((name, output[end + 1:end + 1 + size]))
+    offset = end + 2 + size
+  return build(files)
+
+def load(env, version):
+  """Returns the Manifest for the assets version 'version', building it from
+  the working tree or the git history if it is not cached. 'version' may
+  also be 'current', for the version in assets_version.md5."""
+  if version == "current":
+    with open(os.path.join(env.client_root, "assets_version.md5")) as current:
+      version = current.read().strip()
+  path = manifest_path(env, version)
+  if not os.path.isfile(path):
+    if metasum.compute(env) == version:
+      update(env)
+    else:
+      revision = find_revision(env, version)
+      if not revision:
+        raise ValueError("Assets version " + version + " is not in the " +
+                         "history of " + VERSION_PATH)
+      if _save(env, build_from_git(env, revision)) != version:
+        raise ValueError("The checksums committed with assets version " +
+                         version + " do not match it")
+  with open(path, "rb") as manifest_file:
+    return Manifest(manifest_file.read())
+
+def diff(old, new):
+  """Compares two Manifests. Returns (changed vendors, list of FileDiffs),
+  where each vendor is (name, status) and status is 'added', 'removed' or
+  'modified'. Only the files of vendors whose hashes differ are compared."""
+  vendors = []
+  files = []
+  for name in sorted(set(old.vendors) | set(new.vendors)):
+    before = old.vendors.get(name)
+    after = new.vendors.get(name)
+    if before and after and before.hash == after.hash: continue
+    vendors.append((name, "added" if not before else
+                    "removed" if not after else "modified"))
+    old_entries = list(old.entries(name)) if before else []
+    new_entries = list(new.entries(name)) if after else []
+    (i, j) = (0, 0)
+    while i < len(old_entries) or j < len(new_entries):
+      (old_path, old_crc) = (old_entries[i] if i < len(old_entries)
+                             else (None, None))
+      (new_path, new_crc) = (new_entries[j] if j < len(new_entries)
+                             else (None, None))
+      if new_path is None or (old_path is not None and
+                              _encode(old_path) < _encode(new_path)):
+        files.append(FileDiff(old_path, "removed", old_crc, None))
+        i += 1
+      elif old_path is None or _encode(new_path) < _encode(old_path):
+        files.append(FileDiff(new_path, "added", None, new_crc))
+        j += 1
+      else:
+        if old_crc != new_crc:
+          files.append(FileDiff(old_path, "modified", old_crc, new_crc))
+        i += 1
+        j += 1
+  return (vendors, files)
@@ -2,13 +2,29 @@
 import hashlib
 import os
 import lib
-env = lib.init()
-
-result = hashlib.md5()
-checksums = sorted(os.listdir(env.checksums_root))
-for checksum in checksums:
-  file = os.path.join(env.checksums_root, checksum)
-  if os.path.isfile(file):
-    with open(file) as hashfile:
-      result.update(hashfile.read())
-print result.hexdigest()
+
+def version_of(contents):
+  """Returns the assets version for a list of the contents of the files in
+  the checksums directory, in file name order."""
+  result = hashlib.md5()
+  for content in contents:
+    result.update(content)
+  return result.hexdigest()
+
+def compute(env):
+  """Returns the assets version: an MD5 of the contents of every file in the
+  checksums directory."""
+  contents = []
+  checksums = sorted(os.listdir(env.checksums_root))
+  for checksum in checksums:
+    file = os.path.join(env.checksums_root, checksum)
+    if os.path.isfile(file):
+      with open(file, "rb") as hashfile:
+        contents.append(hashfile.read())
+  return version_of(contents)
+
+def main(env, argv = None):
+  print(compute(env))
+
+if __name__ == "__main__":
+  main(lib.init())
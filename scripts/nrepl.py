@@ -0,0 +1,247 @@
+"""A minimal nREPL client used to run Leiningen commands in a long-lived, warm
+   JVM instead of starting a new one for every command. Servers are started
+   with 'scripts/repl_server.py' and recorded in the cache directory."""
+
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+  text_type = unicode
+except NameError:
+  text_type = str
+
+STARTUP_TIMEOUT = 300
+
+# Clojure code evaluated in the warm JVM in place of 'lein test'. Reloads any
+# changed namespaces first so that the results match a cold run.
+TEST_CODE = """
+(do
+  (require 'clojure.test 'clojure.tools.namespace.repl)
+  (clojure.tools.namespace.repl/set-refresh-dirs "src" "test")
+  (let [refresh-result (clojure.tools.namespace.repl/refresh)]
+    (if (instance? Throwable refresh-result)
+      (do (.printStackTrace refresh-result) 1)
+      (let [{:keys [fail error]}
+            (clojure.test/run-all-tests #".*-test$")]
+        (+ fail error)))))
+"""
+
+# Clojure code evaluated in place of 'lein cljfmt check' or 'lein cljfmt fix'.
+CLJFMT_CODE = r"""
+(do
+  (require 'cljfmt.core 'clojure.java.io)
+  (let [files (->> ["src" "test"]
+                   (map clojure.java.io/file)
+                   (mapcat file-seq)
+                   (filter #(re-find #"\.clj[sc]?$" (.getName %%))))
+        incorrect (doall (remove #(let [source (slurp %%)]
+                                    (= source (cljfmt.core/reformat-string
+                                               source)))
+                                 files))]
+    (doseq [file incorrect]
+      (if %(fix)s
+        (do (println "Reformatting" (.getPath file))
+            (spit file (cljfmt.core/reformat-string (slurp file))))
+        (println (.getPath file) "has incorrect formatting")))
+    (if %(fix)s 0 (count incorrect))))
+"""
+
+WARM_COMMANDS = {
+  ("test",): TEST_CODE,
+  ("cljfmt", "check"): CLJFMT_CODE % {"fix": "false"},
+  ("cljfmt", "fix"): CLJFMT_CODE % {"fix": "true"},
+}
+
+def encode(value):
+  """Bencodes 'value'."""
+  if isinstance(value, bool) or isinstance(value, int):
+    return ("i" + str(int(value)) + "e").encode("ascii")
+  if isinstance(value, text_type):
+    value = value.encode("utf-8")
+  if isinstance(value, bytes):
+    return str(len(value)).encode("ascii") + b":" + value
+  if isinstance(value, (list, tuple)):
+    return b"l" + b"".join(encode(item) for item in value) + b"e"
+  if isinstance(value, dict):
+    return (b"d" +
+            b"".join(encode(key) + encode(value[key])
+                     for key in sorted(value.keys())) +
+            b"e")
+  raise ValueError("Cannot bencode " + repr(value))
+
+def decode(stream, prefix = None):
+  """Reads a single bencoded value from the file-like object 'stream'. Strings
+  are returned as text. 'prefix' is the first byte of the value, if it has
+  already been read."""
+  prefix = prefix or stream.read(1)
+  if not prefix:
+    raise EOFError("nREPL connection closed")
+  if prefix == b"i":
+    digits = b""
+    while True:
+      char = stream.read(1)
+      if char == b"e": return int(digits)
+      digits += char
+  if prefix in (b"l", b"d"):
+    items = []
+    while True:
+      char = stream.read(1)
+      if char == b"e": break
+      items.append(decode(stream, char))
+    if prefix == b"l":
+      return items
+    return dict(zip(items[::2], items[1::2]))
+  length = prefix
+  while True:
+    char = stream.read(1)
+    if char == b":": break
+    length += char
+  return stream.read(int(length)).decode("utf-8", "replace")
+
+class Client(object):
+  """A connection to an nREPL server."""
+  _ids = itertools.count()
+
+  def __init__(self, port, host = "127.0.0.1", timeout = 5):
+    self.socket = socket.create_connection((host, port), timeout)
+    self.socket.settimeout(None)
+    self.stream = self.socket.makefile("rb")
+
+  def close(self):
+    self.stream.close()
+    self.socket.close()
+
+  def eval(self, code):
+    """Evaluates 'code', echoing its output as it arrives. Returns a tuple of
+    (value, exception) where 'value' is the printed form of the last value
+    produced and 'exception' is the name of an exception class, if one was
+    thrown."""
+    message_id = str(next(self._ids))
+    self.socket.sendall(encode({"op": "eval", "code": code,
+                                "id": message_id}))
+    value = None
+    exception = None
+    while True:
+      response = decode(self.stream)
+      if response.get("id") != message_id: continue
+      if "out" in response:
+        sys.stdout.write(response["out"])
+        sys.stdout.flush()
+      if "err" in response:
+        sys.stderr.write(response["err"])
+        sys.stderr.flush()
+      if "value" in response:
+        value = response["value"]
+      if "ex" in response:
+        exception = response["ex"]
+      if "done" in response.get("status", []):
+        return (value, exception)
+
+def server_info_path(env, project_root):
+  """Returns the path of the file describing the warm server for a project."""
+  return os.path.join(env.cache_root, "repl",
+                      os.path.basename(project_root) + ".json")
+
+def read_server_info(env, project_root):
+  try:
+    with open(server_info_path(env, project_root)) as info_file:
+      return json.load(info_file)
+  except (IOError, ValueError):
+    return None
+
+def connect(env, project_root):
+  """Returns a Client connected to the warm server for 'project_root', or None
+  if no usable server is running. A server is not used if project.clj changed
+  after it was started, since its classpath may be out of date."""
+  info = read_server_info(env, project_root)
+  if not info:
+    return None
+  project_file = os.path.join(project_root, "project.clj")
+  if os.path.getmtime(project_file) > info["started"]:
+    print("project.clj changed since the REPL server started, ignoring it. " +
+          "Restart it with 'scripts/repl_server.py restart'.")
+    return None
+  try:
+    return Client(info["port"])
+  except socket.error:
+    return None
+
+def free_port():
+  """Returns a TCP port which is currently free."""
+  sock = socket.socket()
+  sock.bind(("127.0.0.1", 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+def start_server(env, project_root):
+  """Starts a headless Leiningen REPL for 'project_root' in the background and
+  waits for it to accept connections. Returns True on success."""
+  port = free_port()
+  info_path = server_info_path(env, project_root)
+  if not os.path.isdir(os.path.dirname(info_path)):
+    os.makedirs(os.path.dirname(info_path))
+  log = open(os.path.splitext(info_path)[0] + ".log", "w")
+  started = time.time()
+  process = subprocess.Popen(
+    ["lein", "repl", ":headless", ":host", "127.0.0.1", ":port", str(port)],
+    cwd = project_root, stdout = log, stderr = subprocess.STDOUT,
+    stdin = open(os.devnull), preexec_fn = os.setsid)
+  while time.time() - started < STARTUP_TIMEOUT:
+    if process.poll() is not None:
+      print("REPL server for " + project_root + " exited. See " + log.name)
+      return False
+    try:
+      Client(port, timeout = 1).close()
+      break
+    except socket.error:
+      time.sleep(1)
+  else:
+    print("Timed out waiting for REPL server for " + project_root)
+    os.killpg(process.pid, 15)
+    return False
+  with open(info_path, "w") as info_file:
+    json.dump({"port": port, "pid": process.pid, "started": started},
+              info_file)
+  return True
+
+def stop_server(env, project_root):
+  """Stops the warm server for 'project_root', if one is running."""
+  info = read_server_info(env, project_root)
+  if not info:
+    return
+  try:
+    os.killpg(info["pid"], 15)
+  except OSError:
+    pass
+  os.remove(server_info_path(env, project_root))
+
+def run_lein(env, project_root, args):
+  """Runs the lein command 'args' in the warm server for 'project_root'.
+  Returns the command's exit code, or None if the command is not supported in
+  a warm JVM or no server is available."""
+  code = WARM_COMMANDS.get(tuple(args))
+  if not code:
+    return None
+  client = connect(env, project_root)
+  if not client and env.warm_lein:
+    print("Starting REPL server for " + project_root + "...")
+    if start_server(env, project_root):
+      client = connect(env, project_root)
+  if not client:
+    return None
+  try:
+    (value, exception) = client.eval(code)
+  finally:
+    client.close()
+  if exception:
+    return 1
+  try:
+    return 1 if int(value) else 0
+  except (TypeError, ValueError):
+    return 1
@@ -1,54 +1,204 @@
 #!/usr/bin/env python2.7
+import argparse
 import os
-import lib
+import sys
 import time
-env = lib.init()
+import lib
+import staging
+import watcher
+
+# Wall time limits for the Unity steps, in seconds. Their processes are killed
+# when a limit is reached, so a hung client or editor fails the step instead of
+# blocking the presubmit forever.
+EDITOR_TESTS_TIMEOUT = 30 * 60
+INTEGRATION_TESTS_TIMEOUT = 60 * 60
+
+def watched_task(task, check):
+  """Returns a task which reports the result of 'task' published by the watch
+  daemon (see 'watch.py') instead of running it."""
+  def report():
+    print(task.name + " results from the watch daemon:")
+    for error in check["errors"]:
+      print("Error: " + error)
+    return 0 if check["ok"] else 1
+  return lib.Task(task.name, fn = report, deps = task.deps)
+
+def make_tasks(env, args, cache, workspaces, watched = None):
+  """Returns the task graph for a presubmit run. Steps which run scripts from
+  this checkout are run in-process with the shared 'env'. The Unity steps run
+  in the staging workspaces in 'workspaces', in parallel if there is more
+  than one. Steps with results in 'watched', the status of the watch daemon,
+  are not run again."""
+  source_dir = os.path.join(env.client_root, "Assets", "Source")
+  driver_dir = os.path.join(env.driver_root, "src")
+  driver_tests_dir = os.path.join(env.driver_root, "test")
+  third_party_dir = os.path.join(env.client_root, "Assets", "ThirdParty")
+
+  def script(name, args=[]):
+    """Returns the command line to invoke a script."""
+    return [env.script(name)] + args
+
+  def staging_script(workspace, name, args=[]):
+    """Returns the command line to invoke a script on the project copy in a
+    staging workspace."""
+    return [os.path.join(workspace, "scripts", name)] + args
 
-def time_duration(func):
-  """Prints the duration a function took to run."""
-  """Calls a script on the project copy in the staging area."""
-  start = time.time()
-  func()
-  elapsed = time.time() - start
-  if elapsed > 60:
-    print("Done. " + str(round(elapsed / 60, 2)) + " minutes elapsed.")
-  elif elapsed > 5:
-    print("Done. " + str(round(elapsed, 2)) + " seconds elapsed.")
+  def version(program, args = ["--version"]):
+    """Returns the version of a tool for use in a cache key."""
+    return cache.tool_version(program, args) if cache else program
 
-def call_script(name, args=[]):
-  """Calls a script and times the run time."""
-  def fn(): lib.call([env.script(name)] + args)
-  time_duration(fn)
+  source_checks = ["check_for_unsaved_files", "lint", "uncrustify"]
+  checksum_files = [os.path.join(env.checksums_root, name)
+                    for name in sorted(os.listdir(env.checksums_root))
+                    if name.endswith(".svf")]
+  editor_workspaces = workspaces[:-1] or workspaces
 
-def call_script_on_staging(name, args=[]):
-  """Calls a script on the project copy in the staging area."""
-  def fn(): lib.call([os.path.join(env.staging_path, "scripts", name)] + args)
-  time_duration(fn)
+  tasks = [
+    lib.Task("check_for_unsaved_files",
+             args = script("check_for_unsaved_files.py"),
+             env = env,
+             inputs = [env.project_root]),
+    lib.Task("lint",
+             args = script("lint.py"),
+             env = env,
+             inputs = [source_dir, driver_dir, driver_tests_dir,
+                       env.script("linter.py")],
+             cache = True),
+    lib.Task("uncrustify",
+             args = script("uncrustify.py"),
+             env = env,
+             inputs = [source_dir, env.script("uncrustify.cfg")],
+             cache = True,
+             config = [version("uncrustify")]),
+    lib.Task("driver_tests",
+             args = script("run_driver_tests.py"),
+             env = env,
+             inputs = [
+               os.path.join(env.driver_root, "project.clj"),
+               driver_dir,
+               driver_tests_dir,
+               os.path.join(env.effects_root, "project.clj"),
+               os.path.join(env.effects_root, "src"),
+               os.path.join(env.effects_root, "test"),
+             ],
+             cache = True,
+             config = [version("lein")]),
+    # Runs as a subprocess because it hashes files in a process pool, which
+    # isn't safe to fork from a process with other threads running. Only the
+    # .svf files are inputs, since the step rewrites its stat index in
+    # checksums/.index on every run.
+    lib.Task("checksum",
+             args = script("checksum.py"),
+             inputs = [third_party_dir, env.script("hashing.py")] +
+                      checksum_files,
+             cache = True),
 
-print("Starting pre-commit checks...")
+    # Unity tests need to be run on separate copies of the project, because
+    # you can't have the same project open in two different copies of Unity at
+    # once. The integration tests get their own staging workspace if there is
+    # more than one, and otherwise can't overlap with the editor tests, which
+    # are sharded across the remaining workspaces. The integration tests run
+    # the workspace's scripts, so they are a subprocess.
+    lib.Task("copy_to_staging_area",
+             args = script("copy_to_staging_area.py",
+                           [argument for workspace in workspaces
+                            for argument in ["--workspace", workspace]]),
+             env = env,
+             inputs = [env.project_root],
+             deps = source_checks),
+    lib.Task("editor_tests",
+             args = script("run_editor_tests.py",
+                           ["--shards", str(len(editor_workspaces))] +
+                           [argument for workspace in editor_workspaces
+                            for argument in ["--workspace", workspace]]),
+             env = env,
+             deps = ["copy_to_staging_area"],
+             timeout = EDITOR_TESTS_TIMEOUT),
+    lib.Task("integration_tests",
+             args = staging_script(
+               workspaces[-1], "run_integration.py",
+               ["--test", "all"] if args.all_integration_tests
+               else ["--test", "changed", "--base", args.base]),
+             deps = (["copy_to_staging_area"] if len(workspaces) > 1
+                     else ["editor_tests"]),
+             timeout = INTEGRATION_TESTS_TIMEOUT),
+  ]
+  if watched:
+    tasks = [watched_task(task, watched["checks"][task.name])
+             if task.name in watched["checks"] else task for task in tasks]
+  return tasks
 
-call_script("check_for_unsaved_files.py")
+def record_history(env, results, processes, started, trace_path):
+  """Records the timing of this run and the resource use of its processes in
+  the history database. See 'presubmit_history.py'."""
+  revision = lib.output(["git", "rev-parse", "HEAD"]).strip()
+  connection = lib.history_db(env)
+  with connection:
+    cursor = connection.execute(
+      "INSERT INTO presubmit_runs " +
+      "(started, seconds, success, revision, trace_path) " +
+      "VALUES (?, ?, ?, ?, ?)",
+      (started, time.time() - started, lib.tasks_succeeded(results), revision,
+       trace_path))
+    connection.executemany(
+      "INSERT INTO presubmit_steps (run_id, name, status, seconds) " +
+      "VALUES (?, ?, ?, ?)",
+      [(cursor.lastrowid, result.name, result.status, result.seconds)
+       for result in results])
+    connection.executemany(
+      "INSERT INTO presubmit_processes (run_id, " +
+      ", ".join(lib.ProcessStats._fields) + ") " +
+      "VALUES (?" + ", ?" * len(lib.ProcessStats._fields) + ")",
+      [(cursor.lastrowid,) + tuple(stats) for stats in processes])
+  connection.close()
 
-print("Checking for banned regexes...")
-source_dir = os.path.join(env.client_root, "Assets", "Source")
-driver_dir = os.path.join(env.driver_root, "src")
-driver_tests_dir = os.path.join(env.driver_root, "test")
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(description = "Runs pre-commit checks.")
+  parser.add_argument("--jobs", type = int,
+                      help = "Maximum number of steps to run at once " +
+                             "(default: number of CPUs)")
+  parser.add_argument("--no-cache", action = "store_true",
+                      help = "Run every step, even if its inputs are " +
+                             "unchanged")
+  parser.add_argument("--all-integration-tests", action = "store_true",
+                      help = "Run every integration test instead of only " +
+                             "those affected by uncommitted changes")
+  parser.add_argument("--base", default = "HEAD",
+                      help = "Commit to compare against when selecting the " +
+                             "integration tests affected by changes " +
+                             "(default: HEAD)")
+  parser.add_argument("--no-watch", action = "store_true",
+                      help = "Run every step, even if the watch daemon has " +
+                             "results for it")
+  args = parser.parse_args(argv)
 
-lib.ban_regex(source_dir, ".cs", r"Debug\.Log")
-lib.ban_regex(driver_dir, ".clj", r"\(p ")
-lib.ban_regex(driver_tests_dir, ".clj", r"\(p ")
+  cache = None if args.no_cache else lib.ResultCache(env.cache_root)
+  watched = None if args.no_watch else watcher.sync(env)
+  # Held until this process exits, so that another presubmit can't sync over
+  # a workspace while Unity has it open.
+  lease = staging.acquire_workspaces(env, env.staging_workspaces)
+  tasks = make_tasks(env, args, cache, lease.paths, watched)
+  if watched:
+    print("Using results from the watch daemon for: " +
+          ", ".join(task.name for task in tasks
+                    if task.name in watched["checks"]))
 
-# Note: These should be ordered from shortest to longest runtime.
-call_script("check_line_lengths.py")
+  print("Starting pre-commit checks...")
 
-call_script("uncrustify.py")
+  started = time.time()
+  events_path = lib.start_trace(env, "presubmit")
+  results = lib.run_tasks(tasks, jobs = args.jobs, cache = cache)
+  trace_path = lib.finish_trace(events_path)
+  processes = lib.process_stats()
+  lib.print_process_table(processes)
+  record_history(env, results, processes, started, trace_path)
+  print("Trace written to " + trace_path)
 
-call_script("run_driver_tests.py")
+  if not lib.tasks_succeeded(results):
+    print("Pre-commit checks failed.")
+    sys.exit(1)
 
-call_script("checksum.py")
+  print("All pre-commit checks passed.")
 
-# Unity tests need to be run on a separate copy of the project, because you
-# can't have the same project open in two different copies of Unity at once.
-call_script("copy_to_staging_area.py")
-call_script_on_staging("run_editor_tests.py")
-call_script_on_staging("run_integration.py", ["--test", "all"])
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2.7
+"""Shows the timing history recorded by presubmit.py and flags steps which got
+slower in the most recent run."""
+
+import argparse
+import time
+import lib
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Shows presubmit timing history.")
+  parser.add_argument("--runs", type = int, default = 20,
+                      help = "Number of previous runs to compare against")
+  parser.add_argument("--threshold", type = float, default = 1.5,
+                      help = "Slowdown factor reported as a regression")
+  args = parser.parse_args(argv)
+
+  connection = lib.history_db(env)
+  runs = connection.execute(
+    "SELECT id, started, seconds, success, revision, trace_path " +
+    "FROM presubmit_runs ORDER BY id DESC LIMIT ?", (args.runs + 1,)).fetchall()
+  if not runs:
+    print("No presubmit runs recorded yet.")
+    connection.close()
+    return
+
+  print("Recent runs:")
+  for (run_id, started, seconds, success, revision, trace_path) in runs[:5]:
+    print("  " + time.strftime("%Y-%m-%d %H:%M", time.localtime(started)) +
+          "  " + ("passed" if success else "FAILED") + "  " +
+          lib.format_duration(seconds) + "  " + (revision or "")[:10] +
+          "  " + (trace_path or ""))
+
+  latest = runs[0][0]
+  previous = [run[0] for run in runs[1:]]
+  steps = connection.execute(
+    "SELECT name, seconds FROM presubmit_steps WHERE run_id = ? " +
+    "AND status = 'ok'", (latest,)).fetchall()
+
+  print("\nLatest run compared to the median of the previous " +
+        str(len(previous)) + " runs:")
+  width = max([len(name) for (name, seconds) in steps] + [4])
+  for (name, seconds) in steps:
+    history = [row[0] for row in connection.execute(
+      "SELECT seconds FROM presubmit_steps WHERE name = ? AND status = 'ok' " +
+      "AND run_id IN (" + ",".join("?" * len(previous)) + ")",
+      [name] + previous)] if previous else []
+    if not history:
+      print("  " + name.ljust(width) + "  " + lib.format_duration(seconds))
+      continue
+    typical = median(history)
+    flag = ""
+    if seconds > typical * args.threshold and seconds - typical > 1:
+      flag = "  REGRESSION"
+    print("  " + name.ljust(width) + "  " + lib.format_duration(seconds) +
+          " (median " + lib.format_duration(typical) + ")" + flag)
+  connection.close()
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python2.7
+"""Manages long-lived headless Leiningen REPL servers for the driver and
+effects projects. While a server is running, 'lein test' and 'lein cljfmt'
+invocations made through the scripts in this directory are evaluated in its
+warm JVM instead of starting a new one."""
+
+import argparse
+import lib
+import nrepl
+env = lib.init()
+
+parser = argparse.ArgumentParser(description = "Manages warm REPL servers.")
+parser.add_argument("command", choices = ["start", "stop", "restart", "status"])
+args = parser.parse_args()
+
+projects = [env.driver_root, env.effects_root]
+
+def stop():
+  for project in projects:
+    nrepl.stop_server(env, project)
+  print("REPL servers stopped.")
+
+def start():
+  for project in projects:
+    client = nrepl.connect(env, project)
+    if client:
+      client.close()
+      print("REPL server for " + project + " already running.")
+      continue
+    print("Starting REPL server for " + project + "...")
+    if not nrepl.start_server(env, project):
+      exit(1)
+  print("REPL servers started.")
+
+if args.command == "stop":
+  stop()
+elif args.command == "restart":
+  stop()
+  start()
+elif args.command == "start":
+  start()
+else:
+  for project in projects:
+    client = nrepl.connect(env, project)
+    if client:
+      client.close()
+      info = nrepl.read_server_info(env, project)
+      print(project + ": running on port " + str(info["port"]))
+    else:
+      print(project + ": not running")
@@ -1,16 +1,17 @@
 #!/usr/bin/env python2.7
+import sys
 import lib
-import os
 
-env = lib.init()
+def main(env, argv = None):
+  print("\nRunning driver tests...\n")
 
-print("\nRunning driver tests...\n")
+  env.lein(["test"])
 
-env.lein(["test"])
+  print("\nRunning effects tests...\n")
 
-print("\nRunning effects tests...\n")
+  if env.lein(["test"], allow_failure = True, project_root = env.effects_root):
+    print("Effects tests failed!")
+    sys.exit(1)
 
-cwd = os.getcwd()
-os.chdir(env.effects_root)
-lib.call(["lein", "test"], failure_message = "Effects tests failed!")
-os.chdir(cwd)
+if __name__ == "__main__":
+  main(lib.init())
@@ -1,15 +1,133 @@
 #!/usr/bin/env python2.7
+"""Runs the Unity editor tests and records each test's result and duration.
+With '--shards', the fixtures are split into shards of about the same
+expected duration, based on previous runs, which run at the same time in
+separate staging workspaces."""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import editor_tests
+import fileindex
 import lib
-env = lib.init()
+import staging
+
+def run_shard(env, client_root, fixtures):
+  """Runs the editor tests of the Unity project in 'client_root', or only
+  those in 'fixtures' if it is not None. Returns a tuple of (Unity's exit
+  code, list of TestResults)."""
+  results_path = os.path.join(client_root, "Logs", "EditorTestResults.xml")
+  log_path = os.path.join(client_root, "Logs", "Editor.log")
+  lib.mkdirs(os.path.dirname(results_path))
+  lib.rm(results_path)
+  args = [
+    "-batchmode",
+    "-quit", # Documentation says this isn't required, but it's wrong :)
+    "-projectPath", client_root,
+    "-runEditorTests",
+    "-editorTestsResultFile", results_path,
+    "-logFile", log_path,
+  ]
+  if fixtures is not None:
+    args += ["-editorTestsFilter", ";".join(fixtures)]
+  code = env.unity(args, allow_failure = True)
+  if not os.path.isfile(results_path):
+    return (code, [])
+  return (code, editor_tests.parse_results(results_path))
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(description = "Runs Unity editor tests.")
+  parser.add_argument("--shards", type = int, default = 1,
+                      help = "Number of Unity instances to split the tests " +
+                             "across")
+  parser.add_argument("--workspace", action = "append",
+                      help = "Staging workspace to run a shard in, which " +
+                             "the caller has locked and synced. May be " +
+                             "repeated. By default, workspaces are locked " +
+                             "and synced when there is more than one shard.")
+  args = parser.parse_args(argv)
+
+  lease = None
+  workspaces = args.workspace
+  if not workspaces and args.shards > 1:
+    lease = staging.acquire_workspaces(env, args.shards)
+    workspaces = lease.paths
+    code = lib.run_script(env, env.script("copy_to_staging_area.py"),
+                          [argument for workspace in workspaces
+                           for argument in ["--workspace", workspace]])
+    if code != 0:
+      sys.exit(code)
+  client = os.path.relpath(env.client_root, env.project_root)
+  roots = ([os.path.join(workspace, client) for workspace in workspaces]
+           if workspaces else [env.client_root])
+  roots = roots[:args.shards]
 
-print("\nRunning Unity editor tests...\n")
+  started = time.time()
+  discovered = set()
+  unnamed = []
+  if len(roots) > 1:
+    (discovered, unnamed) = editor_tests.discover_fixtures(
+      fileindex.load(env), os.path.join(env.assets_dir_path, "Tests"))
+  if len(roots) == 1 or unnamed:
+    if unnamed:
+      print("Warning: Not sharding, since these test classes can't be " +
+            "named in a filter:\n  " + "\n  ".join(unnamed))
+    plan = [(None, None)]
+  else:
+    estimates = editor_tests.fixture_estimates(env, discovered)
+    plan = editor_tests.make_shards(estimates, len(roots)) or [(None, None)]
 
-result = env.unity([
-  "-batchmode",
-  "-quit", # Documentation says this isn't required, but it's wrong :)
-  "-projectPath", env.client_root,
-  "-runEditorTests"
-])
+  print("\nRunning Unity editor tests" +
+        (" in " + str(len(plan)) + " shards" if len(plan) > 1 else "") +
+        "...\n")
+  for (index, (expected, fixtures)) in enumerate(plan):
+    if fixtures is not None:
+      print("Shard " + str(index) + " (" + roots[index] + ", about " +
+            lib.format_duration(expected) + "): " + ", ".join(fixtures))
+
+  # A shard which fails to run at all counts as a Unity failure.
+  outcomes = [(1, [])] * len(plan)
+  step = lib.current_step()
+  def shard(index):
+    with lib.in_step(step):
+      outcomes[index] = run_shard(env, roots[index], plan[index][1])
+  threads = [threading.Thread(target = shard, args = (index,))
+             for index in range(len(plan))]
+  try:
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    if lease:
+      lease.release()
+
+  codes = [code for (code, results) in outcomes]
+  results = [result for (code, results) in outcomes for result in results]
+  if results:
+    run_id = editor_tests.record(env, results, started, len(plan))
+    editor_tests.print_report(results,
+                              editor_tests.slowdowns(env, results, run_id))
+  # A fixture in the test sources which reported nothing was not matched by
+  # its shard's filter, so its tests did not run.
+  missing = editor_tests.missing_fixtures(
+    [fixture for (expected, fixtures) in plan if fixtures
+     for fixture in fixtures if fixture in discovered], results)
+  for fixture in missing:
+    print("Error: No results for fixture " + fixture + ". Run without " +
+          "--shards to run every test.")
+  for (index, code) in enumerate(codes):
+    if code != 0:
+      print("Error: Unity exited with code " + str(code) +
+            (" in shard " + str(index) if len(plan) > 1 else "") + ". See " +
+            os.path.join(roots[index], "Logs", "Editor.log"))
+  if (any(codes) or missing or
+      any(result.status == "failed" for result in results)):
+    sys.exit(max(codes) or 1)
 
-if result == 0:
   print("Editor tests passed!")
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -1,49 +1,69 @@
 #!/usr/bin/env python2.7
 import argparse
-import os
-import subprocess
+import multiprocessing
+import sys
+import time
 import lib
-env = lib.init()
+import integration
 
-parser = argparse.ArgumentParser(
-  description="Runs recording-based integration tests.")
-parser.add_argument("--test",
-                    help="Test to run, or 'all', or 'changed'",
-                    required=True)
-parser.add_argument("--verbose",
-                    action="store_true",
-                    help="Should tests be run in verbose mode?")
-args = parser.parse_args()
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description="Runs recording-based integration tests.")
+  parser.add_argument("--test",
+                      help="Test to run, or 'all', or 'changed'",
+                      required=True)
+  parser.add_argument("--verbose",
+                      action="store_true",
+                      help="Should tests be run in verbose mode?")
+  parser.add_argument("--jobs",
+                      type=int,
+                      default=max(1, multiprocessing.cpu_count() // 2),
+                      help="Number of clients to run at once")
+  parser.add_argument("--isolated",
+                      action="store_true",
+                      help="Run each test on its own client instead of " +
+                           "sharing prerequisites between tests")
+  parser.add_argument("--base",
+                      default="HEAD",
+                      help="Commit to compare against for '--test changed'")
+  args = parser.parse_args(argv)
 
-print("\nRunning integration test(s) '" + args.test + "'...\n")
+  print("\nRunning integration test(s) '" + args.test + "'...\n")
 
-client_logs = os.path.join(env.client_binary_path, "Logs")
-lib.rm(os.path.join(client_logs, "client_logs.txt"))
-lib.mkdirs(client_logs)
+  recordings = integration.load_recordings(env.tests_root)
+  if args.test == "all":
+    tests = integration.top_level_tests(recordings)
+  elif args.test == "changed":
+    tests = integration.changed_tests(env, recordings, args.base)
+    if not tests:
+      print("No integration tests are affected by changes since " + args.base)
+      return
+  else:
+    tests = [name if name.endswith(".edn") else name + ".edn"
+             for name in args.test.split(",")]
 
-driver_logs = os.path.join(env.driver_jar_path, "logs")
-lib.rm(os.path.join(driver_logs, "driver_logs.txt"))
-lib.mkdirs(driver_logs)
+  # Unknown tests and broken prerequisites are reported before the builds.
+  for test in tests:
+    try:
+      integration.prerequisite_chain(recordings, test)
+    except ValueError as e:
+      print("Error: " + str(e))
+      sys.exit(1)
 
-lib.call([env.script("build_unity_client.py")])
-lib.call([env.script("build_driver_jar.py")])
+  for script in ["build_unity_client.py", "build_driver_jar.py"]:
+    result = lib.run_script(env, env.script(script))
+    if result != 0:
+      sys.exit(result)
 
-client = subprocess.Popen([
-  os.path.join(env.client_binary_path, "Contents", "MacOS", "dungeonstrike"),
-  "-batchmode",
-  "--port", "59009",
-])
+  start = time.time()
+  results = integration.run_tests(env, tests, args.jobs, args.verbose,
+                                  args.isolated)
+  lib.print_task_summary(results, time.time() - start)
+  failed = [r for r in results if r.status not in lib.SUCCESS_STATUSES]
+  for result in failed:
+    print("Logs for '" + result.name + "': " + str(result.output))
+  if failed:
+    sys.exit(1)
 
-print("Started client with pid " + str(client.pid) + "\n")
-verbose = ["--verbose"] if args.verbose else []
-
-lib.call([
-  "java",
-  "-jar", os.path.join(env.driver_jar_path, "driver.jar"),
-  "--crash-on-exceptions",
-  "--port", "59009",
-  "--client-path", env.client_binary_path,
-  "--driver-path", env.driver_jar_path,
-  "--tests-path", env.tests_root,
-  "--test", args.test
-] + verbose)
+if __name__ == "__main__":
+  main(lib.init())
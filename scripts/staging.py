@@ -0,0 +1,315 @@
+"""Incremental snapshots of the project tree into a staging directory. A
+   manifest of the previous snapshot is kept in the staging directory so that
+   only files which changed since then are copied. Files under 'link_prefixes'
+   (third party assets, which are never edited) are hardlinked or reflinked
+   instead of copied.
+
+   There is a pool of staging directories ("workspaces"), so that Unity can
+   have several copies of the project open at once. Each workspace keeps its
+   own Unity Library cache between runs, and is locked by the process using
+   it."""
+
+import collections
+import ctypes
+import errno
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+MANIFEST_NAME = ".staging_manifest.json"
+
+SyncStats = collections.namedtuple(
+  "SyncStats", ["copied_files", "copied_bytes", "linked_files", "linked_bytes",
+                "reused_files", "reused_bytes", "deleted_files"])
+
+def _stat_key(stat):
+  return [stat.st_size, stat.st_mtime]
+
+def _scan(root, exclude):
+  """Returns a tuple of a dictionary from path relative to 'root' to lstat
+  result for every file and symlink under 'root', and a list of the relative
+  paths of every directory under 'root'."""
+  result = {}
+  directories = []
+  for (dirpath, dirnames, filenames) in os.walk(root):
+    relative = os.path.relpath(dirpath, root)
+    if relative == ".":
+      relative = ""
+    kept = []
+    for name in dirnames:
+      path = os.path.join(relative, name)
+      if path in exclude: continue
+      if os.path.islink(os.path.join(dirpath, name)):
+        filenames.append(name)
+      else:
+        kept.append(name)
+        directories.append(path)
+    dirnames[:] = kept
+    for name in filenames:
+      path = os.path.join(relative, name)
+      if path in exclude or path == MANIFEST_NAME: continue
+      result[path] = os.lstat(os.path.join(dirpath, name))
+  return (result, directories)
+
+# The Linux ioctl which makes a file share another file's extents.
+FICLONE = 0x40049409
+
+# Errors meaning that a filesystem can't make copy-on-write clones.
+_CLONE_UNSUPPORTED = set([errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV,
+                          errno.EINVAL, errno.ENOTTY, errno.ENOSYS])
+
+# Whether cloning works, keyed by the devices of the source and destination.
+_clone_support = {}
+
+def _path_bytes(path):
+  return path if isinstance(path, bytes) else path.encode("utf-8")
+
+def _clone(source, destination):
+  """Makes 'destination' a copy-on-write clone of 'source', raising OSError
+  if that is not possible."""
+  if sys.platform == "darwin":
+    libc = ctypes.CDLL(None, use_errno = True)
+    if libc.clonefile(_path_bytes(source), _path_bytes(destination), 0) != 0:
+      code = ctypes.get_errno()
+      raise OSError(code, os.strerror(code))
+  elif sys.platform.startswith("linux"):
+    try:
+      with open(source, "rb") as input_file:
+        with open(destination, "wb") as output_file:
+          fcntl.ioctl(output_file.fileno(), FICLONE, input_file.fileno())
+    except (IOError, OSError):
+      if os.path.lexists(destination):
+        os.remove(destination)
+      raise
+    shutil.copystat(source, destination)
+  else:
+    raise OSError(errno.EOPNOTSUPP, "Cloning is not supported")
+
+def _reflink(source, destination):
+  """Makes a copy-on-write clone of 'source' in this process. Returns False if
+  the filesystem does not support it. Support is only tried once for each
+  pair of source and destination filesystems, so copying to a filesystem
+  without clones costs no more than a plain copy."""
+  key = (os.stat(source).st_dev,
+         os.stat(os.path.dirname(destination) or ".").st_dev)
+  if _clone_support.get(key) is False:
+    return False
+  try:
+    _clone(source, destination)
+  except (IOError, OSError) as e:
+    if e.errno not in _CLONE_UNSUPPORTED:
+      raise
+    _clone_support[key] = False
+    return False
+  _clone_support[key] = True
+  return True
+
+def place(source, destination, link_mode):
+  """Puts a copy of 'source' at 'destination' using 'link_mode' ('hardlink',
+  'reflink' or 'copy'). Returns True if the file was linked rather than
+  copied."""
+  if os.path.isdir(destination) and not os.path.islink(destination):
+    # The path was a directory in the previous sync.
+    shutil.rmtree(destination)
+  elif os.path.lexists(destination):
+    # Never write through an existing hardlink into the source tree.
+    os.remove(destination)
+  parent = os.path.dirname(destination)
+  if not os.path.isdir(parent):
+    if os.path.lexists(parent):
+      # The parent directory was a file, or a symlink, in the previous sync.
+      os.remove(parent)
+    os.makedirs(parent)
+  if os.path.islink(source):
+    os.symlink(os.readlink(source), destination)
+    return False
+  if link_mode == "hardlink":
+    try:
+      os.link(source, destination)
+      return True
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+  elif link_mode == "reflink" and _reflink(source, destination):
+    return True
+  shutil.copy2(source, destination)
+  return False
+
+def _load_manifest(destination):
+  try:
+    with open(os.path.join(destination, MANIFEST_NAME)) as manifest_file:
+      return json.load(manifest_file)
+  except (IOError, ValueError):
+    return {}
+
+def scan(source, exclude = ()):
+  """Lists 'source' for 'sync', so that it can be synced to several
+  destinations without being listed again."""
+  return _scan(source, set(exclude))
+
+def sync(source, destination, link_prefixes = (), link_mode = "hardlink",
+         exclude = (), source_scan = None):
+  """Makes 'destination' a copy of 'source', deleting anything in
+  'destination' which is not in 'source'. Files are only copied if they
+  changed in either tree since the previous sync. Paths starting with one of
+  'link_prefixes' are placed with 'link_mode'. Paths in 'exclude' are left
+  untouched in the destination. 'source_scan' is the result of 'scan' for
+  'source' and 'exclude', if already known. Returns a SyncStats."""
+  if not os.path.isdir(destination):
+    os.makedirs(destination)
+  exclude = set(exclude)
+  manifest = _load_manifest(destination)
+  (source_files, source_directories) = source_scan or _scan(source, exclude)
+  destination_files = _scan(destination, exclude)[0]
+  updated = {}
+  counts = collections.Counter()
+
+  for (path, stat) in sorted(source_files.items()):
+    source_key = _stat_key(stat)
+    previous = manifest.get(path)
+    current = destination_files.get(path)
+    if (previous and current and previous[0] == source_key and
+        previous[1] == _stat_key(current)):
+      updated[path] = previous
+      counts["reused_files"] += 1
+      counts["reused_bytes"] += stat.st_size
+      continue
+    linked = False
+    if any(path.startswith(prefix) for prefix in link_prefixes):
+      linked = place(os.path.join(source, path),
+                      os.path.join(destination, path), link_mode)
+    else:
+      place(os.path.join(source, path), os.path.join(destination, path),
+             "copy")
+    kind = "linked" if linked else "copied"
+    counts[kind + "_files"] += 1
+    counts[kind + "_bytes"] += stat.st_size
+    updated[path] = [
+      source_key, _stat_key(os.lstat(os.path.join(destination, path)))]
+
+  for path in destination_files:
+    if path not in source_files:
+      target = os.path.join(destination, path)
+      # Files which were replaced by a directory, or were in a directory
+      # replaced by a file, are already gone.
+      if os.path.lexists(target) and (os.path.islink(target) or
+                                      not os.path.isdir(target)):
+        os.remove(target)
+      counts["deleted_files"] += 1
+  _remove_empty_directories(source, destination, exclude)
+  for path in source_directories:
+    if not os.path.isdir(os.path.join(destination, path)):
+      os.makedirs(os.path.join(destination, path))
+
+  tmp = os.path.join(destination, MANIFEST_NAME + ".tmp")
+  with open(tmp, "w") as manifest_file:
+    json.dump(updated, manifest_file)
+  os.rename(tmp, os.path.join(destination, MANIFEST_NAME))
+  return SyncStats(*[counts[field] for field in SyncStats._fields])
+
+def _remove_empty_directories(source, destination, exclude):
+  """Removes directories in 'destination' which do not exist in 'source'."""
+  for (dirpath, dirnames, filenames) in os.walk(destination, topdown = False):
+    relative = os.path.relpath(dirpath, destination)
+    if relative == "." or any(relative == path or
+                              relative.startswith(path + os.sep)
+                              for path in exclude): continue
+    if not os.path.isdir(os.path.join(source, relative)):
+      try:
+        os.rmdir(dirpath)
+      except OSError:
+        pass
+
+def print_stats(stats):
+  """Prints a summary of the work done by 'sync'."""
+  def megabytes(count):
+    return str(round(count / (1024.0 * 1024.0), 1)) + " MB"
+  print("Copied " + str(stats.copied_files) + " files (" +
+        megabytes(stats.copied_bytes) + "), linked " +
+        str(stats.linked_files) + " files (" +
+        megabytes(stats.linked_bytes) + "), reused " +
+        str(stats.reused_files) + " files (" +
+        megabytes(stats.reused_bytes) + "), deleted " +
+        str(stats.deleted_files) + " files.")
+
+def workspace_paths(env):
+  """Returns the paths of the staging workspaces. The first is
+  'staging_path', and the others are named after it."""
+  return [env.staging_path] + [env.staging_path + "-" + str(index)
+                               for index in range(1, env.staging_workspaces)]
+
+def workspace_excludes(env):
+  """Returns the paths, relative to the project root, which belong to each
+  workspace rather than being copied from the project: the Unity caches and
+  logs, which Unity rewrites whenever it opens the workspace."""
+  client = os.path.relpath(env.client_root, env.project_root)
+  return [os.path.join(client, name) for name in ["Library", "Temp", "Logs"]]
+
+def seed_library(env, workspace, link_mode = "reflink"):
+  """Gives a new workspace a copy of the project's Unity Library, so that
+  Unity doesn't reimport every asset the first time it opens the workspace.
+  Returns True if the Library was copied."""
+  library = os.path.join(env.client_root, "Library")
+  target = os.path.join(workspace, os.path.relpath(library, env.project_root))
+  if os.path.isdir(target) or not os.path.isdir(library):
+    return False
+  sync(library, target, link_prefixes = [""], link_mode = link_mode)
+  os.remove(os.path.join(target, MANIFEST_NAME))
+  return True
+
+class Lease(object):
+  """Exclusive locks on a set of staging workspaces, held until 'release' is
+  called or the process exits."""
+  def __init__(self, paths, lock_files):
+    self.paths = paths
+    self.lock_files = lock_files
+
+  def release(self):
+    for lock_file in self.lock_files:
+      lock_file.close()
+    self.lock_files = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+def _try_lock(path):
+  lock_file = open(path + ".lock", "a")
+  try:
+    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return lock_file
+  except IOError as e:
+    lock_file.close()
+    if e.errno not in (errno.EAGAIN, errno.EACCES):
+      raise
+    return None
+
+def acquire_workspaces(env, count):
+  """Locks 'count' free staging workspaces, waiting for other processes to
+  release theirs if needed. Returns a Lease."""
+  count = min(count, env.staging_workspaces)
+  parent = os.path.dirname(os.path.abspath(env.staging_path))
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+  waiting = False
+  while True:
+    paths = []
+    lock_files = []
+    for path in workspace_paths(env):
+      lock_file = _try_lock(path)
+      if lock_file:
+        paths.append(path)
+        lock_files.append(lock_file)
+        if len(paths) == count:
+          return Lease(paths, lock_files)
+    for lock_file in lock_files:
+      lock_file.close()
+    if not waiting:
+      print("Waiting for another process to release a staging workspace...")
+      waiting = True
+    time.sleep(1)
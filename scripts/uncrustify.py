@@ -1,48 +1,140 @@
 #!/usr/bin/env python2.7
+"""Checks the formatting of C# source files using uncrustify. Files are
+formatted in parallel and compared in memory, and all formatting errors are
+reported together."""
+
+import argparse
+import difflib
+import multiprocessing
 import os
+import sys
 import tempfile
+from multiprocessing.pool import ThreadPool
+import fileindex
 import lib
-env = lib.init()
-
-source = os.path.join(env.client_root, "Assets", "Source")
-
-print("Checking C# source code formatting...")
-
-for (dirpath, dirname, filenames) in os.walk(source):
-  for name in filenames:
-    if name.endswith(".cs") and not lib.is_generated(name):
-      path = os.path.join(dirpath, name)
-      tmp = tempfile.NamedTemporaryFile()
-      lib.call([
-        "uncrustify",
-        "-l", "CS",
-        "-c", os.path.join(env.scripts_root, "uncrustify.cfg"),
-        "-q",
-        "-o", tmp.name,
-        "-f", path
-      ])
-      devnull = open(os.devnull, 'wb')
-      result = lib.call_unchecked(["diff", path, tmp.name], stdout=devnull)
-      if result:
-        print("Formatting error in " + name)
-        while True:
-          response = lib.input_prompt(
-            "[s]how/[f]ix/[n]ext/[q]uit:",
-            validator=lambda x: x[0] in ["s", "f", "n", "q"],
-            invalid_message="Please enter s, f, n, or q.")
-          if response.startswith("s"):
-            lib.call_unchecked(["diff", "-C", "3", path, tmp.name])
-          elif response.startswith("f"):
-            print("Reformatting " + name)
-            lib.call([
-              "uncrustify",
-              "-l", "CS",
-              "-c", os.path.join(env.scripts_root, "uncrustify.cfg"),
-              "-q", "--no-backup",
-              path
-            ])
-            break
-          elif response.startswith("n"):
-            break
-          else:
-            exit(1)
+
+def uncrustify_command(env):
+  return [
+    "uncrustify",
+    "-l", "CS",
+    "-c", os.path.join(env.scripts_root, "uncrustify.cfg"),
+    "-q"
+  ]
+
+def source_files(env, source):
+  """Returns the paths of all non-generated C# source files under 'source'."""
+  return [path for path in fileindex.load(env).files(source, [".cs"])
+          if not lib.is_generated(os.path.basename(path))]
+
+def check(uncrustify, path):
+  """Formats the file at 'path' in memory. Returns a tuple of (path, original
+  contents, formatted contents)."""
+  # The formatted file goes through a temporary file rather than a pipe, so
+  # that the process is supervised by lib and its output is kept byte-exact.
+  with tempfile.TemporaryFile() as output:
+    if lib.call_unchecked(uncrustify + ["-f", path], stdout = output) != 0:
+      return (path, None, None)
+    output.seek(0)
+    formatted = output.read()
+  with open(path, "rb") as source_file:
+    return (path, source_file.read(), formatted)
+
+def diff(env, path, original, formatted, context = 0):
+  """Returns a diff between the original and formatted file contents."""
+  name = os.path.relpath(path, env.project_root)
+  return "".join(difflib.unified_diff(
+    original.decode("utf-8", "replace").splitlines(True),
+    formatted.decode("utf-8", "replace").splitlines(True),
+    name, name + " (formatted)", n = context))
+
+def fix_all(pool, uncrustify, paths, jobs):
+  """Reformats the files in 'paths' in place, splitting them across parallel
+  uncrustify invocations."""
+  chunks = [paths[i::jobs] for i in range(jobs)]
+  results = pool.map(
+    lambda chunk: lib.call_unchecked(uncrustify + ["--no-backup"] + chunk),
+    [chunk for chunk in chunks if chunk])
+  if any(results):
+    print("Error running uncrustify.")
+    sys.exit(1)
+
+def prompt(env, path, original, formatted):
+  """Asks the user what to do about a formatting error. Returns False if the
+  user chose to quit."""
+  name = os.path.basename(path)
+  print("Formatting error in " + name)
+  while True:
+    response = lib.input_prompt(
+      "[s]how/[f]ix/[n]ext/[q]uit:",
+      validator=lambda x: x[0] in ["s", "f", "n", "q"],
+      invalid_message="Please enter s, f, n, or q.")
+    if response.startswith("s"):
+      print(diff(env, path, original, formatted, context = 3))
+    elif response.startswith("f"):
+      print("Reformatting " + name)
+      with open(path, "wb") as source_file:
+        source_file.write(formatted)
+      return True
+    elif response.startswith("n"):
+      return True
+    else:
+      return False
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Checks C# source formatting.")
+  parser.add_argument("--fix-all", action = "store_true",
+                      help = "Reformat every file with formatting errors")
+  parser.add_argument("--interactive", action = "store_true",
+                      help = "Prompt to show or fix each formatting error")
+  parser.add_argument("--jobs", type = int,
+                      default = multiprocessing.cpu_count(),
+                      help = "Number of uncrustify processes to run at once")
+  args = parser.parse_args(argv)
+
+  source = os.path.join(env.client_root, "Assets", "Source")
+  uncrustify = uncrustify_command(env)
+
+  print("Checking C# source code formatting...")
+
+  pool = ThreadPool(args.jobs)
+  try:
+    with lib.span("format check", "lint"):
+      results = pool.map(lambda path: check(uncrustify, path),
+                         source_files(env, source))
+
+    failures = [path for (path, original, formatted) in results
+                if original is None]
+    for path in failures:
+      print("Error: uncrustify failed on " + path)
+
+    errors = [result for result in results
+              if result[1] is not None and result[1] != result[2]]
+
+    if args.fix_all:
+      if errors:
+        print("Reformatting " + str(len(errors)) + " files...")
+        fix_all(pool, uncrustify,
+                [path for (path, original, formatted) in errors], args.jobs)
+      errors = []
+    elif args.interactive:
+      for (path, original, formatted) in errors:
+        if not prompt(env, path, original, formatted):
+          sys.exit(1)
+      errors = []
+    else:
+      for (path, original, formatted) in errors:
+        print(diff(env, path, original, formatted))
+  finally:
+    pool.close()
+
+  if errors:
+    print(str(len(errors)) + " files have formatting errors. Run " +
+          "'scripts/uncrustify.py --fix-all' to fix them.")
+  if errors or failures:
+    sys.exit(1)
+
+  print("C# formatting OK!")
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python2.7
+"""Watches the project for changes and keeps the results of the linter, the
+ThirdParty checksums and the generated asset references up to date as files
+are saved. Only changed files are relinted and rehashed, and asset references
+are regenerated when an asset is added to or removed from a directory listed
+in assets.json. Results are published to a status file which presubmit.py
+uses in place of running those steps itself."""
+
+import argparse
+import json
+import os
+import sys
+import time
+import checksum
+import fileindex
+import lib
+import lint
+import linter
+import watcher
+
+class Checks(object):
+  """The current results of each watched check. Each result is a dictionary
+  with an 'ok' flag and a list of 'errors'."""
+  def __init__(self, env):
+    self.env = env
+    self.linter = linter.Linter(lint.RULES)
+    self.lint_roots = lint.trees(env)
+    self.lint_errors = {}
+    self.third_party = checksum.third_party_root(env)
+    self.checksum_errors = {}
+    self.asset_config = None
+    self.asset_files = set()
+    self.asset_result = None
+
+  def _format(self, violation):
+    return (os.path.relpath(violation.path, self.env.project_root) + ":" +
+            str(violation.line) + " " + violation.message)
+
+  def _lint_rules(self, path):
+    """Returns the lint rules which apply to 'path', or None."""
+    if lib.is_generated(os.path.basename(path)):
+      return None
+    if not any(path.startswith(root + os.sep) for root in self.lint_roots):
+      return None
+    return self.linter.rules.get(os.path.splitext(path)[1])
+
+  def lint_all(self):
+    self.lint_errors = {}
+    for violation in self.linter.lint_trees(fileindex.load(self.env),
+                                            self.lint_roots):
+      self.lint_errors.setdefault(violation.path, []).append(
+        self._format(violation))
+
+  def lint(self, path):
+    """Relints the file at 'path'. Returns True if it is a source file."""
+    rules = self._lint_rules(path)
+    if not rules:
+      return False
+    self.lint_errors.pop(path, None)
+    if os.path.isfile(path):
+      errors = [self._format(violation)
+                for violation in self.linter.lint_file(path, *rules)]
+      if errors:
+        self.lint_errors[path] = errors
+    return True
+
+  def verify(self, vendors):
+    """Verifies the vendor directories in 'vendors' against their checksums,
+    rehashing only files which changed."""
+    current = set(checksum.vendors(self.env))
+    for vendor in vendors:
+      self.checksum_errors.pop(vendor, None)
+      if vendor not in current: continue
+      (errors, rehashed) = checksum.verify(self.env, vendor)
+      self.checksum_errors[vendor] = errors
+
+  def vendor(self, path):
+    """Returns the vendor directory affected by a change to 'path', or
+    None."""
+    if path.startswith(self.third_party + os.sep):
+      parts = os.path.relpath(path, self.third_party).split(os.sep)
+      return parts[0] if len(parts) > 1 else None
+    if (os.path.dirname(path) == self.env.checksums_root and
+        path.endswith(".svf")):
+      return os.path.splitext(os.path.basename(path))[0]
+    return None
+
+  def load_asset_config(self):
+    """Reads assets.json and lists the files it refers to."""
+    try:
+      with open(self.env.asset_config_path) as config_file:
+        self.asset_config = json.load(config_file)
+    except (IOError, ValueError):
+      self.asset_config = {"dirs": []}
+    self.asset_files = set()
+    for (root, config) in self._asset_dirs():
+      for (dirpath, dirnames, filenames) in os.walk(root):
+        for name in filenames:
+          path = os.path.join(dirpath, name)
+          if self._is_asset(path, root, config):
+            self.asset_files.add(path)
+
+  def _asset_dirs(self):
+    return [(os.path.join(self.env.assets_dir_path, config["path"]), config)
+            for config in self.asset_config["dirs"]]
+
+  def _is_asset(self, path, root, config):
+    extension = os.path.splitext(path)[1][1:].lower()
+    return (path.startswith(root + os.sep) and
+            extension in [e.lower() for e in config["extensions"]])
+
+  def asset_changed(self, path):
+    """Returns True if 'path' is an asset listed by assets.json which was
+    added or removed."""
+    if not any(self._is_asset(path, root, config)
+               for (root, config) in self._asset_dirs()):
+      return False
+    exists = os.path.isfile(path)
+    if exists == (path in self.asset_files):
+      return False
+    if exists:
+      self.asset_files.add(path)
+    else:
+      self.asset_files.discard(path)
+    return True
+
+  def generate_asset_references(self):
+    (code, output) = lib.run_script(
+      self.env, self.env.script("generate_asset_references.py"),
+      capture = True)
+    errors = []
+    if code:
+      lines = output.strip().splitlines()
+      errors = ([line for line in lines if line.startswith("Error")] or
+                lines[-1:])
+    self.asset_result = {"ok": code == 0, "errors": errors}
+
+  def update_all(self):
+    self.lint_all()
+    self.checksum_errors = {}
+    self.verify(checksum.vendors(self.env))
+    self.load_asset_config()
+    self.generate_asset_references()
+
+  def update(self, paths):
+    """Updates the checks affected by changes to 'paths'. Returns the names
+    of the checks which were run."""
+    updated = set()
+    vendors = set()
+    regenerate = False
+    if self.env.asset_config_path in paths:
+      self.load_asset_config()
+      regenerate = True
+    for path in paths:
+      if self.lint(path):
+        updated.add("lint")
+      vendor = self.vendor(path)
+      if vendor:
+        vendors.add(vendor)
+      if self.asset_changed(path):
+        regenerate = True
+    if vendors:
+      self.verify(vendors)
+      updated.add("checksum")
+    if regenerate:
+      self.generate_asset_references()
+      updated.add("asset_references")
+    return updated
+
+  def results(self):
+    lint_errors = sorted(error for errors in self.lint_errors.values()
+                         for error in errors)
+    checksum_errors = sorted(error for errors in self.checksum_errors.values()
+                             for error in errors)
+    return {
+      "lint": {"ok": not lint_errors, "errors": lint_errors},
+      "checksum": {"ok": not checksum_errors, "errors": checksum_errors},
+      "asset_references": self.asset_result,
+    }
+
+def print_results(results, names):
+  for name in sorted(names):
+    result = results[name]
+    print(time.strftime("%H:%M:%S") + " " + name + ": " +
+          ("OK" if result["ok"] else
+           str(len(result["errors"])) + " error(s)"))
+    for error in result["errors"]:
+      print("  " + error)
+
+def main(env, argv = None):
+  parser = argparse.ArgumentParser(
+    description = "Keeps lint, checksum and asset reference results up to " +
+                  "date as files change.")
+  parser.add_argument("--poll", action = "store_true",
+                      help = "Poll for changes instead of using inotify " +
+                             "or FSEvents")
+  parser.add_argument("--interval", type = float, default = 1.0,
+                      help = "Minimum seconds between scans when polling. " +
+                             "Scans are spaced further apart if they are " +
+                             "slow, and Assets/ThirdParty is only scanned " +
+                             "every 30 seconds or when presubmit asks for " +
+                             "results.")
+  args = parser.parse_args(argv)
+
+  running = watcher.read_status(env)
+  if running and running["pid"] != os.getpid():
+    print("Error: Already watching in process " + str(running["pid"]))
+    sys.exit(1)
+
+  lib.mkdirs(watcher.status_root(env))
+  # The status directory is watched first so that, when polling, a sync
+  # request is seen no later than the changes made before it.
+  roots = [watcher.status_root(env), env.scripts_root, env.assets_dir_path,
+           os.path.join(env.driver_root, "src"),
+           os.path.join(env.driver_root, "test"), env.checksums_root]
+  watch = watcher.create(roots, args.poll, args.interval,
+                         slow_roots = [checksum.third_party_root(env)],
+                         barrier_paths = [watcher.sync_path(env)])
+
+  print("Running all checks...")
+  checks = Checks(env)
+  checks.update_all()
+  status = {"pid": os.getpid(), "mode": watch.mode, "started": time.time(),
+            "synced": None, "checks": checks.results()}
+  watcher.write_status(env, status)
+  print_results(status["checks"], status["checks"].keys())
+  print("Watching for changes (" + watch.mode + "). Press Ctrl-C to stop.")
+
+  status_prefix = watcher.status_root(env) + os.sep
+  scripts_prefix = env.scripts_root + os.sep
+  try:
+    while True:
+      changed = watch.wait()
+      if changed and any(path.startswith(scripts_prefix) and
+                         path.endswith(".py") for path in changed):
+        # The checks themselves changed, so the results are out of date.
+        print("Scripts changed, restarting...")
+        watch.close()
+        lib.rm(watcher.status_path(env))
+        os.execv(sys.executable,
+                 [sys.executable, env.script("watch.py")] + sys.argv[1:])
+      if changed is None:
+        print("Events were lost, running all checks...")
+        checks.update_all()
+        updated = set(status["checks"].keys())
+        changed = set()
+      else:
+        paths = set(path for path in changed
+                    if not path.startswith(status_prefix))
+        updated = checks.update(paths) if paths else set()
+      if (watcher.sync_path(env) in changed and
+          os.path.isfile(watcher.sync_path(env))):
+        with open(watcher.sync_path(env)) as sync_file:
+          status["synced"] = sync_file.read()
+      elif not updated:
+        continue
+      status["checks"] = checks.results()
+      watcher.write_status(env, status)
+      print_results(status["checks"], updated)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    watch.close()
+    lib.rm(watcher.status_path(env))
+
+if __name__ == "__main__":
+  main(lib.init())
@@ -0,0 +1,436 @@
+"""Filesystem change notification for 'scripts/watch.py', plus the status file
+   it publishes. Changes are delivered through ctypes by inotify on Linux and
+   by FSEvents on macOS. If neither is available, the watched trees are polled
+   by comparing the size and mtime of every file. Large trees which rarely
+   change, such as Assets/ThirdParty, can be polled less often than the
+   rest, and the polling interval grows with the cost of a scan.
+
+   Callers such as presubmit.py use 'sync' to wait until the watch daemon has
+   processed every change made before the call, and then read its results."""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import sys
+import time
+import uuid
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+# Changes are collected until no event has arrived for this many seconds, so
+# that an editor saving several files results in a single update.
+SETTLE_SECONDS = 0.2
+
+# When polling, the time between scans is at least this many times the time a
+# scan takes, so that polling uses a small fraction of a core however large
+# the watched trees are.
+POLL_COST_RATIO = 20
+
+# FSEvents constants, from FSEvents.h.
+FSEVENTS_SINCE_NOW = 0xFFFFFFFFFFFFFFFF
+FSEVENTS_NO_DEFER = 0x02
+FSEVENTS_WATCH_ROOT = 0x04
+FSEVENTS_FILE_EVENTS = 0x10
+FSEVENTS_MUST_SCAN_SUBDIRS = 0x01
+FSEVENTS_USER_DROPPED = 0x02
+FSEVENTS_KERNEL_DROPPED = 0x04
+FSEVENTS_ROOT_CHANGED = 0x20
+CF_STRING_ENCODING_UTF8 = 0x08000100
+
+def _ignored(name):
+  return name.startswith(".") or name.endswith("~")
+
+class PollingWatcher(object):
+  """Detects changes by rescanning the watched trees. Roots are scanned in
+  order, so a change seen in one root was made before every change missed in
+  the roots after it.
+
+  The trees under 'slow_roots' are only rescanned every 'slow_interval'
+  seconds, or when one of 'barrier_paths' changes, so that a change to a
+  barrier path is reported together with every change made before it. Other
+  trees are rescanned every 'interval' seconds, or less often if a scan is
+  slow (see POLL_COST_RATIO)."""
+  mode = "polling"
+
+  def __init__(self, roots, interval = 1.0, slow_roots = (),
+               slow_interval = 30.0, barrier_paths = ()):
+    self.roots = list(roots)
+    self.interval = interval
+    self.slow_roots = set(slow_roots)
+    self.slow_interval = slow_interval
+    self.barrier_paths = set(barrier_paths)
+    self.snapshot = {}
+    self.snapshot = self._scan(True)
+    self.next_slow_scan = time.time() + slow_interval
+
+  def _is_slow(self, path):
+    return any(path == root or path.startswith(root + os.sep)
+               for root in self.slow_roots)
+
+  def _scan(self, slow):
+    """Returns the size and mtime of every watched file. Unless 'slow' is
+    set, the entries under 'slow_roots' are copied from the last scan."""
+    snapshot = {}
+    for root in self.roots:
+      for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not _ignored(name) and
+                       (slow or not self._is_slow(os.path.join(dirpath,
+                                                               name)))]
+        for name in filenames:
+          path = os.path.join(dirpath, name)
+          try:
+            stat = os.lstat(path)
+          except OSError:
+            continue
+          snapshot[path] = (stat.st_size, stat.st_mtime)
+    if not slow:
+      for (path, stamp) in self.snapshot.items():
+        if self._is_slow(path):
+          snapshot[path] = stamp
+    return snapshot
+
+  def wait(self, timeout = None):
+    """Blocks until a file changes or 'timeout' seconds elapse. Returns the
+    set of paths which were created, modified or deleted."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      start = time.time()
+      slow = start >= self.next_slow_scan
+      snapshot = self._scan(slow)
+      changed = set(path for path in set(snapshot) | set(self.snapshot)
+                    if snapshot.get(path) != self.snapshot.get(path))
+      if not slow and self.slow_roots and changed & self.barrier_paths:
+        snapshot = self._scan(True)
+        changed = set(path for path in set(snapshot) | set(self.snapshot)
+                      if snapshot.get(path) != self.snapshot.get(path))
+        slow = True
+      cost = time.time() - start
+      if slow:
+        self.next_slow_scan = time.time() + max(self.slow_interval,
+                                                POLL_COST_RATIO * cost)
+      self.snapshot = snapshot
+      if changed:
+        return changed
+      if deadline is not None and time.time() >= deadline:
+        return set()
+      time.sleep(self.interval if slow else
+                 max(self.interval, POLL_COST_RATIO * cost))
+
+  def close(self):
+    pass
+
+class InotifyWatcher(object):
+  """Detects changes with a recursive set of inotify watches. Raises OSError
+  if inotify is unavailable or the watch limit is reached."""
+  mode = "inotify"
+
+  def __init__(self, roots):
+    library = ctypes.util.find_library("c")
+    if not library:
+      raise OSError(errno.ENOSYS, "libc not found")
+    self.libc = ctypes.CDLL(library, use_errno = True)
+    if not hasattr(self.libc, "inotify_init1"):
+      raise OSError(errno.ENOSYS, "inotify is not supported")
+    self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.roots = list(roots)
+    self.watches = {}
+    try:
+      for root in self.roots:
+        self._add_tree(root)
+    except OSError:
+      self.close()
+      raise
+
+  def _add_tree(self, root):
+    """Watches 'root' and every directory below it. Returns the paths of the
+    files found, which are new if 'root' was just created."""
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+      dirnames[:] = [name for name in dirnames if not _ignored(name)]
+      path = dirpath.encode("utf-8") if not isinstance(dirpath, bytes) \
+             else dirpath
+      wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+      if wd < 0:
+        error = ctypes.get_errno()
+        if error in (errno.ENOENT, errno.ENOTDIR): continue
+        raise OSError(error, "inotify_add_watch failed for " + dirpath)
+      self.watches[wd] = dirpath
+      files.extend(os.path.join(dirpath, name) for name in filenames)
+    return files
+
+  def _read(self):
+    """Reads the pending events. Returns None if the event queue overflowed,
+    meaning that any file may have changed."""
+    data = os.read(self.fd, 1024 * 1024)
+    changed = set()
+    offset = 0
+    while offset < len(data):
+      (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+      offset += EVENT_HEADER.size
+      name = data[offset:offset + length].rstrip(b"\0")
+      offset += length
+      if mask & IN_Q_OVERFLOW:
+        return None
+      if mask & IN_IGNORED:
+        self.watches.pop(wd, None)
+        continue
+      directory = self.watches.get(wd)
+      if directory is None or not name: continue
+      if not isinstance(directory, bytes):
+        name = name.decode("utf-8", "surrogateescape")
+      if _ignored(name): continue
+      path = os.path.join(directory, name)
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          changed.update(self._add_tree(path))
+        else:
+          # The directory's contents were deleted or moved away, and are no
+          # longer watched.
+          prefix = path + os.sep
+          for (key, value) in list(self.watches.items()):
+            if value == path or value.startswith(prefix):
+              del self.watches[key]
+          changed.add(path)
+      else:
+        changed.add(path)
+    return changed
+
+  def wait(self, timeout = None):
+    """Blocks until a file changes or 'timeout' seconds elapse. Returns the
+    set of paths which were created, modified or deleted, or None if events
+    were lost and every watched tree must be rescanned."""
+    changed = set()
+    while True:
+      wait_time = SETTLE_SECONDS if changed else timeout
+      (readable, _, _) = select.select([self.fd], [], [], wait_time)
+      if not readable:
+        return changed
+      events = self._read()
+      if events is None:
+        self._reset()
+        return None
+      changed.update(events)
+
+  def _reset(self):
+    for wd in list(self.watches):
+      self.libc.inotify_rm_watch(self.fd, wd)
+    self.watches = {}
+    for root in self.roots:
+      self._add_tree(root)
+
+  def close(self):
+    os.close(self.fd)
+
+_FSEventStreamCallback = ctypes.CFUNCTYPE(
+  None, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t,
+  ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_uint32),
+  ctypes.POINTER(ctypes.c_uint64))
+
+class FSEventsWatcher(object):
+  """Detects changes with an FSEvents stream reporting individual files,
+  delivered on a dispatch queue. Raises OSError if FSEvents is
+  unavailable."""
+  mode = "fsevents"
+
+  def __init__(self, roots):
+    def load(name):
+      library = ctypes.util.find_library(name)
+      if not library:
+        raise OSError(errno.ENOSYS, name + " not found")
+      return ctypes.CDLL(library)
+    self.cf = load("CoreFoundation")
+    self.cs = load("CoreServices")
+    self.system = load("System")
+    self.cf.CFStringCreateWithCString.restype = ctypes.c_void_p
+    self.cf.CFStringCreateWithCString.argtypes = [
+      ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint32]
+    self.cf.CFArrayCreate.restype = ctypes.c_void_p
+    self.cf.CFArrayCreate.argtypes = [
+      ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p), ctypes.c_long,
+      ctypes.c_void_p]
+    self.cf.CFRelease.argtypes = [ctypes.c_void_p]
+    self.cs.FSEventStreamCreate.restype = ctypes.c_void_p
+    self.cs.FSEventStreamCreate.argtypes = [
+      ctypes.c_void_p, _FSEventStreamCallback, ctypes.c_void_p,
+      ctypes.c_void_p, ctypes.c_uint64, ctypes.c_double, ctypes.c_uint32]
+    for name in ["FSEventStreamSetDispatchQueue", "FSEventStreamStart",
+                 "FSEventStreamStop", "FSEventStreamInvalidate",
+                 "FSEventStreamRelease"]:
+      getattr(self.cs, name).argtypes = (
+        [ctypes.c_void_p, ctypes.c_void_p]
+        if name == "FSEventStreamSetDispatchQueue" else [ctypes.c_void_p])
+    self.system.dispatch_queue_create.restype = ctypes.c_void_p
+    self.system.dispatch_queue_create.argtypes = [ctypes.c_char_p,
+                                                  ctypes.c_void_p]
+
+    # FSEvents reports resolved paths, which are mapped back to the roots as
+    # given.
+    self.prefixes = [(os.path.realpath(root), root) for root in roots]
+    self.events = queue.Queue()
+    self.callback = _FSEventStreamCallback(self._callback)
+    strings = [self.cf.CFStringCreateWithCString(
+                 None, real.encode("utf-8"), CF_STRING_ENCODING_UTF8)
+               for (real, root) in self.prefixes]
+    callbacks = ctypes.c_void_p.in_dll(self.cf, "kCFTypeArrayCallBacks")
+    paths = self.cf.CFArrayCreate(
+      None, (ctypes.c_void_p * len(strings))(*strings), len(strings),
+      ctypes.addressof(callbacks))
+    for string in strings:
+      self.cf.CFRelease(string)
+    self.stream = self.cs.FSEventStreamCreate(
+      None, self.callback, None, paths, FSEVENTS_SINCE_NOW, SETTLE_SECONDS / 2,
+      FSEVENTS_NO_DEFER | FSEVENTS_WATCH_ROOT | FSEVENTS_FILE_EVENTS)
+    self.cf.CFRelease(paths)
+    if not self.stream:
+      raise OSError(errno.ENOSYS, "FSEventStreamCreate failed")
+    self.queue = self.system.dispatch_queue_create(b"dungeonstrike.watch",
+                                                   None)
+    self.cs.FSEventStreamSetDispatchQueue(self.stream, self.queue)
+    if not self.cs.FSEventStreamStart(self.stream):
+      self.cs.FSEventStreamInvalidate(self.stream)
+      self.cs.FSEventStreamRelease(self.stream)
+      raise OSError(errno.ENOSYS, "FSEventStreamStart failed")
+
+  def _path(self, path):
+    for (real, root) in self.prefixes:
+      if path == real or path.startswith(real + os.sep):
+        return root + path[len(real):]
+    return path
+
+  def _callback(self, stream, info, count, paths, flags, ids):
+    for index in range(count):
+      if flags[index] & (FSEVENTS_MUST_SCAN_SUBDIRS | FSEVENTS_USER_DROPPED |
+                         FSEVENTS_KERNEL_DROPPED | FSEVENTS_ROOT_CHANGED):
+        self.events.put(None)
+        continue
+      path = paths[index].decode("utf-8", "replace")
+      if not _ignored(os.path.basename(path)):
+        self.events.put(self._path(path))
+
+  def wait(self, timeout = None):
+    """Blocks until a file changes or 'timeout' seconds elapse. Returns the
+    set of paths which were created, modified or deleted, or None if events
+    were lost and every watched tree must be rescanned."""
+    changed = set()
+    lost = False
+    while True:
+      if changed or lost:
+        wait_time = SETTLE_SECONDS
+      else:
+        # Python 2's Queue.get can only be interrupted by Ctrl-C if it has a
+        # timeout.
+        wait_time = 3600 if timeout is None else timeout
+      try:
+        path = self.events.get(True, wait_time)
+      except queue.Empty:
+        if changed or lost:
+          return None if lost else changed
+        if timeout is not None:
+          return set()
+        continue
+      if path is None:
+        lost = True
+      else:
+        changed.add(path)
+
+  def close(self):
+    self.cs.FSEventStreamStop(self.stream)
+    self.cs.FSEventStreamInvalidate(self.stream)
+    self.cs.FSEventStreamRelease(self.stream)
+
+def create(roots, poll = False, interval = 1.0, slow_roots = (),
+           barrier_paths = ()):
+  """Returns an InotifyWatcher or FSEventsWatcher for 'roots' if possible, or
+  a PollingWatcher otherwise. See PollingWatcher for the other arguments."""
+  if not poll:
+    try:
+      if sys.platform == "darwin":
+        return FSEventsWatcher(roots)
+      return InotifyWatcher(roots)
+    except (OSError, AttributeError) as e:
+      print("File events unavailable (" + str(e) + "), polling for changes")
+  return PollingWatcher(roots, interval, slow_roots,
+                        barrier_paths = barrier_paths)
+
+def status_root(env):
+  return os.path.join(env.cache_root, "watch")
+
+def status_path(env):
+  """Returns the path of the status file published by the watch daemon."""
+  return os.path.join(status_root(env), "status.json")
+
+def sync_path(env):
+  """Returns the path of the file written by 'sync' to request an update."""
+  return os.path.join(status_root(env), "sync")
+
+def write_status(env, status):
+  status["updated"] = time.time()
+  tmp = status_path(env) + ".tmp"
+  with open(tmp, "w") as status_file:
+    json.dump(status, status_file)
+  os.rename(tmp, status_path(env))
+
+def read_status(env):
+  """Returns the status published by a running watch daemon, or None."""
+  try:
+    with open(status_path(env)) as status_file:
+      status = json.load(status_file)
+  except (IOError, ValueError):
+    return None
+  try:
+    os.kill(status["pid"], 0)
+  except OSError:
+    return None
+  return status
+
+def sync(env, timeout = 10):
+  """Waits for the watch daemon to process every change made before this call
+  and returns its status, or None if no daemon is running or it did not
+  respond within 'timeout' seconds. Changes are delivered in order, so once
+  the daemon has seen the request written here it has also seen every earlier
+  change."""
+  if not read_status(env):
+    return None
+  request = uuid.uuid4().hex
+  tmp = sync_path(env) + ".tmp"
+  with open(tmp, "w") as sync_file:
+    sync_file.write(request)
+  os.rename(tmp, sync_path(env))
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    status = read_status(env)
+    if not status:
+      return None
+    if status.get("synced") == request:
+      return status
+    time.sleep(0.05)
+  return None